@@ -0,0 +1,595 @@
+"""
+An in-process fake of the parts of python-irodsclient that the
+irods-acl-management code uses: the collections, data_objects and
+permissions managers, GenQuery (session.query) and specific queries.
+
+The catalog is generated from a few numbers instead of being stored, so
+trees of millions of objects fit in memory; only ACLs changed by the
+code under test are kept. Every round trip (a GenQuery or specific query
+page, a get/exists or a permissions call) waits for the configured
+latency and is counted per type.
+
+Example:
+catalog = FakeCatalog(objects=100000, latency=0.001)
+with fake_specific_queries():
+    session = FakeSession(catalog)
+    PermissionManager(session).save_acl('/tempZone/home', '/tmp', format='ndjson')
+print(catalog.round_trips)
+"""
+
+import re
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from irods.access import iRODSAccess
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from irods.models import Collection, DataObject, User, CollectionUser, DataAccess, \
+                         CollectionAccess, UserGroup
+import src.util
+from src.snapshot import in_subtree
+
+
+PAGE_SIZE = 256
+ACCESS_NAMES = {'read': 'read object', 'write': 'modify object', 'modify object': 'modify object',
+                'read object': 'read object', 'own': 'own'}
+
+
+class FakeCatalog(object):
+    """
+    This class generates a zone with a balanced collection tree.
+    ...
+    Attributes
+    ----------
+    zone : str
+        the zone name.
+    objects : int
+        the number of data objects.
+    per_collection : int
+        the number of data objects in a collection.
+    fanout : int
+        the number of sub-collections of a collection.
+    users : int
+        the number of users owning objects.
+    groups : int
+        the number of groups getting read access.
+    orphan_every : int
+        every n-th object has no ACL at all, 0 for none.
+    latency : float
+        seconds every round trip waits.
+    collation : str
+        the order of the names, 'C' for the order of Python strings or
+        'nocase' like the case insensitive collation of a MySQL catalog;
+        with 'nocase' every other collection and data object name starts
+        with a capital, so both orders differ.
+    round_trips : dict
+        the number of round trips per type.
+    writers : float
+        the mean number of permission changes sent at the same time.
+    """
+
+    def __init__(self, objects=10000, per_collection=100, fanout=10, users=20, groups=20,
+                 orphan_every=50, latency=0.0, zone='tempZone', collation='C'):
+        """A constructor method"""
+        self.zone = zone
+        self.objects = objects
+        self.per_collection = per_collection
+        self.fanout = fanout
+        self.user_names = [f'user_{i}' for i in range(users)]
+        self.group_names = [f'group_{i}' for i in range(groups)]
+        self.orphan_every = orphan_every
+        self.latency = latency
+        self.collation = collation
+        self.collate = str.lower if collation == 'nocase' else str
+        self.round_trips = {}
+        self.writers = 0.0
+        self._writing = 0
+        self._writes = 0
+        self.overrides = {}
+        self.inheritance_overrides = {}
+        self.inheritance_modified = {}
+        self.modified = {}
+        self._lock = threading.Lock()
+        self.root = f'/{zone}/home'
+        count = max((objects + per_collection - 1) // per_collection, 1)
+        self.collection_paths = [self.root]
+        for index in range(1, count):
+            parent = self.collection_paths[(index - 1) // fanout]
+            self.collection_paths.append(f'{parent}/{self._capital(index)}oll_{index:07d}')
+        self.collection_index = {path: index for index, path in enumerate(self.collection_paths)}
+        self.sorted_collections = sorted(range(count), key=lambda i: self.collate(self.collection_paths[i]))
+
+    # -- round trips -------------------------------------------------------
+
+    def round_trip(self, kind):
+        with self._lock:
+            self.round_trips[kind] = self.round_trips.get(kind, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # -- objects -----------------------------------------------------------
+
+    def data_objects_in(self, coll_index):
+        start = coll_index * self.per_collection
+        return range(start, min(start + self.per_collection, self.objects))
+
+    def _capital(self, index):
+        return 'C' if self.collation == 'nocase' and index % 2 else 'c'
+
+    def data_name(self, object_index):
+        return f'{"O" if self._capital(object_index) == "C" else "o"}bj_{object_index:09d}.dat'
+
+    def data_path(self, object_index):
+        coll_index = object_index // self.per_collection
+        return f'{self.collection_paths[coll_index]}/{self.data_name(object_index)}'
+
+    def find_data_object(self, path):
+        coll_path, _, name = path.rpartition('/')
+        coll_index = self.collection_index.get(coll_path)
+        match = re.match(r'[Oo]bj_(\d+)\.dat$', name)
+        if coll_index is None or match is None:
+            return None
+        object_index = int(match.group(1))
+        if object_index >= self.objects or object_index // self.per_collection != coll_index or \
+                name != self.data_name(object_index):
+            return None
+        return object_index
+
+    def owner(self, kind, index):
+        return self.user_names[index % len(self.user_names)]
+
+    def inheritance(self, coll_index):
+        return self.inheritance_overrides.get(coll_index, coll_index % 2 == 0)
+
+    def object_id(self, kind, index):
+        return index + 1 if kind == 'collection' else 10 ** 9 + index
+
+    def acl(self, kind, index):
+        """A method returning {user: access} of an object"""
+        override = self.overrides.get((kind, index))
+        if override is not None:
+            return override
+        if self.orphan_every and index % self.orphan_every == self.orphan_every - 1:
+            return {}
+        acl = {self.owner(kind, index): 'own'}
+        if index % 3 != 0:
+            acl[self.group_names[index % len(self.group_names)]] = 'read object'
+        return acl
+
+    def set_acl(self, kind, index, user, access):
+        with self._lock:
+            acl = dict(self.acl(kind, index))
+            if access == 'null':
+                acl.pop(user, None)
+            else:
+                acl[user] = ACCESS_NAMES.get(access, access)
+            self.overrides[(kind, index)] = acl
+            self.modified[(kind, index)] = int(time.time())
+
+    def user_groups(self, name):
+        """A method returning the groups a user is member of, its personal group included"""
+        groups = [name]
+        if name in self.user_names:
+            groups.append(self.group_names[self.user_names.index(name) % len(self.group_names)])
+        return groups
+
+    def user_type(self, name):
+        if name in self.group_names:
+            return 'rodsgroup'
+        return 'rodsadmin' if name == 'rods' else 'rodsuser'
+
+    # -- permissions -------------------------------------------------------
+
+    def apply(self, acl, recursive=False):
+        """A method to apply an iRODSAccess like modAccessControl does"""
+        coll_index = self.collection_index.get(acl.path)
+        targets = []
+        if coll_index is not None:
+            subtree = [coll_index]
+            if recursive:
+                subtree = [index for index, path in enumerate(self.collection_paths)
+                           if path == acl.path or path.startswith(f'{acl.path}/')]
+            for index in subtree:
+                targets.append(('collection', index))
+                if recursive:
+                    targets.extend(('data_obj', i) for i in self.data_objects_in(index))
+        else:
+            object_index = self.find_data_object(acl.path)
+            if object_index is None:
+                raise DataObjectDoesNotExist(acl.path)
+            targets.append(('data_obj', object_index))
+        for kind, index in targets:
+            if acl.access_name in ('inherit', 'noinherit'):
+                if kind == 'collection':
+                    self.inheritance_overrides[index] = acl.access_name == 'inherit'
+                    self.inheritance_modified[index] = int(time.time())
+            else:
+                self.set_acl(kind, index, acl.user_name, acl.access_name)
+
+    # -- query row sources ---------------------------------------------------
+
+    def collections_matching(self, criteria):
+        """A method to get indexes of collections satisfying the Collection.name criteria"""
+        name_criteria = [c for c in criteria if c.query_key is Collection.name]
+        for index in self.sorted_collections:
+            path = self.collection_paths[index]
+            if all(_matches(c, path, self.collate) for c in name_criteria):
+                yield index
+
+    def collection_row(self, index):
+        return {Collection.name: self.collection_paths[index], Collection.id: self.object_id('collection', index),
+                Collection.inheritance: '1' if self.inheritance(index) else '0',
+                Collection.owner_name: self.owner('collection', index), Collection.owner_zone: self.zone,
+                Collection.modify_time: f'{self.inheritance_modified.get(index, 0):011d}'}
+
+    def data_row(self, index):
+        coll_index = index // self.per_collection
+        row = self.collection_row(coll_index)
+        row.update({DataObject.name: self.data_name(index), DataObject.id: self.object_id('data_obj', index),
+                    DataObject.owner_name: self.owner('data_obj', index), DataObject.owner_zone: self.zone})
+        return row
+
+    def rows(self, columns, criteria):
+        """A generator method yielding full rows of the table the columns refer to"""
+        models = set(_model_of(column) for column in columns)
+        models |= set(_model_of(c.query_key) for c in criteria)
+        if UserGroup in models:
+            for name in ['rods'] + self.user_names:
+                for group in self.user_groups(name):
+                    yield {User.name: name, User.zone: self.zone, User.type: self.user_type(name),
+                           UserGroup.name: group}
+        elif DataAccess in models:
+            for coll_index in self.collections_matching(criteria):
+                for index in self.data_objects_in(coll_index):
+                    base = self.data_row(index)
+                    for user, access in sorted(self.acl('data_obj', index).items()):
+                        row = dict(base)
+                        row.update({User.name: user, User.zone: self.zone, User.type: self.user_type(user),
+                                    DataAccess.name: access})
+                        yield row
+        elif CollectionAccess in models:
+            for coll_index in self.collections_matching(criteria):
+                base = self.collection_row(coll_index)
+                for user, access in sorted(self.acl('collection', coll_index).items()):
+                    row = dict(base)
+                    row.update({CollectionUser.name: user, CollectionUser.zone: self.zone,
+                                CollectionAccess.name: access})
+                    yield row
+        elif DataObject in models:
+            for coll_index in self.collections_matching(criteria):
+                for index in self.data_objects_in(coll_index):
+                    yield self.data_row(index)
+        elif Collection in models:
+            for coll_index in self.collections_matching(criteria):
+                yield self.collection_row(coll_index)
+        else:
+            for name in ['rods'] + self.user_names + self.group_names:
+                yield {User.name: name, User.zone: self.zone, User.type: self.user_type(name)}
+
+    def query(self, columns, criteria):
+        """A generator method yielding the selected columns of all matching rows"""
+        distinct = Collection.name not in columns
+        seen = set()
+        for row in self.rows(columns, criteria):
+            if not all(_matches(c, row.get(c.query_key)) for c in criteria
+                       if c.query_key is not Collection.name):
+                continue
+            result = {column: row.get(column) for column in columns}
+            if distinct:
+                key = tuple(result.values())
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield result
+
+    # -- specific queries ----------------------------------------------------
+
+    def specific_query(self, alias, columns, args, sql=''):
+        """A generator method answering the specific queries the code registers"""
+        if alias.startswith(('list_orphaned_data_object_in_shard_', 'list_orphaned_collections_in_shard_')):
+            args = list(args)
+            lower = args.pop(0) if 'coll_name >= ?' in sql else None
+            upper = args.pop(0) if 'coll_name < ?' in sql else None
+            kind = 'data_obj' if alias.startswith('list_orphaned_data_object') else 'collection'
+            for index in range(self.objects if kind == 'data_obj' else len(self.collection_paths)):
+                coll_path = self.collection_paths[index // self.per_collection if kind == 'data_obj' else index]
+                if (lower is None or self.collate(coll_path) >= self.collate(lower)) and \
+                        (upper is None or self.collate(coll_path) < self.collate(upper)) and \
+                        not self.acl(kind, index):
+                    yield self.data_row(index) if kind == 'data_obj' else self.collection_row(index)
+        elif alias in ('list_orphaned_data_object', 'list_orphaned_data_object_with_owner'):
+            after = int(args[0]) if args else 0
+            for index in range(self.objects):
+                if self.object_id('data_obj', index) > after and not self.acl('data_obj', index):
+                    yield self.data_row(index)
+        elif alias in ('list_orphaned_collections', 'list_orphaned_collections_with_owner'):
+            after = int(args[0]) if args else 0
+            for index in range(len(self.collection_paths)):
+                if self.object_id('collection', index) > after and not self.acl('collection', index):
+                    yield self.collection_row(index)
+        elif alias in ('list_changed_collection_acls', 'list_changed_data_object_acls'):
+            since, coll_path, _ = args
+            kind = 'collection' if alias == 'list_changed_collection_acls' else 'data_obj'
+            for (changed_kind, index), modified in sorted(self.modified.items()):
+                if changed_kind != kind or modified <= int(since):
+                    continue
+                row = self.collection_row(index) if kind == 'collection' else self.data_row(index)
+                if not in_subtree(row[Collection.name], coll_path):
+                    continue
+                for user, access in self.acl(kind, index).items():
+                    row = dict(row)
+                    row.update({User.name: user, User.zone: self.zone, CollectionAccess.name: access,
+                                DataAccess.name: access})
+                    yield row
+        else:
+            raise ValueError(f'The fake catalog does not know the specific query {alias}')
+
+
+class FakeQuery(object):
+    """This class mimics irods.query.Query on top of a FakeCatalog"""
+
+    def __init__(self, session, columns, criteria=None, counted=()):
+        self.session = session
+        self.columns = list(columns)
+        self.criteria = list(criteria or [])
+        self.counted = tuple(counted)
+
+    def filter(self, *criteria):
+        return FakeQuery(self.session, self.columns, self.criteria + list(criteria), self.counted)
+
+    def order_by(self, column, order='asc'):
+        # the fake catalog always returns rows sorted by path, in the order of its collation
+        return self
+
+    def count(self, *columns):
+        return FakeQuery(self.session, self.columns, self.criteria, self.counted + columns)
+
+    def get_batches(self):
+        catalog = self.session.catalog
+        rows = catalog.query(self.columns, self.criteria)
+        if self.counted:
+            rows = _counted_rows(rows, self.counted)
+        while True:
+            catalog.round_trip('query')
+            page = [row for _, row in zip(range(PAGE_SIZE), rows)]
+            yield page
+            if len(page) < PAGE_SIZE:
+                return
+
+    def __iter__(self):
+        for page in self.get_batches():
+            for row in page:
+                yield row
+
+    def all(self):
+        return _Rows(list(self))
+
+
+def _counted_rows(rows, counted):
+    """A function to group rows on their other columns and count the counted ones, like SELECT_COUNT"""
+    groups = {}
+    for row in rows:
+        key = tuple((column, value) for column, value in row.items()
+                    if not any(column is other for other in counted))
+        counts = groups.setdefault(key, dict.fromkeys(counted, 0))
+        for column in counted:
+            if row.get(column) is not None:
+                counts[column] += 1
+    for key, counts in groups.items():
+        row = dict(key)
+        row.update({column: str(count) for column, count in counts.items()})
+        yield row
+
+
+class _Rows(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeSpecificQuery(object):
+    """This class mimics irods.query.SpecificQuery on top of a FakeCatalog"""
+
+    def __init__(self, session, sql=None, alias=None, columns=None, args=None):
+        self.session = session
+        self.sql = sql or ''
+        self.alias = alias
+        self.columns = columns
+        self.args = args or []
+
+    def register(self):
+        self.session.catalog.round_trip('specific_query_admin')
+
+    def remove(self):
+        self.session.catalog.round_trip('specific_query_admin')
+
+    def get_batches(self):
+        catalog = self.session.catalog
+        rows = catalog.specific_query(self.alias, self.columns, self.args, self.sql)
+        while True:
+            catalog.round_trip('specific_query')
+            page = [{column: row.get(column) for column in self.columns}
+                    for _, row in zip(range(PAGE_SIZE), rows)]
+            yield page
+            if len(page) < PAGE_SIZE:
+                return
+
+    def __iter__(self):
+        for page in self.get_batches():
+            for row in page:
+                yield row
+
+
+class FakeCollection(object):
+    def __init__(self, catalog, index):
+        self.id = catalog.object_id('collection', index)
+        self.path = catalog.collection_paths[index]
+        self.name = self.path.rpartition('/')[2]
+        self.inheritance = catalog.inheritance(index)
+        self.owner_name = catalog.owner('collection', index)
+        self.owner_zone = catalog.zone
+        self._index = index
+
+
+class FakeDataObject(object):
+    def __init__(self, catalog, index):
+        self.id = catalog.object_id('data_obj', index)
+        self.path = catalog.data_path(index)
+        self.name = catalog.data_name(index)
+        self.owner_name = catalog.owner('data_obj', index)
+        self.owner_zone = catalog.zone
+        self._index = index
+
+
+class _CollectionManager(object):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def get(self, path):
+        self.catalog.round_trip('collections.get')
+        index = self.catalog.collection_index.get(path.rstrip('/') or '/')
+        if index is None:
+            raise CollectionDoesNotExist(path)
+        return FakeCollection(self.catalog, index)
+
+    def exists(self, path):
+        self.catalog.round_trip('collections.exists')
+        return (path.rstrip('/') or '/') in self.catalog.collection_index
+
+
+class _DataObjectManager(object):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def get(self, path):
+        self.catalog.round_trip('data_objects.get')
+        index = self.catalog.find_data_object(path)
+        if index is None:
+            raise DataObjectDoesNotExist(path)
+        return FakeDataObject(self.catalog, index)
+
+    def exists(self, path):
+        self.catalog.round_trip('data_objects.exists')
+        return self.catalog.find_data_object(path) is not None
+
+
+class _AccessManager(object):
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def get(self, target, report_raw_acls=False, **kw):
+        self.catalog.round_trip('permissions.get')
+        kind = 'collection' if isinstance(target, FakeCollection) else 'data_obj'
+        return [iRODSAccess(access, target.path, user, self.catalog.zone)
+                for user, access in sorted(self.catalog.acl(kind, target._index).items())]
+
+    def set(self, acl, recursive=False, admin=False, **kw):
+        catalog = self.catalog
+        with catalog._lock:
+            catalog._writing += 1
+            catalog._writes += 1
+            catalog.writers += (catalog._writing - catalog.writers) / catalog._writes
+        try:
+            catalog.round_trip('permissions.set')
+            catalog.apply(acl, recursive=recursive)
+        finally:
+            with catalog._lock:
+                catalog._writing -= 1
+
+
+class FakeSession(object):
+    """
+    This class mimics irods.session.iRODSSession for the code of this
+    project. Sessions created on the same catalog share its state, like
+    pooled connections to one zone do.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.zone = catalog.zone
+        self.collections = _CollectionManager(catalog)
+        self.data_objects = _DataObjectManager(catalog)
+        self.permissions = _AccessManager(catalog)
+
+    def query(self, *columns, **kwargs):
+        return FakeQuery(self, columns)
+
+    def cleanup(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+
+class FakeSessionFactory(object):
+    """
+    This class is a picklable session factory for the processes of a
+    sharded scan. In the process that created it, it returns sessions on
+    the given catalog; a process it is pickled into generates the same
+    catalog once and answers specific queries from it. The round trips
+    of other processes are not counted in the given catalog.
+    """
+
+    def __init__(self, catalog):
+        self.options = {'objects': catalog.objects, 'per_collection': catalog.per_collection,
+                        'fanout': catalog.fanout, 'users': len(catalog.user_names),
+                        'groups': len(catalog.group_names), 'orphan_every': catalog.orphan_every,
+                        'latency': catalog.latency, 'zone': catalog.zone, 'collation': catalog.collation}
+        self.catalog = catalog
+
+    def __getstate__(self):
+        return {'options': self.options, 'catalog': None}
+
+    def __call__(self):
+        if self.catalog is None:
+            self.catalog = FakeCatalog(**self.options)
+            src.util.SpecificQuery = FakeSpecificQuery
+        return FakeSession(self.catalog)
+
+
+@contextmanager
+def fake_specific_queries():
+    """A context manager to answer specific queries from the fake catalog"""
+    original = src.util.SpecificQuery
+    src.util.SpecificQuery = FakeSpecificQuery
+    try:
+        yield
+    finally:
+        src.util.SpecificQuery = original
+
+
+def _model_of(column):
+    """A function to find the model class a column belongs to"""
+    for model in (DataAccess, CollectionAccess, CollectionUser, DataObject, Collection, User, UserGroup):
+        if any(column is candidate for candidate in model._columns):
+            return model
+    return None
+
+
+def _like_to_regex(pattern):
+    return re.compile('^' + ''.join('.*' if char == '%' else '.' if char == '_' else re.escape(char)
+                                    for char in pattern) + '$', re.S)
+
+
+def _matches(criterion, value, collate=str):
+    """A function to evaluate a GenQuery criterion on a value, comparing in the order of collate"""
+    op = criterion.op.lower()
+    if op == '=':
+        return str(value) == str(criterion.value)
+    if op in ('<>', '!='):
+        return str(value) != str(criterion.value)
+    if op == 'like':
+        return _like_to_regex(criterion.value).match(str(value)) is not None
+    if op == 'not like':
+        return _like_to_regex(criterion.value).match(str(value)) is None
+    if op in ('>', '<', '>=', '<='):
+        return {'>': str.__gt__, '<': str.__lt__, '>=': str.__ge__, '<=': str.__le__}[op](collate(str(value)),
+                                                                                   collate(str(criterion.value)))
+    if op == 'in':
+        return str(value) in [str(item) for item in criterion.value]
+    raise ValueError(f'The fake catalog does not support the operator {criterion.op}')
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_irods import FakeCatalog, FakeSession, FakeSessionFactory, fake_specific_queries
+from src.manage_acl import PermissionManager
+from src.checkpoint import Checkpoint
+from src.index import AclIndex
+from src.shard import ShardedScan
+
+
+desc = """Run the PermissionManager operations against an in-process fake
+iRODS catalog and report wall time, round trips and peak memory per
+operation. The catalog is a generated tree of data objects with owner and
+group ACLs; every round trip waits for --latency milliseconds, so the
+numbers show how an operation scales with the size of a tree and with
+the distance to the catalog without a running iRODS server.
+
+Example:
+benchmarks/run_benchmarks.py
+benchmarks/run_benchmarks.py -n 10000 100000 --latency 1
+benchmarks/run_benchmarks.py -n 1000000 -o save_ndjson check_zone --no-memory
+benchmarks/run_benchmarks.py -n 10000 -o set_client_side --jobs 8 --latency 2 --json
+
+With --jobs N and a latency, an operation sending many ACL changes
+but fewer than N at the same time is reported and the exit code is 1.
+"""
+
+
+def list_recursive(manager, catalog, workdir):
+    manager.target_path = catalog.root
+    manager.list_acl_recursively()
+
+def save(format):
+    def run(manager, catalog, workdir):
+        manager.save_acl(catalog.root, workdir, format=format)
+    return run
+
+def save_sharded(manager, catalog, workdir):
+    # the shards share the in-process catalog, so they are scanned one after another
+    scan = ShardedScan(manager.session, catalog.root, 4, jobs=1, session_factory=lambda: FakeSession(catalog))
+    scan.save(os.path.join(workdir, 'sharded.ndjson'), 'ndjson')
+
+def save_sharded_jobs(manager, catalog, workdir):
+    # every process generates the catalog anew, the round trips of the processes are not counted
+    scan = ShardedScan(manager.session, catalog.root, 4, jobs=4, session_factory=FakeSessionFactory(catalog))
+    scan.save(os.path.join(workdir, 'sharded.ndjson'), 'ndjson')
+
+def save_incremental(manager, catalog, workdir):
+    state = os.path.join(workdir, 'baseline.state')
+    manager.save_acl(catalog.root, workdir, format='ndjson', baseline=state)
+    manager.save_acl(catalog.root, workdir, format='ndjson', since=state)
+
+def compare_recursive(manager, catalog, workdir):
+    source, target = catalog.collection_paths[1:3]
+    manager.compare_acl_of_two_collections_recursively(source, target)
+
+def check_recursive(manager, catalog, workdir):
+    manager.search_orphaned_objects(collection_path=catalog.root, recursive=True)
+
+def audit_inheritance(manager, catalog, workdir):
+    manager.audit_inheritance(catalog.root, summary=True)
+
+def check_zone(manager, catalog, workdir):
+    manager.search_orphaned_objects_entire_zone(zone_name=catalog.zone)
+
+def check_zone_sharded(manager, catalog, workdir):
+    scan = ShardedScan(manager.session, f'/{catalog.zone}', 4, jobs=4, session_factory=FakeSessionFactory(catalog))
+    scan.orphans()
+
+def restore_zone(manager, catalog, workdir):
+    checkpoint = Checkpoint(os.path.join(workdir, 'restore.checkpoint'))
+    manager.restore_original_owner(zone_name=catalog.zone, checkpoint=checkpoint)
+
+def set_server_side(manager, catalog, workdir):
+    manager.target_path = catalog.root
+    manager.set_acl('group_0', 'write', recursive=True)
+
+def set_client_side(manager, catalog, workdir):
+    manager.target_path = catalog.root
+    manager.set_acl('group_0', 'write', recursive=True, server_side=False)
+
+def clear_server_side(manager, catalog, workdir):
+    manager.target_path = catalog.root
+    manager.remove_all_acl_recursively()
+
+def clear_client_side(manager, catalog, workdir):
+    manager.target_path = catalog.root
+    manager.remove_all_acl_recursively(server_side=False)
+
+def index_build(manager, catalog, workdir):
+    with AclIndex(os.path.join(workdir, 'index.sqlite')) as index:
+        index.build(manager.session, catalog.root, session_pool=manager.session_pool)
+
+def check_offline(manager, catalog, workdir):
+    filename = os.path.join(workdir, 'index.sqlite')
+    with AclIndex(filename) as index:
+        index.build(manager.session, catalog.root, session_pool=manager.session_pool)
+    with AclIndex(filename, readonly=True) as index:
+        offline = PermissionManager(None, index=index)
+        offline.search_orphaned_objects(collection_path=catalog.root, recursive=True)
+        offline.search_orphaned_objects_entire_zone(zone_name=catalog.zone)
+
+def revoke_user(manager, catalog, workdir):
+    manager.revoke_user('user_0')
+
+def reconcile(manager, catalog, workdir):
+    policy = os.path.join(workdir, 'policy.json')
+    with open(policy, 'w') as f:
+        json.dump({f'{catalog.root}/**': {'g:group_0': 'read', 'inherit': True},
+                   f'{catalog.root}/*/*.dat': {'user_0': 'own'}}, f)
+    manager.reconcile_policy(policy)
+    manager.reconcile_policy(policy)
+
+def copy(manager, catalog, workdir):
+    manager.source_path = catalog.root
+    manager.target_path = catalog.collection_paths[1]
+    manager.copy_acl()
+
+
+OPERATIONS = {
+    'list_recursive': list_recursive,
+    'save_csv': save('csv'),
+    'save_json': save('json'),
+    'save_ndjson': save('ndjson'),
+    'save_sharded': save_sharded,
+    'save_sharded_jobs': save_sharded_jobs,
+    'save_incremental': save_incremental,
+    'compare_recursive': compare_recursive,
+    'check_recursive': check_recursive,
+    'check_zone': check_zone,
+    'check_zone_sharded': check_zone_sharded,
+    'audit_inheritance': audit_inheritance,
+    'restore_zone': restore_zone,
+    'set_server_side': set_server_side,
+    'set_client_side': set_client_side,
+    'clear_server_side': clear_server_side,
+    'clear_client_side': clear_client_side,
+    'copy': copy,
+    'revoke_user': revoke_user,
+    'reconcile': reconcile,
+    'index_build': index_build,
+    'check_offline': check_offline,
+}
+
+
+def run_operation(name, objects, args):
+    """
+    A function to run one operation on a newly generated catalog
+    Returns a dict with the wall time, round trips and peak memory.
+    """
+    catalog = FakeCatalog(objects=objects, per_collection=args.per_collection, fanout=args.fanout,
+                          users=args.users, groups=args.groups, orphan_every=args.orphan_every,
+                          latency=args.latency / 1000.0, collation=args.collation)
+    session = FakeSession(catalog)
+    manager = PermissionManager(session, jobs=args.jobs, session_factory=lambda: FakeSession(catalog))
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with fake_specific_queries(), redirect_stdout(devnull):
+            OPERATIONS[name](manager, catalog, workdir)
+            manager.close()
+        wall = time.perf_counter() - start
+        peak = 0
+        if args.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {'operation': name, 'objects': objects, 'latency_ms': args.latency, 'jobs': args.jobs,
+            'wall': wall, 'round_trips': sum(catalog.round_trips.values()),
+            'round_trips_by_type': dict(sorted(catalog.round_trips.items())),
+            'writers': catalog.writers, 'peak_memory': peak}
+
+
+def check_writers(result):
+    """
+    A function to check that an operation sending many ACL changes with
+    --jobs N and a latency sent N of them at the same time on average,
+    with half a change of slack for the start and the end of a batch,
+    returns a message if it did not
+    """
+    changes = result['round_trips_by_type'].get('permissions.set', 0)
+    if result['jobs'] > 1 and result['latency_ms'] > 0 and changes >= 100 * result['jobs'] and \
+            result['writers'] < result['jobs'] - 0.5:
+        return f"{result['operation']}: on average {result['writers']:.1f} of its {changes} ACL changes " \
+               f"were sent at the same time, not {result['jobs']}"
+    return None
+
+
+def format_result(result):
+    peak = f"{result['peak_memory'] / 2 ** 20:.1f}" if result['peak_memory'] else '-'
+    return f"{result['operation']:<20}{result['objects']:>10}{result['wall']:>10.3f}" \
+           f"{result['round_trips']:>12}{peak:>14}"
+
+
+arg_parser = ArgumentParser(description=desc,
+                            formatter_class=RawDescriptionHelpFormatter)
+
+arg_parser.add_argument('-n', '--objects', type=int, nargs='+', default=[10000],
+                        help='Number of data objects of the generated trees, e.g. 10000 1000000.')
+arg_parser.add_argument('-o', '--operations', nargs='+', choices=sorted(OPERATIONS),
+                        default=sorted(OPERATIONS), help='Operations to run, all by default.')
+arg_parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds every round trip to the fake catalog waits.')
+arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of parallel connections sending ACL changes.')
+arg_parser.add_argument('--per-collection', type=int, default=100,
+                        help='Number of data objects in a collection.')
+arg_parser.add_argument('--fanout', type=int, default=10,
+                        help='Number of sub-collections of a collection.')
+arg_parser.add_argument('--users', type=int, default=20,
+                        help='Number of users owning objects.')
+arg_parser.add_argument('--groups', type=int, default=20,
+                        help='Number of groups getting read access.')
+arg_parser.add_argument('--orphan-every', type=int, default=50,
+                        help='Every n-th object has no ACL at all, 0 for none.')
+arg_parser.add_argument('--collation', choices=['C', 'nocase'], default='C',
+                        help='The order of the names in the catalog: C, or nocase like a case insensitive \
+                              MySQL catalog, whose names then differ in case.')
+arg_parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Does not trace the peak memory, which slows the operations down.')
+arg_parser.add_argument('--json', action='store_true',
+                        help='Prints the results as newline delimited json.')
+
+args = arg_parser.parse_args()
+
+if not args.json:
+    print(f"{'OPERATION':<20}{'OBJECTS':>10}{'WALL(s)':>10}{'ROUND TRIPS':>12}{'PEAK MEM(MB)':>14}")
+failures = []
+for objects in args.objects:
+    for name in args.operations:
+        result = run_operation(name, objects, args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(format_result(result))
+        failure = check_writers(result)
+        if failure is not None:
+            failures.append(failure)
+for failure in failures:
+    print(failure, file=sys.stderr)
+if failures:
+    sys.exit(1)
@@ -0,0 +1,115 @@
+import json
+from collections import namedtuple
+from .compare import Difference
+
+
+Drift = namedtuple('Drift', ['path', 'object_type', 'parent', 'differences'])
+
+
+def acl_grants(acls):
+    """
+    A function to reduce the ACLs of an object to a sorted tuple of
+    ((user, zone), access) grants, so equal ACL sets compare equal
+    """
+    return tuple(sorted(((item.user_name, item.user_zone), item.access_name) for item in acls))
+
+
+def audit_inheritance(snapshot, coll_path, ignore_extra=False, counts=None):
+    """
+    A generator function:
+    It reads all objects of a tree with their ACLs in bulk and compares
+    in a single pass the ACLs of every object in a collection with
+    inheritance on against the ACLs of that collection. Objects with the
+    same grants as their parent are skipped without a closer look.
+    Only the grants of collections with inheritance on are kept,
+    so the memory does not grow with the number of data objects.
+    A collection differing from its parent is reported once; the
+    objects below it are compared with it, not with its parent.
+    Parameters
+    ----------
+    snapshot : object
+        an AclSnapshot object
+    coll_path : str
+        an absolute iRODS collection path
+    ignore_extra : bool
+        whether grants an object has on top of the ones of its parent,
+        e.g. the 'own' ACL of the user who created it, are left out.
+    counts : dict
+        when given, it is filled with the number of objects compared
+        per collection with inheritance on.
+    Returns
+    -------
+    A generator object for Drift tuples, their differences are Difference
+    tuples of kind 'missing grant', 'extra grant', 'access' or 'inheritance'
+    with the value of the parent as source and of the object as target.
+    """
+
+    parents = {}
+    for path, object_type, inheritance, acls in snapshot.objects_with_acls(coll_path):
+        grants = acl_grants(acls)
+        parent_path = path.rsplit('/', 1)[0] or '/'
+        parent = parents.get(parent_path)
+        if object_type == 'collection' and inheritance:
+            parents[path] = grants
+        if parent is None:
+            continue
+        if counts is not None:
+            counts[parent_path] = counts.get(parent_path, 0) + 1
+        differences = []
+        if object_type == 'collection' and not inheritance:
+            differences.append(Difference('inheritance', path, object_type, None, True, False))
+        if grants != parent:
+            differences.extend(_diff_grants(path, object_type, parent, grants, ignore_extra))
+        if differences:
+            yield Drift(path, object_type, parent_path, differences)
+
+
+def _diff_grants(path, object_type, parent_grants, grants, ignore_extra):
+    """A private function to list how the grants of an object differ from the ones of its parent"""
+    parent_acls = dict(parent_grants)
+    acls = dict(grants)
+    for user in sorted(set(parent_acls) | set(acls)):
+        if user not in acls:
+            yield Difference('missing grant', path, object_type, user, parent_acls[user], None)
+        elif user not in parent_acls:
+            if not ignore_extra:
+                yield Difference('extra grant', path, object_type, user, None, acls[user])
+        elif parent_acls[user] != acls[user]:
+            yield Difference('access', path, object_type, user, parent_acls[user], acls[user])
+
+
+def format_drift(drift, is_group=None):
+    """
+    A function to show a drift as a line of text
+    is_group is called with a user name to prefix groups with 'g:'
+    """
+    if drift.object_type == 'collection':
+        path = f'C - {drift.path} (subtree)'
+    else:
+        path = drift.path
+    parts = []
+    for difference in drift.differences:
+        if difference.kind == 'inheritance':
+            parts.append('inheritance off')
+            continue
+        user_name, user_zone = difference.user
+        group = 'g:' if is_group is not None and is_group(user_name) else ''
+        user = f'{group}{user_name}#{user_zone}'
+        if difference.kind == 'missing grant':
+            parts.append(f'missing {user}:{difference.source}')
+        elif difference.kind == 'extra grant':
+            parts.append(f'extra {user}:{difference.target}')
+        else:
+            parts.append(f'{user} {difference.source} -> {difference.target}')
+    return f'{path}: ' + ', '.join(parts)
+
+
+def drift_to_json(drift):
+    """A function to show a drift as a json object"""
+    differences = []
+    for difference in drift.differences:
+        user_name, user_zone = difference.user if difference.user else (None, None)
+        differences.append({'kind': difference.kind, 'user_name': user_name, 'user_zone': user_zone,
+                            'parent': difference.source, 'object': difference.target})
+    return json.dumps({'path': drift.path, 'object_type': drift.object_type,
+                       'parent': drift.parent, 'differences': differences})
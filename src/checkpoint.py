@@ -0,0 +1,112 @@
+import os
+import json
+import time
+
+
+class Checkpoint(object):
+    """
+    This class keeps a compact journal of a long running operation in
+    a local json file, so that an interrupted run can continue where it
+    stopped. The journal holds free form progress markers (e.g. the last
+    object id or collection that was completed) and the items that failed.
+    The file is written atomically and at most every interval seconds
+    unless a save is forced.
+    ...
+    Attributes
+    ----------
+    filename : str
+        a local file path of the journal.
+    interval : int
+        the minimum number of seconds between two writes.
+    state : dict
+        the progress markers.
+    failures : list
+        [item, error] pairs of the failed items.
+
+    Examples:
+
+        checkpoint = Checkpoint('/tmp/restore.checkpoint')
+        if resume:
+            checkpoint.load()
+        checkpoint.state['last_id'] = 42
+        checkpoint.save()
+        checkpoint.finish()
+    """
+
+    def __init__(self, filename, interval=10):
+        """A constructor method"""
+        self.filename = filename
+        self.interval = interval
+        self.state = {}
+        self.failures = []
+        self._saved_at = 0
+
+    def load(self):
+        """A method to read the journal of an earlier run, if there is one"""
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                journal = json.load(f)
+            self.state = journal.get('state', {})
+            self.failures = journal.get('failures', [])
+        return self
+
+    def add_failure(self, item, err):
+        """A method to record an item that could not be processed"""
+        self.failures.append([item, err])
+
+    def save(self, force=False):
+        """A method to write the journal when the interval has passed"""
+        now = time.monotonic()
+        if not force and now - self._saved_at < self.interval:
+            return
+        tmp_filename = f'{self.filename}.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'state': self.state, 'failures': self.failures}, f)
+        os.replace(tmp_filename, self.filename)
+        self._saved_at = now
+
+    def finish(self):
+        """
+        A method to close the journal at the end of a run
+        It is removed when nothing failed, otherwise it is kept
+        so that the failed items can be inspected or retried.
+        """
+        if self.failures:
+            self.save(force=True)
+        elif os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def resume_after(make_items, last, key):
+    """
+    A generator function:
+    It yields the items coming after the last completed one of an
+    earlier run. The items have to come in the same order on every
+    call of make_items, e.g. from a sorted catalog query. When the
+    last item is not found anymore, e.g. because it was removed, all
+    items are yielded again; setting an ACL twice does no harm.
+    Parameters
+    ----------
+    make_items : callable
+        a function returning a new iterable of the items
+    last : object
+        the key of the last completed item, None to start from the top
+    key : callable
+        a function returning the key of an item as it is journaled
+    Returns
+    -------
+    A generator object for the remaining items
+    """
+
+    if last is None:
+        yield from make_items()
+        return
+    found = False
+    for item in make_items():
+        if found:
+            yield item
+        elif key(item) == last:
+            found = True
+    if not found:
+        print('The last completed item of the checkpoint was not found, starting from the top.')
+        yield from make_items()
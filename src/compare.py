@@ -0,0 +1,230 @@
+import json
+import heapq
+import pickle
+import tempfile
+from operator import attrgetter
+from collections import namedtuple
+
+
+ObjectAcl = namedtuple('ObjectAcl', ['key', 'path', 'object_type', 'inheritance', 'acls'])
+Difference = namedtuple('Difference', ['kind', 'relative_path', 'object_type', 'user',
+                                       'source', 'target'])
+# objects of a tree sorted in memory at a time before a run is spilled to disk
+RUN_SIZE = 100000
+
+
+def relative_path(path, coll_path):
+    """A function to get the path of an object relative to the top of its tree"""
+    coll_path = coll_path.rstrip('/')
+    return path[len(coll_path):].lstrip('/') or '.'
+
+
+def sorted_object_acls(snapshot, coll_path, run_size=RUN_SIZE):
+    """
+    A function to read all objects of a tree with their ACLs in bulk
+    and to sort them by relative path.
+    The catalog sorts with its own collation, which does not have to
+    match python's, so both trees are sorted here with the same key.
+    Only compact tuples are kept: (key, path, type, inheritance, acls).
+    Parameters
+    ----------
+    snapshot : object
+        an AclSnapshot object
+    coll_path : str
+        an absolute iRODS collection path
+    run_size : int
+        the number of objects sorted in memory at a time
+    Returns
+    -------
+    A generator object for ObjectAcl tuples sorted by (relative path, object type)
+    """
+
+    return merge_runs(spill_object_acls(snapshot, coll_path, run_size))
+
+
+def spill_object_acls(snapshot, coll_path, run_size=RUN_SIZE):
+    """
+    A function to read all objects of a tree with their ACLs and to sort
+    them in runs of run_size objects. Every full run is written into an
+    anonymous temporary file, so the memory does not grow with the size
+    of the tree; only the last run is kept in memory.
+    Returns
+    -------
+    runs : list
+        temporary files and a list of ObjectAcl tuples, each sorted by key,
+        to be read with merge_runs
+    """
+
+    def objects():
+        for path, object_type, inheritance, acls in snapshot.objects_with_acls(coll_path):
+            key = (relative_path(path, coll_path), object_type)
+            grants = tuple(sorted(((item.user_name, item.user_zone), item.access_name) for item in acls))
+            yield ObjectAcl(key, path, object_type, inheritance, grants)
+
+    return spill_sorted(objects(), attrgetter('key'), run_size)
+
+
+def spill_sorted(items, key, run_size=RUN_SIZE):
+    """
+    A function to sort a stream of tuples in runs of run_size items.
+    Every full run is written into an anonymous temporary file; only
+    the last run is kept in memory.
+    Returns
+    -------
+    runs : list
+        temporary files and a list of tuples, each sorted by key,
+        to be read with merge_runs
+    """
+
+    runs = []
+    for _ in sort_in_runs(items, key, runs, run_size):
+        pass
+    return runs
+
+
+def sort_in_runs(items, key, runs, run_size=RUN_SIZE):
+    """
+    A generator function:
+    It passes a stream of tuples on while sorting them into runs like
+    spill_sorted, which are added to runs; the last one when the stream
+    ends. The temporary files are removed when the stream fails.
+    """
+
+    run = []
+    try:
+        for item in items:
+            run.append(item)
+            if len(run) >= run_size:
+                runs.append(_spill(run, key))
+                run = []
+            yield item
+    except BaseException:
+        close_runs(runs)
+        raise
+    run.sort(key=key)
+    runs.append(run)
+
+
+def merge_runs(runs, key=attrgetter('key'), make=ObjectAcl._make):
+    """
+    A generator function:
+    It merges sorted runs, of spill_object_acls by default, into one
+    stream sorted by key and removes their temporary files at the end.
+    make turns the tuples read back from a file into items again.
+    """
+
+    try:
+        streams = [_read_run(run, make) if hasattr(run, 'read') else iter(run) for run in runs]
+        for item in heapq.merge(*streams, key=key):
+            yield item
+    finally:
+        close_runs(runs)
+
+
+def close_runs(runs):
+    """A function to remove the temporary files of sorted runs that are not merged"""
+    for run in runs:
+        if hasattr(run, 'close'):
+            run.close()
+
+
+def _spill(items, key):
+    """A private function to sort a run of tuples and write it into a temporary file"""
+    items.sort(key=key)
+    f = tempfile.TemporaryFile()
+    for item in items:
+        # pickled one by one: a memo shared between the items would grow with the run
+        pickle.dump(tuple(item), f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _read_run(f, make):
+    """A private generator function reading a spilled run back"""
+    while True:
+        try:
+            yield make(pickle.load(f))
+        except EOFError:
+            return
+
+
+def diff_object_acls(source_objects, target_objects):
+    """
+    A generator function:
+    It merge-joins two sorted object streams in a single pass and
+    yields only the differences between them.
+    Parameters
+    ----------
+    source_objects : iterable
+        ObjectAcl tuples sorted by key
+    target_objects : iterable
+        ObjectAcl tuples sorted by key
+    Returns
+    -------
+    A generator object for Difference tuples. The kind is one of
+    'missing' (only in source), 'extra' (only in target), 'missing grant',
+    'extra grant', 'access' or 'inheritance'.
+    """
+
+    source_objects = iter(source_objects)
+    target_objects = iter(target_objects)
+    source = next(source_objects, None)
+    target = next(target_objects, None)
+    while source is not None or target is not None:
+        if target is None or (source is not None and source.key < target.key):
+            yield Difference('missing', source.key[0], source.object_type, None, source.path, None)
+            source = next(source_objects, None)
+        elif source is None or target.key < source.key:
+            yield Difference('extra', target.key[0], target.object_type, None, None, target.path)
+            target = next(target_objects, None)
+        else:
+            for difference in _diff_object(source, target):
+                yield difference
+            source = next(source_objects, None)
+            target = next(target_objects, None)
+
+
+def _diff_object(source, target):
+    """A private function to compare the ACLs of two objects with the same relative path"""
+    relative, object_type = source.key
+    if object_type == 'collection' and source.inheritance != target.inheritance:
+        yield Difference('inheritance', relative, object_type, None, source.inheritance, target.inheritance)
+    if source.acls == target.acls:
+        return
+    source_acls = dict(source.acls)
+    target_acls = dict(target.acls)
+    for user in sorted(set(source_acls) | set(target_acls)):
+        if user not in target_acls:
+            yield Difference('missing grant', relative, object_type, user, source_acls[user], None)
+        elif user not in source_acls:
+            yield Difference('extra grant', relative, object_type, user, None, target_acls[user])
+        elif source_acls[user] != target_acls[user]:
+            yield Difference('access', relative, object_type, user, source_acls[user], target_acls[user])
+
+
+def format_difference(difference, is_group=None):
+    """
+    A function to show a difference as a line of text
+    is_group is called with a user name to prefix groups with 'g:'
+    """
+    prefix = 'C - ' if difference.object_type == 'collection' else ''
+    path = f'{prefix}{difference.relative_path}'
+    if difference.kind == 'missing':
+        return f'Only in source: {path}'
+    if difference.kind == 'extra':
+        return f'Only in target: {path}'
+    if difference.kind == 'inheritance':
+        return f'{path}: inheritance source={difference.source} target={difference.target}'
+    user_name, user_zone = difference.user
+    group = 'g:' if is_group is not None and is_group(user_name) else ''
+    return f'{path}: {group}{user_name}#{user_zone} source={difference.source or "-"} ' \
+           f'target={difference.target or "-"}'
+
+
+def difference_to_json(difference):
+    """A function to show a difference as a json object"""
+    user_name, user_zone = difference.user if difference.user else (None, None)
+    return json.dumps({'kind': difference.kind, 'path': difference.relative_path,
+                       'object_type': difference.object_type, 'user_name': user_name,
+                       'user_zone': user_zone, 'source': difference.source,
+                       'target': difference.target})
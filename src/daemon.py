@@ -0,0 +1,492 @@
+import os
+import sys
+import json
+import time
+import runpy
+import struct
+import signal
+import socket
+import threading
+import traceback
+import socketserver
+from .util import GetiRODSSession, get_irods_env_file, set_session_factory, drop_object_cache
+from .metrics import uninstrument_session
+
+
+DEFAULT_SOCKET = os.environ.get('IACL_SOCKET') or os.path.expanduser('~/.irods/iacl.sock')
+COMMANDS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'commands')
+CONNECT_TIMEOUT = 1.0
+BUSY_WAIT = 2.0
+START_TIMEOUT = float(os.environ.get('IACL_DAEMON_TIMEOUT') or 10.0)
+FRAME_SIZE = 65536
+FLUSH_INTERVAL = 0.5
+
+_serving = False
+
+
+class WarmSessions(object):
+    """
+    This class keeps the authenticated sessions of the daemon open between
+    the commands it runs. It is the factory new_session() uses inside the
+    daemon: cleaning up a lent session gives it back instead of closing
+    its connections, with its metrics and object cache dropped. The
+    user/group cache of a session stays, it refreshes itself.
+    ...
+    Attributes
+    ----------
+    size : int
+        the number of idle sessions kept, more are closed when given back.
+    max_idle : float
+        seconds after which an idle session is closed instead of lent again,
+        before the server or a firewall drops its connections.
+    session_factory : callable
+        a function returning a new authenticated session, GetiRODSSession by default.
+    """
+
+    def __init__(self, size=8, max_idle=600, session_factory=None):
+        """A constructor method"""
+        self.size = size
+        self.max_idle = max_idle
+        self.session_factory = session_factory or GetiRODSSession
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        """A method to lend an idle session, or a new one"""
+        stale = []
+        session = None
+        with self._lock:
+            while self._idle:
+                candidate, released = self._idle.pop()
+                if time.monotonic() - released < self.max_idle:
+                    session = candidate
+                    self.reused += 1
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            self._close(candidate)
+        if session is not None:
+            return session
+        session = self.session_factory()
+        session.cleanup = lambda *args, **kwargs: self._release(session, *args, **kwargs)
+        with self._lock:
+            self.created += 1
+        return session
+
+    def _release(self, session, new_host=''):
+        """A private method taking back a session a command cleaned up"""
+        if new_host:
+            self._close(session)
+            return
+        uninstrument_session(session)
+        drop_object_cache(session)
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((session, time.monotonic()))
+                return
+        self._close(session)
+
+    def _close(self, session):
+        """A private method to really close the connections of a session"""
+        session.__dict__.pop('cleanup', None)
+        session.cleanup()
+
+    def warm_up(self):
+        """A method to open and authenticate one session before the first command"""
+        with self() as session:
+            getattr(session, 'server_version', None)
+
+    def close(self):
+        """A method to close all idle sessions"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, _ in idle:
+            self._close(session)
+
+    def stats(self):
+        """A method returning the session counters as a dict"""
+        return {'idle': len(self._idle), 'created': self.created, 'reused': self.reused}
+
+
+class IaclDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    This class serves the iacl commands over a local Unix socket, so they
+    run on warm sessions instead of connecting and authenticating anew.
+    A command is run in the daemon as it would run in a terminal: with
+    the arguments and working directory of the client, its output sent
+    back while it runs. Commands are run one after the other: a client
+    arriving while another command runs waits at most busy_wait seconds,
+    then it is told the daemon is busy and runs the command itself.
+    ...
+    Attributes
+    ----------
+    socket_path : str
+        the Unix socket, only accessible by the user running the daemon.
+    sessions : WarmSessions
+        the sessions lent to the commands.
+    busy_wait : float
+        seconds a command waits for the running one before it is refused.
+    commands : int
+        the number of commands run.
+    busy : int
+        the number of commands refused because another one was running.
+
+    Examples:
+
+        daemon = IaclDaemon()
+        daemon.serve()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, sessions=8, max_idle=600, session_factory=None,
+                 busy_wait=BUSY_WAIT):
+        """A constructor method"""
+        self.socket_path = socket_path
+        self.sessions = WarmSessions(sessions, max_idle, session_factory)
+        self.busy_wait = busy_wait
+        self.env_file = get_irods_env_file()
+        self.started = time.time()
+        self.commands = 0
+        self.busy = 0
+        self._run_lock = threading.Lock()
+        if os.path.exists(socket_path):
+            if request_daemon('status', socket_path) is not None:
+                raise RuntimeError(f'An iacl daemon is already running on {socket_path}')
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        """A method to serve commands until stop is requested or the process is terminated"""
+        global _serving
+        self.sessions.warm_up()
+        set_session_factory(self.sessions)
+        _serving = True
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=self.shutdown).start())
+        try:
+            self.serve_forever()
+        finally:
+            _serving = False
+            set_session_factory(None)
+            self.server_close()
+            self.sessions.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    def allows(self, connection):
+        """A method to accept only clients of the user running the daemon"""
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        return uid == os.getuid()
+
+    def status(self):
+        """A method returning what the daemon holds and has done as a dict"""
+        return {'pid': os.getpid(), 'socket': self.socket_path, 'env_file': self.env_file,
+                'uptime': round(time.time() - self.started, 1), 'commands': self.commands,
+                'busy': self.busy, 'running': self._run_lock.locked(), 'sessions': self.sessions.stats()}
+
+    def refusal(self, request):
+        """A method returning why a command has to run in the client, or None"""
+        command = os.path.basename(str(request.get('command', '')))
+        if not command.startswith('iacl-') or command == 'iacl-daemon' or \
+                not os.path.isfile(os.path.join(COMMANDS_DIR, command)):
+            return f'{command} is not served by the daemon'
+        if not os.path.isdir(str(request.get('cwd', ''))):
+            return 'the working directory is not accessible by the daemon'
+        if request.get('env_file') != self.env_file:
+            return f'the daemon uses the iRODS environment {self.env_file}'
+        return None
+
+    def run(self, request, reply):
+        """
+        A method to run a command with the arguments, working directory
+        and output of a client, once the running command ended. The client
+        is told when the command starts.
+        Returns
+        -------
+        exit_code : int, or None when another command still runs after busy_wait seconds
+        """
+
+        script = os.path.join(COMMANDS_DIR, os.path.basename(request['command']))
+        if not self._run_lock.acquire(timeout=self.busy_wait):
+            self.busy += 1
+            return None
+        try:
+            reply.send(b'r', b'')
+            self.commands += 1
+            saved = sys.argv, sys.stdin, sys.stdout, sys.stderr, os.getcwd()
+            stdin = open(os.devnull)
+            try:
+                os.chdir(request['cwd'])
+                sys.argv = [script] + list(request.get('args', []))
+                sys.stdin, sys.stdout, sys.stderr = stdin, reply.stdout, reply.stderr
+                try:
+                    runpy.run_path(script, run_name='__main__')
+                    exit_code = 0
+                except SystemExit as exc:
+                    exit_code = _exit_code(exc.code)
+                except Exception:
+                    exit_code = 1
+                    self.sessions.close()
+                    try:
+                        traceback.print_exc()
+                    except OSError:
+                        pass
+            finally:
+                stdin.close()
+                sys.argv, sys.stdin, sys.stdout, sys.stderr, cwd = saved
+                os.chdir(cwd)
+        finally:
+            self._run_lock.release()
+        return exit_code
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """A private class answering one request of a client"""
+
+    def handle(self):
+        if not self.server.allows(self.request):
+            return
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        reply = _Reply(self.wfile)
+        action = request.get('action')
+        try:
+            if action == 'status':
+                reply.send(b'o', json.dumps(self.server.status()).encode())
+            elif action == 'stop':
+                reply.send(b'o', json.dumps(self.server.status()).encode())
+                threading.Thread(target=self.server.shutdown).start()
+            elif action == 'run':
+                reason = self.server.refusal(request)
+                if reason is not None:
+                    reply.send(b'f', reason.encode())
+                    return
+                exit_code = self.server.run(request, reply)
+                if exit_code is None:
+                    reply.send(b'f', b'the daemon is busy running another command')
+                    return
+                reply.send(b'x', str(exit_code).encode())
+        except OSError:
+            pass
+
+
+class _Reply(object):
+    """
+    A private class sending the output of a command to the client in
+    frames of one tag byte (r: started, o: stdout, e: stderr, x: exit code,
+    f: run it yourself), a 4 byte length and the payload.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.stdout = _ReplyStream(self, b'o')
+        self.stderr = _ReplyStream(self, b'e')
+        self._tag = None
+        self._pending = []
+        self._size = 0
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, tag, data):
+        with self._lock:
+            if tag != self._tag:
+                self._flush()
+                self._tag = tag
+            self._pending.append(bytes(data))
+            self._size += len(data)
+            if self._size >= FRAME_SIZE or tag == b'e' or \
+                    time.monotonic() - self._flushed > FLUSH_INTERVAL:
+                self._flush()
+        return len(data)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def send(self, tag, payload):
+        with self._lock:
+            self._flush()
+            _write_frame(self.wfile, tag, payload)
+            self.wfile.flush()
+
+    def _flush(self):
+        if self._pending:
+            _write_frame(self.wfile, self._tag, b''.join(self._pending))
+            self.wfile.flush()
+            self._pending = []
+            self._size = 0
+        self._flushed = time.monotonic()
+
+
+class _ReplyStream(object):
+    """A private class standing in for sys.stdout and sys.stderr while the daemon runs a command"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, reply, tag):
+        self.buffer = _ReplyBuffer(reply, tag)
+
+    def write(self, text):
+        self.buffer.write(text.encode(self.encoding))
+        return len(text)
+
+    def flush(self):
+        self.buffer.flush()
+
+    def isatty(self):
+        return False
+
+    def writable(self):
+        return True
+
+
+class _ReplyBuffer(object):
+    """A private class standing in for sys.stdout.buffer while the daemon runs a command"""
+
+    def __init__(self, reply, tag):
+        self.reply = reply
+        self.tag = tag
+
+    def write(self, data):
+        return self.reply.write(self.tag, data)
+
+    def flush(self):
+        self.reply.flush()
+
+    def writable(self):
+        return True
+
+
+def _write_frame(wfile, tag, payload):
+    wfile.write(tag + struct.pack('>I', len(payload)) + payload)
+
+
+def _read_frame(rfile):
+    """A private function returning (tag, payload) of the next frame, or (None, None) at the end"""
+    header = rfile.read(5)
+    if len(header) < 5:
+        return None, None
+    size, = struct.unpack('>I', header[1:])
+    payload = rfile.read(size)
+    if len(payload) < size:
+        return None, None
+    return header[:1], payload
+
+
+def _exit_code(code):
+    """A private function to turn the code of a SystemExit into an exit code"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def _connect(socket_path):
+    """A private function returning a socket connected to the daemon, or None"""
+    if not os.path.exists(socket_path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(CONNECT_TIMEOUT)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        connection.close()
+        return None
+    connection.settimeout(None)
+    return connection
+
+
+def request_daemon(action, socket_path=DEFAULT_SOCKET):
+    """
+    A function to ask the daemon for its status or to stop it.
+    Parameters
+    ----------
+    action : str
+        'status' or 'stop'
+    socket_path : str
+        the Unix socket of the daemon
+    Returns
+    -------
+    status : dict, or None when no daemon is running
+    """
+
+    connection = _connect(socket_path)
+    if connection is None:
+        return None
+    with connection:
+        try:
+            connection.sendall(json.dumps({'action': action}).encode() + b'\n')
+            tag, payload = _read_frame(connection.makefile('rb'))
+        except OSError:
+            return None
+    if tag != b'o':
+        return None
+    return json.loads(payload)
+
+
+def run_in_daemon(command_file, reads_stdin=False, socket_path=None):
+    """
+    A function to run a command in the iacl daemon, when one is running.
+    It returns when the command has to run in this process: no daemon
+    is running, IACL_NO_DAEMON is set, the command reads stdin, the
+    daemon uses another iRODS environment, it is busy with another command
+    or it does not start the command within START_TIMEOUT seconds
+    (IACL_DAEMON_TIMEOUT). Otherwise the output of the
+    command in the daemon is written to stdout and stderr and the
+    process exits with its exit code.
+    Parameters
+    ----------
+    command_file : str
+        __file__ of the command
+    reads_stdin : bool
+        whether the command reads its input from stdin
+    socket_path : str
+        the Unix socket of the daemon, DEFAULT_SOCKET by default
+    """
+
+    if _serving or reads_stdin or os.environ.get('IACL_NO_DAEMON'):
+        return
+    args = sys.argv[1:]
+    connection = _connect(socket_path or DEFAULT_SOCKET)
+    if connection is None:
+        return
+    request = {'action': 'run', 'command': os.path.basename(command_file), 'args': args,
+               'cwd': os.getcwd(), 'env_file': get_irods_env_file()}
+    with connection:
+        connection.settimeout(START_TIMEOUT)
+        try:
+            connection.sendall(json.dumps(request).encode() + b'\n')
+            rfile = connection.makefile('rb')
+            tag, payload = _read_frame(rfile)
+        except OSError:
+            return
+        if tag != b'r':
+            return
+        connection.settimeout(None)
+        tag, payload = _read_frame(rfile)
+        while tag is not None:
+            if tag == b'x':
+                sys.stdout.flush()
+                sys.exit(int(payload))
+            stream = sys.stdout if tag == b'o' else sys.stderr
+            stream.flush()
+            stream.buffer.write(payload)
+            stream.buffer.flush()
+            tag, payload = _read_frame(rfile)
+    print('The iacl daemon closed the connection before the command ended.', file=sys.stderr)
+    sys.exit(2)
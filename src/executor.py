@@ -0,0 +1,317 @@
+import time
+import threading
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor
+from irods.exception import NetworkException
+from .util import new_session
+from .metrics import get_metrics, instrument_session
+
+
+# errors of the connection, not of the request, are worth a retry
+RETRYABLE_ERRORS = (NetworkException, OSError)
+
+
+class SessionPool(object):
+    """
+    This class keeps a bounded number of iRODS sessions so that every
+    worker thread sends its requests on its own connection.
+    Sessions are created lazily with the session factory and are
+    cleaned up when the pool is closed.
+    ...
+    Attributes
+    ----------
+    size : int
+        the maximum number of sessions.
+    session_factory : callable
+        a function returning a new authenticated session, new_session by default.
+
+    Examples:
+
+        with SessionPool(4) as pool:
+            session = pool.acquire()
+            pool.release(session)
+    """
+
+    def __init__(self, size, session_factory=None):
+        """A constructor method"""
+        self.size = size
+        self.session_factory = session_factory or new_session
+        self._idle = Queue()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def acquire(self, block=True):
+        """
+        A method to take a session from the pool, creating one when allowed
+        Without block, None is returned when all sessions are in use.
+        """
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            if len(self._sessions) < self.size:
+                session = self.session_factory()
+                self._sessions.append(session)
+                return session
+        if not block:
+            return None
+        return self._idle.get()
+
+    def release(self, session):
+        """A method to give a session back to the pool"""
+        self._idle.put(session)
+
+    def close(self):
+        """A method to clean up all sessions the pool has created"""
+        with self._lock:
+            for session in self._sessions:
+                session.cleanup()
+            self._sessions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ExecutionSummary(object):
+    """
+    This class collects the outcome of every item an executor
+    has applied instead of printing errors as they happen.
+    ...
+    Attributes
+    ----------
+    succeeded : int
+        the number of items applied successfully.
+    failures : list
+        (item, error) tuples of the items that failed.
+    planned : int
+        the number of items only recorded in a plan.
+    """
+
+    def __init__(self):
+        """A constructor method"""
+        self.succeeded = 0
+        self.failures = []
+        self.planned = 0
+        self._lock = threading.Lock()
+
+    @property
+    def failed(self):
+        return len(self.failures)
+
+    def add_success(self):
+        with self._lock:
+            self.succeeded += 1
+
+    def add_failure(self, item, err):
+        with self._lock:
+            self.failures.append((item, err))
+
+    def add_planned(self):
+        with self._lock:
+            self.planned += 1
+
+    def report(self):
+        """A method to print a summary of successes and failures"""
+        if self.planned and not self.succeeded and not self.failures:
+            print(f'Planned: {self.planned} ACL changes.')
+            return
+        print(f'Done: {self.succeeded} succeeded, {self.failed} failed.')
+        for item, err in self.failures:
+            print(f'     {describe_item(item)}: {describe_error(err)}')
+
+
+class AclExecutor(object):
+    """
+    This class applies ACL mutations either one by one on a single
+    session or on a bounded thread pool where each worker uses its
+    own session from a SessionPool. At most jobs * backlog items are
+    in flight, so huge iterables are consumed as fast as the workers
+    go and never loaded into memory at once.
+    ...
+    Attributes
+    ----------
+    session : object
+        a connection object used when jobs is 1.
+    jobs : int
+        the number of worker threads.
+    session_factory : callable
+        a function returning a new authenticated session for the workers.
+    backlog : int
+        the number of queued items per worker.
+    retries : int
+        how often an item failing with a network error is tried again.
+    backoff : float
+        seconds to wait before the first retry, doubled for every next one.
+    on_success : callable
+        called with (item, func) after every applied item, e.g. to
+        invalidate what is cached about its path.
+    session_pool : SessionPool
+        the pool the worker sessions are taken from. When none is given,
+        the executor creates its own, kept open until close().
+
+    Examples:
+
+        executor = AclExecutor(session, jobs=8)
+        summary = executor.run(acls, lambda session, acl: session.permissions.set(acl, admin=True))
+        summary.report()
+        executor.close()
+    """
+
+    def __init__(self, session, jobs=1, session_factory=None, backlog=4, retries=3, backoff=1.0,
+                 on_success=None, session_pool=None):
+        """A constructor method"""
+        self.session = session
+        self.on_success = on_success
+        self.jobs = max(int(jobs or 1), 1)
+        self.session_factory = session_factory
+        self.backlog = backlog
+        self.retries = max(int(retries or 0), 0)
+        self.backoff = backoff
+        self.session_pool = session_pool
+        self._owns_pool = False
+
+    def _pool(self):
+        """A private method returning the pool of worker sessions, created on first use"""
+        if self.session_pool is None:
+            self.session_pool = SessionPool(self.jobs, self._worker_session_factory())
+            self._owns_pool = True
+        return self.session_pool
+
+    def close(self):
+        """A method to clean up the worker sessions when the executor created their pool"""
+        if self._owns_pool:
+            self.session_pool.close()
+            self.session_pool = None
+            self._owns_pool = False
+
+    def run(self, items, func, summary=None):
+        """
+        A method to call func(session, item) for every item
+        Parameters
+        ----------
+        items : iterable
+            the items to apply, e.g. iRODSAccess objects
+        func : callable
+            a function taking a session and an item
+        summary : ExecutionSummary
+            an existing summary to add the outcome to
+        Returns
+        -------
+        summary : ExecutionSummary
+        """
+
+        summary = summary if summary is not None else ExecutionSummary()
+        sessions = self._reserve() if self.jobs > 1 else []
+        if not sessions:
+            for item in items:
+                self._apply(self.session, item, func, summary)
+            return summary
+
+        slots = threading.BoundedSemaphore(len(sessions) * self.backlog)
+        local = threading.local()
+        free = Queue()
+        for session in sessions:
+            free.put(session)
+
+        def work(item):
+            if not hasattr(local, 'session'):
+                local.session = free.get_nowait()
+            try:
+                self._apply(local.session, item, func, summary)
+            finally:
+                slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+                for item in items:
+                    slots.acquire()
+                    executor.submit(work, item)
+        finally:
+            for session in sessions:
+                self.session_pool.release(session)
+        return summary
+
+    def _reserve(self):
+        """
+        A private method to take the worker sessions of one run from the pool
+        Only the sessions not in use, e.g. by the streams of a tree read
+        at the same time, are taken, so a run never waits for a stream
+        it consumes itself; with none free the items are applied one by
+        one on the main session.
+        """
+        pool = self._pool()
+        sessions = []
+        while len(sessions) < self.jobs:
+            session = pool.acquire(block=False)
+            if session is None:
+                break
+            sessions.append(session)
+        return sessions
+
+    def _worker_session_factory(self):
+        """A private method returning the factory of worker sessions"""
+        return worker_session_factory(self.session, self.session_factory)
+
+    def _apply(self, session, item, func, summary):
+        """
+        A private method to apply one item and record its outcome
+        Network errors are retried with exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                func(session, item)
+            except RETRYABLE_ERRORS as err:
+                if attempt == self.retries:
+                    summary.add_failure(item, err)
+                    break
+                time.sleep(self.backoff * 2 ** attempt)
+            except Exception as err:
+                summary.add_failure(item, err)
+                break
+            else:
+                summary.add_success()
+                if self.on_success is not None:
+                    self.on_success(item, func)
+                break
+        metrics = get_metrics(session)
+        if metrics is not None:
+            metrics.increment('acl_changes')
+
+
+def worker_session_factory(session, session_factory=None):
+    """
+    A function returning the factory of the extra sessions of a command
+    They share the metrics of the main session, if any.
+    """
+    factory = session_factory or new_session
+    metrics = get_metrics(session)
+    if metrics is None:
+        return factory
+    return lambda: _instrumented(factory(), metrics)
+
+
+def _instrumented(session, metrics):
+    """A function to instrument a new worker session with shared metrics"""
+    instrument_session(session, metrics)
+    return session
+
+
+def describe_item(item):
+    """A function to show an ACL item in a summary"""
+    if hasattr(item, 'access_name'):
+        return f'{item.path} {item.user_name}:{item.access_name}'
+    if hasattr(item, 'access') and hasattr(item, 'user'):
+        return f'{item.path} {item.user}:{item.access}'
+    return str(item)
+
+
+def describe_error(err):
+    """A function to show an iRODS error in a summary"""
+    code = getattr(err, 'code', None)
+    if code is not None:
+        return f'{type(err).__name__} ({code})'
+    return f'{type(err).__name__}: {err}'
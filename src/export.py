@@ -0,0 +1,257 @@
+import io
+import sys
+import csv
+import json
+import gzip
+from datetime import datetime
+from .snapshot import AclEntry
+
+
+FORMATS = ('csv', 'json', 'ndjson')
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+CSV_HEADER = ['iRODS PATH', 'USER NAME', 'ACL']
+
+
+def export_filename(local_path, format, compression=None, name='irods_permissions'):
+    """
+    A function to build the timestamped name of an export file.
+    Returns '-' when the export is written to stdout.
+    """
+    if local_path == '-':
+        return local_path
+    suffix = COMPRESSIONS[compression]
+    return f"{local_path}/{'{0}_{1}.{2}{3}'.format(name, datetime.today().strftime('%Y%m%d_%H%M'), format, suffix)}"
+
+
+def open_output(filename, compression=None):
+    """
+    A function to open a text stream for an export.
+    Parameters
+    ----------
+    filename : str
+        a local file path, or '-' for stdout
+    compression : str
+        None, 'gzip' or 'zstd'
+    Returns
+    -------
+    A writable text file object
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression: {compression}. Choose either gzip or zstd')
+    if filename == '-':
+        if compression is None:
+            return _StdoutWrapper(sys.stdout)
+        raw = _StdoutWrapper(sys.stdout.buffer)
+    else:
+        if compression is None:
+            return open(filename, 'w', newline='')
+        raw = open(filename, 'wb')
+    if compression == 'gzip':
+        binary = gzip.GzipFile(fileobj=raw, mode='wb')
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raw.close()
+            raise ImportError('zstd compression needs the python module zstandard')
+        binary = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return _ClosingTextWrapper(binary, raw)
+
+
+class _StdoutWrapper(object):
+    """A private class to hand out stdout without closing it"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _ClosingTextWrapper(io.TextIOWrapper):
+    """A private class to close the compressor and the underlying file together"""
+
+    def __init__(self, binary, raw):
+        io.TextIOWrapper.__init__(self, binary, encoding='utf-8', newline='')
+        self._raw = raw
+
+    def close(self):
+        if not self.closed:
+            io.TextIOWrapper.close(self)
+            self._raw.close()
+
+
+def write_csv(acl_entries, f):
+    """
+    A function to stream ACL entries into a csv file row by row.
+    The header is written once per file.
+    """
+    writer = csv.writer(f)
+    writer.writerow(CSV_HEADER)
+    for item in acl_entries:
+        writer.writerow((item.path, item.user_name, item.access_name))
+
+
+def write_ndjson(acl_entries, f):
+    """A function to stream ACL entries into a newline delimited json file"""
+    for item in acl_entries:
+        f.write(json.dumps({'path': item.path, 'user_name': item.user_name,
+                            'user_zone': item.user_zone, 'access_name': item.access_name,
+                            'object_type': item.object_type}))
+        f.write('\n')
+
+
+def write_json(acls_by_object, f):
+    """
+    A function to stream ACLs into one json object of the shape
+    {path: {user: access}}. Every path is written on its own line as
+    soon as its ACLs are read, so the whole tree is never kept in memory.
+    """
+    f.write('{')
+    separator = '\n'
+    for path, acls in acls_by_object:
+        f.write(f'{separator}{json.dumps(path)}: ')
+        f.write(json.dumps({item.user_name: item.access_name for item in acls}))
+        separator = ',\n'
+    f.write('\n}\n')
+
+
+def export_format(filename):
+    """A function to find the format of an export from its file name, or None"""
+    for suffix in COMPRESSIONS.values():
+        if suffix and filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    for format in FORMATS:
+        if filename.endswith(f'.{format}'):
+            return format
+    if filename.endswith('.jsonl'):
+        return 'ndjson'
+    return None
+
+
+def open_input(filename):
+    """
+    A function to open an export or another local file for reading,
+    '-' for stdin. gzip and zstd files are found by their suffix.
+    """
+    if filename == '-':
+        return open(sys.stdin.fileno(), newline='', closefd=False)
+    if filename.endswith(COMPRESSIONS['gzip']):
+        return gzip.open(filename, 'rt', encoding='utf-8', newline='')
+    if filename.endswith(COMPRESSIONS['zstd']):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression needs the python module zstandard')
+        raw = open(filename, 'rb')
+        return _ClosingTextWrapper(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), raw)
+    return open(filename, newline='')
+
+
+def read_export(filename, format=None):
+    """
+    A generator function:
+    It streams the ACL entries back from a file written by export_acls.
+    csv exports have no zones and json exports no zones or object types,
+    these fields are None then.
+    Parameters
+    ----------
+    filename : str
+        a local file path, or '-' for stdin
+    format : str
+        csv, json or ndjson, found from the file name when None
+    Returns
+    -------
+    A generator object for AclEntry tuples
+    """
+
+    format = format or export_format(filename)
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format of {filename}. Choose either csv, json or ndjson')
+    with open_input(filename) as f:
+        if format == 'csv':
+            rows = csv.reader(f)
+            if next(rows, None) != CSV_HEADER:
+                raise ValueError(f'{filename} is not a csv export of iacl-save')
+            for path, user_name, access_name in rows:
+                yield AclEntry(path, user_name, None, access_name, None, None)
+        elif format == 'ndjson':
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield AclEntry(item['path'], item['user_name'], item.get('user_zone'),
+                                   item['access_name'], None, item.get('object_type'))
+        else:
+            for path, acls in _read_json_objects(f):
+                for user_name, access_name in acls.items():
+                    yield AclEntry(path, user_name, None, access_name, None, None)
+
+
+def _read_json_objects(f):
+    """
+    A private generator function reading a json export path by path.
+    write_json puts every path on its own line; a file that was written
+    or reformatted otherwise is parsed at once.
+    """
+    head = []
+    parsed = False
+    for line in f:
+        stripped = line.strip().rstrip(',')
+        if stripped in ('{', '}', ''):
+            head.append(line)
+            continue
+        try:
+            item = json.loads('{' + stripped + '}')
+        except ValueError:
+            if parsed:
+                raise
+            head.append(line)
+            break
+        parsed = True
+        for path, acls in item.items():
+            yield path, acls
+    else:
+        return
+    for path, acls in json.loads(''.join(head) + f.read()).items():
+        yield path, acls
+
+
+def export_acls(snapshot, coll_path, filename, format, compression=None):
+    """
+    A function to stream all ACLs of a collection tree into a file.
+    Parameters
+    ----------
+    snapshot : object
+        an AclSnapshot object
+    coll_path : str
+        an absolute iRODS collection path
+    filename : str
+        a local file path, or '-' for stdout
+    format : str
+        csv, json or ndjson
+    compression : str
+        None, 'gzip' or 'zstd'
+    """
+
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format: {format}')
+    with open_output(filename, compression) as f:
+        if format == 'csv':
+            write_csv(snapshot.acls(coll_path), f)
+        elif format == 'ndjson':
+            write_ndjson(snapshot.acls(coll_path), f)
+        else:
+            write_json(snapshot.acls_by_object(coll_path), f)
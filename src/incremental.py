@@ -0,0 +1,307 @@
+import os
+import csv
+import json
+import gzip
+import time
+from itertools import groupby
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
+from .snapshot import AclEntry, in_subtree, data_object_key
+from .export import open_output, write_ndjson
+from .compare import spill_sorted, sort_in_runs, merge_runs
+from .util import iter_specific_query
+from irods.models import Collection, DataObject, User, DataAccess, CollectionAccess
+
+
+CHANGED_DATA_OBJECT_ACLS_SQL = "select distinct c.coll_name, d.data_name, u.user_name, u.zone_name, \
+                t.token_name from R_OBJT_ACCESS a join R_DATA_MAIN d on d.data_id = a.object_id \
+                join R_COLL_MAIN c on c.coll_id = d.coll_id join R_USER_MAIN u on u.user_id = a.user_id \
+                join R_TOKN_MAIN t on t.token_id = a.access_type_id and t.token_namespace = 'access_type' \
+                where a.modify_ts > ? and (c.coll_name = ? or c.coll_name like ?)"
+CHANGED_COLLECTION_ACLS_SQL = "select distinct c.coll_name, u.user_name, u.zone_name, t.token_name \
+                from R_OBJT_ACCESS a join R_COLL_MAIN c on c.coll_id = a.object_id \
+                join R_USER_MAIN u on u.user_id = a.user_id \
+                join R_TOKN_MAIN t on t.token_id = a.access_type_id and t.token_namespace = 'access_type' \
+                where a.modify_ts > ? and (c.coll_name = ? or c.coll_name like ?)"
+CHANGES_CSV_HEADER = ['CHANGE', 'iRODS PATH', 'USER NAME', 'ACL', 'PREVIOUS ACL']
+
+# Clocks of the client and the catalog may differ. Rows changed in
+# this margin before a baseline are read again and drop out in the diff.
+CLOCK_MARGIN = 300
+
+
+def iter_changed_acls(session, coll_path, since):
+    """
+    A generator function:
+    It streams the ACL entries of a tree whose catalog rows
+    (R_OBJT_ACCESS.modify_ts) changed after the given time.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    coll_path : str
+        an absolute iRODS collection path
+    since : int
+        seconds since the epoch
+    Returns
+    -------
+    A generator object for AclEntry tuples
+    """
+
+    coll_path = coll_path.rstrip('/') or '/'
+    args = [f'{int(since):011d}', coll_path, f'{coll_path.rstrip("/")}/%']
+    for result in iter_specific_query(session, CHANGED_COLLECTION_ACLS_SQL, 'list_changed_collection_acls',
+                                      [Collection.name, User.name, User.zone, CollectionAccess.name],
+                                      args=args):
+        if in_subtree(result[Collection.name], coll_path):
+            yield AclEntry(result[Collection.name], result[User.name], result[User.zone],
+                           result[CollectionAccess.name], None, 'collection')
+    for result in iter_specific_query(session, CHANGED_DATA_OBJECT_ACLS_SQL, 'list_changed_data_object_acls',
+                                      [Collection.name, DataObject.name, User.name, User.zone,
+                                       DataAccess.name],
+                                      args=args):
+        if in_subtree(result[Collection.name], coll_path):
+            yield AclEntry(f'{result[Collection.name]}/{result[DataObject.name]}', result[User.name],
+                           result[User.zone], result[DataAccess.name], None, 'data_obj')
+
+
+@contextmanager
+def open_state_file(state_file):
+    """
+    A function to write a state file atomically: it is written into
+    state_file.tmp, which replaces the state file only when it was
+    written completely, so a failed run keeps the last good baseline.
+    """
+    tmp_filename = f'{state_file}.tmp'
+    try:
+        with open_output(tmp_filename, 'gzip') as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    os.replace(tmp_filename, state_file)
+
+
+def write_baseline(entries, coll_path, state_file, snapshot_time):
+    """
+    A function to write the state file of an incremental snapshot:
+    a gzip compressed ndjson file whose first line holds the collection
+    and the time of the snapshot, followed by one line per ACL entry,
+    the entries of one object after the other sorted by _object_key.
+    """
+    with open_state_file(state_file) as f:
+        f.write(json.dumps({'collection': coll_path, 'time': int(snapshot_time)}))
+        f.write('\n')
+        write_ndjson(entries, f)
+
+
+class BaselineRecorder(object):
+    """
+    This class wraps an AclSnapshot so that every ACL entry an export
+    reads through it is also written to the state file of an incremental
+    snapshot. A full export and its baseline then cost a single scan.
+    The entries come in the collation order of the catalog; they are
+    sorted in runs on disk while the export reads them and written to
+    the state file in the order of the incremental merges at the end.
+    ...
+    Attributes
+    ----------
+    snapshot : object
+        an AclSnapshot object.
+    state_file : str
+        a local file path of the state file.
+
+    Examples:
+
+        recorder = BaselineRecorder(AclSnapshot(session), '/tmp/project.state')
+        export_acls(recorder, coll_path, filename, 'ndjson')
+    """
+
+    def __init__(self, snapshot, state_file):
+        """A constructor method"""
+        self.snapshot = snapshot
+        self.state_file = state_file
+
+    def acls(self, coll_path):
+        """A method to get ACL entries of all objects in a tree while recording them"""
+        snapshot_time = time.time()
+        runs = []
+        for _, _, entries in sort_in_runs(_object_groups(self.snapshot.acls(coll_path)), itemgetter(0), runs):
+            for entry in entries:
+                yield entry
+        write_baseline((entry for _, _, entries in merge_runs(runs, itemgetter(0), tuple) for entry in entries),
+                       coll_path, self.state_file, snapshot_time)
+
+    def acls_by_object(self, coll_path):
+        """A method to get ACL entries grouped per object while recording them"""
+        for path, entries in groupby(self.acls(coll_path), key=attrgetter('path')):
+            yield path, list(entries)
+
+
+@contextmanager
+def read_baseline(state_file):
+    """
+    A function to read the state file of an incremental snapshot.
+    Yields (coll_path, snapshot_time, entries), entries streams its
+    AclEntry tuples in the order they were written.
+    """
+    with gzip.open(state_file, 'rt') as f:
+        meta = json.loads(f.readline())
+        yield meta['collection'], meta['time'], (_baseline_entry(line) for line in f)
+
+
+def _baseline_entry(line):
+    item = json.loads(line)
+    return AclEntry(item['path'], item['user_name'], item['user_zone'], item['access_name'],
+                    None, item['object_type'])
+
+
+def save_acl_changes(session, snapshot, coll_path, state_file, filename, format='ndjson',
+                     compression=None, detect_removals=False):
+    """
+    A function to write only the ACL entries that were added, removed or
+    changed since the baseline in the state file, and to roll the state
+    file forward to the current state.
+    Added and changed entries come from the catalog rows modified after
+    the baseline, so unchanged parts of the tree are not read again; they
+    are merged into the state file while it is streamed, so only the
+    changes are held in memory. Revoking an ACL deletes its catalog row
+    and leaves no timestamp, so with detect_removals the whole tree is
+    read instead, sorted in runs on disk like the state file and merged
+    with it object by object. The catalog sorts with its own collation, so
+    both sides of a merge are sorted here with the same key, _object_key.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    snapshot : object
+        an AclSnapshot object
+    coll_path : str
+        an absolute iRODS collection path
+    state_file : str
+        the state file written by an earlier baseline or incremental run
+    filename : str
+        a local file path, or '-' for stdout
+    format : str
+        ndjson or csv
+    compression : str
+        None, 'gzip' or 'zstd'
+    detect_removals : bool
+        whether the whole tree is read to find removed ACLs too
+    Returns
+    -------
+    counts : dict
+        the number of added, changed and removed entries
+    Raises
+    ------
+    ValueError
+        when the state file belongs to another tree or is not sorted
+    """
+
+    snapshot_time = time.time()
+    counts = {'added': 0, 'changed': 0, 'removed': 0}
+    with read_baseline(state_file) as (baseline_path, since, baseline):
+        if baseline_path.rstrip('/') != coll_path.rstrip('/'):
+            raise ValueError(f'The baseline was recorded for {baseline_path}, not for {coll_path}')
+        baseline_objects = _sorted_checked(_object_groups(baseline), state_file)
+        if detect_removals:
+            runs = spill_sorted(_object_groups(snapshot.acls(coll_path)), itemgetter(0))
+            objects = _merge_objects(baseline_objects, merge_runs(runs, itemgetter(0), tuple))
+        else:
+            changes = {}
+            for entry in iter_changed_acls(session, coll_path, since - CLOCK_MARGIN):
+                changes.setdefault((_object_key(entry), entry.path), []).append(entry)
+            changed_objects = ((key, path, entries) for (key, path), entries in sorted(changes.items()))
+            objects = ((path, before, {**before, **changed})
+                       for path, before, changed in _merge_objects(baseline_objects, changed_objects))
+        with open_output(filename, compression) as f:
+            emit = _change_writer(f, format)
+
+            def current_entries():
+                for path, before, after in objects:
+                    for user_name, entry in after.items():
+                        previous = before.get(user_name)
+                        if previous is None:
+                            emit('added', entry, None)
+                            counts['added'] += 1
+                        elif previous.access_name != entry.access_name:
+                            emit('changed', entry, previous.access_name)
+                            counts['changed'] += 1
+                        yield entry
+                    for user_name, previous in before.items():
+                        if user_name not in after:
+                            emit('removed', previous, None)
+                            counts['removed'] += 1
+
+            write_baseline(current_entries(), coll_path, state_file, snapshot_time)
+    return counts
+
+
+def _object_key(entry):
+    """A private function to sort the objects of a state file: collections first, data objects on collection and name"""
+    if entry.object_type == 'collection':
+        return (0, entry.path)
+    return (1,) + data_object_key(entry.path)
+
+
+def _object_groups(entries):
+    """
+    A private function grouping the ACL entries of one object after
+    the other into (key, path, [AclEntry]) tuples
+    """
+    for path, group in groupby(entries, key=attrgetter('path')):
+        group = list(group)
+        yield _object_key(group[0]), path, group
+
+
+def _sorted_checked(objects, state_file):
+    """A private function passing object groups on, checking they are sorted by key"""
+    previous = None
+    for item in objects:
+        if previous is not None and item[0] <= previous:
+            raise ValueError(f'The state file {state_file} is not sorted by object. '
+                             'Record a new baseline with --baseline.')
+        previous = item[0]
+        yield item
+
+
+def _merge_objects(left, right):
+    """
+    A private generator function merging two streams of object groups
+    sorted by key into (path, {user: left AclEntry}, {user: right AclEntry}),
+    {} for a missing side
+    """
+    left_item, right_item = next(left, None), next(right, None)
+    while left_item is not None or right_item is not None:
+        if right_item is None or (left_item is not None and left_item[0] < right_item[0]):
+            yield left_item[1], _users(left_item[2]), {}
+            left_item = next(left, None)
+        elif left_item is None or right_item[0] < left_item[0]:
+            yield right_item[1], {}, _users(right_item[2])
+            right_item = next(right, None)
+        else:
+            yield left_item[1], _users(left_item[2]), _users(right_item[2])
+            left_item, right_item = next(left, None), next(right, None)
+
+
+def _users(entries):
+    return {entry.user_name: entry for entry in entries}
+
+
+def _change_writer(f, format):
+    """A private function returning a function that writes one change"""
+    if format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(CHANGES_CSV_HEADER)
+        return lambda change, entry, previous: writer.writerow(
+            (change, entry.path, entry.user_name, entry.access_name, previous or ''))
+    if format != 'ndjson':
+        raise ValueError(f'Changes can be written as ndjson or csv, not as {format}')
+
+    def emit(change, entry, previous):
+        f.write(json.dumps({'change': change, 'path': entry.path, 'user_name': entry.user_name,
+                            'user_zone': entry.user_zone, 'access_name': entry.access_name,
+                            'previous_access_name': previous, 'object_type': entry.object_type}))
+        f.write('\n')
+    return emit
@@ -0,0 +1,439 @@
+import os
+import sys
+import time
+import sqlite3
+import posixpath
+from contextlib import contextmanager
+from irods.column import Criterion
+from irods.models import Collection, User, UserGroup
+from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
+from .snapshot import AclSnapshot, AclEntry, in_subtree, _inheritance
+from .incremental import iter_changed_acls, CLOCK_MARGIN
+from .util import new_session, chunked
+
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.irods', 'iacl_index.sqlite')
+
+# Paths are compared as bytes (BINARY collation), so all paths below
+# '/a/b' sort between '/a/b/' and '/a/b0' and a path prefix is a range
+# scan of the primary keys.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    object_type TEXT NOT NULL,
+    inheritance INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS objects_parent ON objects (parent);
+CREATE TABLE IF NOT EXISTS acls (
+    path TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    user_zone TEXT NOT NULL,
+    access_name TEXT NOT NULL,
+    object_type TEXT NOT NULL,
+    PRIMARY KEY (path, user_name, user_zone)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS acls_user ON acls (user_name, path);
+CREATE TABLE IF NOT EXISTS groups (name TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS memberships (
+    user_name TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    PRIMARY KEY (user_name, group_name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS memberships_group ON memberships (group_name);
+CREATE TABLE IF NOT EXISTS trees (path TEXT PRIMARY KEY, zone TEXT, refreshed INTEGER);
+"""
+
+
+def _subtree(coll_path, column='path'):
+    """
+    A function to build the SQL condition of a collection tree:
+    the collection itself and the range of paths below it
+    """
+    coll_path = coll_path.rstrip('/')
+    return f'({column} = ? OR ({column} > ? AND {column} < ?))', [coll_path or '/', f'{coll_path}/', f'{coll_path}0']
+
+
+class AclIndex(object):
+    """
+    This class keeps the paths, inheritance and ACLs of collection trees
+    in a local SQLite file, so that listing, checking, comparing, saving
+    and who-has-access lookups can be answered without the catalog.
+    The index is built with the same bulk queries as AclSnapshot and
+    refreshed with the ACL rows changed since the last refresh.
+    ...
+    Attributes
+    ----------
+    filename : str
+        a local file path of the index.
+    readonly : bool
+        whether the index is only read, e.g. by the --offline commands.
+    Methods
+    -------
+    build(session, coll_path):
+        Reads a tree from the catalog and replaces it in the index.
+    refresh(session, coll_path, detect_removals=False):
+        Writes the ACLs changed since the last refresh into the index.
+    snapshot(recursive=True):
+        Returns an IndexSnapshot that reads trees like an AclSnapshot.
+    grants(user_names, coll_path=None):
+        Yields the AclEntry tuples of some users.
+    user_groups(user_name), group_members(group_name):
+        Return the group memberships of the last refresh.
+    orphans():
+        Yields (object_type, path) of the indexed objects without ACL.
+
+    Examples:
+
+        with AclIndex('/tmp/acl.sqlite') as index:
+            index.build(session, '/tempZone/home')
+        with AclIndex('/tmp/acl.sqlite', readonly=True) as index:
+            PermissionManager(None, index=index).search_orphaned_objects('/tempZone/home', recursive=True)
+    """
+
+    def __init__(self, filename=DEFAULT_INDEX, readonly=False):
+        """A constructor method"""
+        self.filename = filename
+        self.readonly = readonly
+        if readonly:
+            if not os.path.exists(filename):
+                raise FileNotFoundError(f'There is no ACL index at {filename}, build it with iacl-index first.')
+            self.connection = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+        else:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(filename)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.executescript(SCHEMA)
+        self._groups = None
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def build(self, session, coll_path, session_pool=None, batch_size=10000):
+        """
+        A method to read a whole tree from the catalog and replace it in the index
+        Returns the number of objects and ACL entries written.
+        """
+        coll_path = coll_path.rstrip('/') or '/'
+        snapshot_time = time.time()
+        snapshot = AclSnapshot(session, session_pool=session_pool)
+        counts = {'objects': 0, 'acls': 0}
+        with self.connection:
+            for table in ('objects', 'acls', 'trees'):
+                condition, args = _subtree(coll_path)
+                self.connection.execute(f'DELETE FROM {table} WHERE {condition}', args)
+            for batch in chunked(snapshot.objects_with_acls(coll_path), batch_size):
+                self.connection.executemany(
+                    'INSERT INTO objects VALUES (?, ?, ?, ?)',
+                    ((path, posixpath.dirname(path), object_type, inheritance)
+                     for path, object_type, inheritance, acls in batch))
+                entries = [(item.path, item.user_name, item.user_zone, item.access_name, object_type)
+                           for path, object_type, inheritance, acls in batch for item in acls]
+                self.connection.executemany('INSERT OR REPLACE INTO acls VALUES (?, ?, ?, ?, ?)', entries)
+                counts['objects'] += len(batch)
+                counts['acls'] += len(entries)
+            self._load_groups(session)
+            self.connection.execute('INSERT OR REPLACE INTO trees VALUES (?, ?, ?)',
+                                    (coll_path, session.zone, int(snapshot_time)))
+        return counts
+
+    def refresh(self, session, coll_path, detect_removals=False, session_pool=None, batch_size=10000):
+        """
+        A method to bring an indexed tree up to date
+        ACL entries and collections modified in the catalog since the last
+        refresh are written into the index; the rest of the tree is not read.
+        Revoking an ACL or removing an object deletes its catalog rows and
+        leaves no timestamp, so with detect_removals the tree is built again.
+        """
+        coll_path = coll_path.rstrip('/') or '/'
+        tree = self.tree_of(coll_path)
+        if tree is None:
+            raise ValueError(f'{coll_path} is not in the index, build it first.')
+        if detect_removals:
+            return self.build(session, coll_path, session_pool=session_pool, batch_size=batch_size)
+        since = tree[1] - CLOCK_MARGIN
+        snapshot_time = time.time()
+        counts = {'acls': 0, 'collections': 0}
+        with self.connection:
+            for batch in chunked(iter_changed_acls(session, coll_path, since), batch_size):
+                self.connection.executemany(
+                    'INSERT OR IGNORE INTO objects VALUES (?, ?, ?, NULL)',
+                    ((item.path, posixpath.dirname(item.path), item.object_type) for item in batch))
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO acls VALUES (?, ?, ?, ?, ?)',
+                    ((item.path, item.user_name, item.user_zone, item.access_name, item.object_type)
+                     for item in batch))
+                counts['acls'] += len(batch)
+            # creating a collection or changing its inheritance updates its modify time
+            for batch in chunked(_changed_collections(session, coll_path, since), batch_size):
+                self.connection.executemany(
+                    'INSERT INTO objects VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (path) DO UPDATE SET inheritance = excluded.inheritance',
+                    ((path, posixpath.dirname(path), 'collection', inheritance) for path, inheritance in batch))
+                counts['collections'] += len(batch)
+            self._load_groups(session)
+            self.connection.execute('INSERT OR REPLACE INTO trees VALUES (?, ?, ?)',
+                                    (coll_path, session.zone, int(snapshot_time)))
+        return counts
+
+    def _load_groups(self, session):
+        """A private method to replace the names and members of the iRODS groups"""
+        self.connection.execute('DELETE FROM groups')
+        result = session.query(User.name).filter(Criterion('=', User.type, 'rodsgroup'))
+        self.connection.executemany('INSERT OR IGNORE INTO groups VALUES (?)',
+                                    ((item[User.name],) for item in result))
+        self.connection.execute('DELETE FROM memberships')
+        result = session.query(User.name, UserGroup.name)
+        self.connection.executemany('INSERT OR IGNORE INTO memberships VALUES (?, ?)',
+                                    ((item[User.name], item[UserGroup.name]) for item in result
+                                     if item[User.name] != item[UserGroup.name]))
+        self._groups = None
+
+    def trees(self):
+        """A method returning (path, zone, refreshed) of all indexed trees"""
+        return self.connection.execute('SELECT path, zone, refreshed FROM trees ORDER BY path').fetchall()
+
+    def tree_of(self, path):
+        """A method returning (path, refreshed) of the deepest indexed tree holding a path, or None"""
+        for tree_path, zone, refreshed in reversed(self.trees()):
+            if in_subtree(path, tree_path):
+                return tree_path, refreshed
+        return None
+
+    @property
+    def zone(self):
+        """The zone of the indexed trees"""
+        row = self.connection.execute('SELECT zone FROM trees LIMIT 1').fetchone()
+        return row[0] if row else None
+
+    def is_group(self, name):
+        """A method returning True when the given user name was a group at the last refresh"""
+        if self._groups is None:
+            self._groups = frozenset(name for name, in self.connection.execute('SELECT name FROM groups'))
+        return name in self._groups
+
+    def user_groups(self, user_name):
+        """A method returning the sorted groups a user was member of at the last refresh"""
+        rows = self.connection.execute('SELECT group_name FROM memberships WHERE user_name = ? '
+                                       'ORDER BY group_name', (user_name,))
+        return [name for name, in rows]
+
+    def group_members(self, group_name):
+        """A method returning the sorted members of a group at the last refresh"""
+        rows = self.connection.execute('SELECT user_name FROM memberships WHERE group_name = ? '
+                                       'ORDER BY user_name', (group_name,))
+        return [name for name, in rows]
+
+    def object_type(self, path):
+        """A method returning 'collection', 'data_obj' or None for a path"""
+        row = self.connection.execute('SELECT object_type FROM objects WHERE path = ?',
+                                      (path.rstrip('/') or '/',)).fetchone()
+        return row[0] if row else None
+
+    def get_collection(self, path):
+        """A method returning the normalized path of an indexed collection"""
+        path = path.rstrip('/') or '/'
+        if self.object_type(path) != 'collection':
+            raise CollectionDoesNotExist(path)
+        return path
+
+    def get_data_object(self, path):
+        """A method returning the path of an indexed data object"""
+        if self.object_type(path) != 'data_obj':
+            raise DataObjectDoesNotExist(path)
+        return path
+
+    def acls_of(self, path):
+        """A method returning the AclEntry tuples of one object"""
+        rows = self.connection.execute(
+            'SELECT a.path, a.user_name, a.user_zone, a.access_name, o.inheritance, a.object_type '
+            'FROM acls a JOIN objects o ON o.path = a.path WHERE a.path = ? ORDER BY a.user_name',
+            (path.rstrip('/') or '/',))
+        return [_entry(row) for row in rows]
+
+    def collection_acl(self, path):
+        """A method returning (inheritance, [AclEntry]) of a collection, or (None, None)"""
+        row = self.connection.execute('SELECT inheritance FROM objects WHERE path = ? AND object_type = ?',
+                                      (path.rstrip('/') or '/', 'collection')).fetchone()
+        if row is None:
+            return None, None
+        return bool(row[0]), self.acls_of(path)
+
+    def data_object_acl(self, path):
+        """A method returning the [AclEntry] of a data object, or None"""
+        if self.object_type(path) != 'data_obj':
+            return None
+        return self.acls_of(path)
+
+    def grants(self, user_names, coll_path=None):
+        """
+        A generator method:
+        It yields the AclEntry tuples of the given users, in a tree when
+        a collection is given, with one lookup on the user index per user.
+        Collections come first and data objects follow them by collection.
+        """
+        for user_name in user_names:
+            sql = 'SELECT a.path, a.user_name, a.user_zone, a.access_name, o.inheritance, a.object_type ' \
+                  'FROM acls a JOIN objects o ON o.path = a.path WHERE a.user_name = ?'
+            args = [user_name]
+            if coll_path is not None:
+                condition, subtree_args = _subtree(coll_path, 'a.path')
+                sql += f' AND {condition}'
+                args += subtree_args
+            order = " ORDER BY a.object_type, CASE WHEN a.object_type = 'collection' THEN a.path " \
+                    "ELSE o.parent END, a.path"
+            for row in self.connection.execute(sql + order, args):
+                yield _entry(row)
+
+    def orphans(self):
+        """A generator method yielding (object_type, path) of all indexed objects without any ACL"""
+        rows = self.connection.execute(
+            'SELECT object_type, path FROM objects o WHERE NOT EXISTS '
+            '(SELECT 1 FROM acls a WHERE a.path = o.path) ORDER BY object_type DESC, parent, path')
+        for object_type, path in rows:
+            yield object_type, path
+
+    def snapshot(self, recursive=True):
+        """A method returning an IndexSnapshot reading the trees of this index"""
+        return IndexSnapshot(self, recursive=recursive)
+
+
+class IndexSnapshot(AclSnapshot):
+    """
+    This class reads collection trees from an AclIndex instead of the
+    catalog. It yields the same streams as AclSnapshot, so everything
+    built on an AclSnapshot works offline unchanged. SQLite sorts the
+    paths by code point, which is the order of a catalog with the C
+    collation only; compare and incremental sort both of their sides
+    with one key and never rely on the two orders being the same.
+    ...
+    Attributes
+    ----------
+    index : AclIndex
+        the local index to read.
+    recursive : bool
+        whether a tree is the whole subtree or only the collection
+        itself and its data objects.
+    """
+
+    def __init__(self, index, recursive=True):
+        """A constructor method"""
+        super().__init__(None, recursive=recursive)
+        self.index = index
+
+    def _stage(self, stream, coll_path):
+        return stream(self.index.connection, coll_path)
+
+    def _where(self, coll_path, object_type):
+        """A private method to build the SQL condition of the objects of a tree"""
+        coll_path = coll_path.rstrip('/') or '/'
+        if self.recursive:
+            return _subtree(coll_path, 'o.path')
+        if object_type == 'collection':
+            return 'o.path = ?', [coll_path]
+        return 'o.parent = ?', [coll_path]
+
+    def _order(self, object_type):
+        """
+        A private method returning the SQL order of the objects of a tree:
+        data objects by collection and then by name, as attach_acls needs
+        the objects and their ACL entries in one order
+        """
+        return 'o.path' if object_type == 'collection' else 'o.parent, o.path'
+
+    def _objects(self, object_type):
+        def stream(connection, coll_path):
+            condition, args = self._where(coll_path, object_type)
+            rows = connection.execute(f'SELECT o.path, o.inheritance FROM objects o '
+                                      f'WHERE o.object_type = ? AND {condition} ORDER BY {self._order(object_type)}',
+                                      [object_type] + args)
+            for path, inheritance in rows:
+                yield path, bool(inheritance) if object_type == 'collection' else None
+        return stream
+
+    def _entries(self, object_type):
+        def stream(connection, coll_path):
+            condition, args = self._where(coll_path, object_type)
+            rows = connection.execute(
+                f'SELECT a.path, a.user_name, a.user_zone, a.access_name, o.inheritance, a.object_type '
+                f'FROM acls a JOIN objects o ON o.path = a.path '
+                f'WHERE a.object_type = ? AND {condition} ORDER BY {self._order(object_type)}, a.user_name',
+                [object_type] + args)
+            for row in rows:
+                yield _entry(row)
+        return stream
+
+    def collections(self, coll_path):
+        return self._stage(self._objects('collection'), coll_path)
+
+    def data_objects(self, coll_path):
+        return self._stage(self._objects('data_obj'), coll_path)
+
+    def collection_acls(self, coll_path):
+        return self._stage(self._entries('collection'), coll_path)
+
+    def data_object_acls(self, coll_path):
+        return self._stage(self._entries('data_obj'), coll_path)
+
+    def users(self, coll_path):
+        return set((item.user_name, item.user_zone) for item in self.acls(coll_path))
+
+
+def _entry(row):
+    """A function to turn a row of the acls table into an AclEntry"""
+    path, user_name, user_zone, access_name, inheritance, object_type = row
+    if object_type == 'collection':
+        return AclEntry(path, user_name, user_zone, access_name, bool(inheritance), object_type)
+    return AclEntry(path, user_name, user_zone, access_name, None, object_type)
+
+
+def _changed_collections(session, coll_path, since):
+    """
+    A generator function:
+    It yields (path, inheritance) of the collections of a tree
+    whose catalog row was modified after the given time.
+    """
+    coll_path = coll_path.rstrip('/') or '/'
+    query = session.query(Collection.name, Collection.inheritance)\
+                   .filter(Criterion('>', Collection.modify_time, f'{int(since):011d}'))
+    for criterion in (Criterion('=', Collection.name, coll_path),
+                      Criterion('like', Collection.name, f'{coll_path.rstrip("/")}/%')):
+        for result in query.filter(criterion):
+            if in_subtree(result[Collection.name], coll_path):
+                yield result[Collection.name], _inheritance(result[Collection.inheritance])
+
+
+def add_offline_arguments(arg_parser):
+    """A function to add the --offline and --index options to a reading command"""
+    arg_parser.add_argument('--offline', action='store_true',
+                            help='Reads the ACLs from the local index written by iacl-index \
+                                  instead of the iRODS catalog.')
+    arg_parser.add_argument('--index', default=DEFAULT_INDEX,
+                            help=f'The local index file, {DEFAULT_INDEX} by default.')
+
+
+@contextmanager
+def open_session_or_index(args):
+    """
+    A function to open what a reading command works on:
+    yields (None, AclIndex) with --offline, else (session, None)
+    """
+    if getattr(args, 'offline', False):
+        try:
+            index = AclIndex(args.index, readonly=True)
+        except FileNotFoundError as err:
+            print(err)
+            sys.exit(2)
+        with index:
+            yield None, index
+    else:
+        with new_session() as session:
+            yield session, None
@@ -1,7 +1,23 @@
+import json
+import time
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from irods.access import iRODSAccess
-from irods.exception import CollectionDoesNotExist, DataObjectDoesNotExist
-from .util import query_data_obj, check_user_group, get_objects_with_no_acl, \
-                  write_acl_csv, write_acl_json, get_objects_with_no_acl_for_entire_zone
+from irods.exception import CollectionDoesNotExist
+from .util import check_user_group, get_objects_with_no_acl, \
+                  iter_objects_with_no_acl_for_entire_zone, iter_orphaned_objects_with_owner, \
+                  chunked, get_user_groups, get_group_members, iter_acls_of_user, get_object_cache
+from .snapshot import AclSnapshot, in_subtree, TREE_STREAMS
+from .export import FORMATS, export_acls, export_filename, read_export
+from .incremental import BaselineRecorder, save_acl_changes
+from .compare import spill_object_acls, merge_runs, diff_object_acls, format_difference, difference_to_json
+from .audit import audit_inheritance, format_drift, drift_to_json
+from .manifest import ManifestRow, read_manifest, coalesce_rows, ordered_batches
+from .plan import ACTIONS, PlanAction, load_desired, common_path, plan_restore, map_tree, to_access
+from .policy import load_policy, PolicyMatcher, diff_policy, format_action
+from .checkpoint import resume_after
+from .executor import AclExecutor, ExecutionSummary, SessionPool, describe_error, \
+                      worker_session_factory
 
 
 class PermissionManager(object):
@@ -18,6 +34,21 @@ class PermissionManager(object):
         an iRODS path of which permissions(ACLs) will be copied or deleted.
     target_path : str
         an iRODS path to which permissions(ACLs) copied will be pasted.
+    jobs : int
+        the number of worker threads (each with its own session) sending ACL changes,
+        and of the sessions reading the query streams of a tree at the same time.
+    session_factory : callable
+        a function returning a new session for the worker threads, new_session by default.
+    plan : ChangePlan
+        when given, ACL changes are recorded into it instead of being sent (dry run).
+    retries : int
+        how often an ACL change failing with a network error is tried again.
+    index : AclIndex
+        when given, trees and ACLs are read from this local index instead
+        of the catalog and session can be None (offline).
+    name_range : tuple
+        when given, trees are only read within these (lower, upper) bounds
+        of collection names, one shard of a ShardedScan.
     Methods
     -------
     __get_collection_acl():
@@ -37,148 +68,466 @@ class PermissionManager(object):
         acl.remove_acl()
         acl = PermissionManager(session, source_path=source_path, target_path=target_path)
         acl.copy_acl()
+        acl = PermissionManager(session, target_path=path, jobs=8)
+        acl.set_acl('group_A', 'read', recursive=True)
     """
 
-    def __init__(self, session, source_path=None, target_path=None):
+    def __init__(self, session, source_path=None, target_path=None, jobs=1, session_factory=None,
+                 plan=None, retries=3, index=None, name_range=None):
         """A constructor method"""
         self.session = session
+        self.index = index
         self.target_path = target_path
         self.source_path = source_path
-        if source_path is None:
-            pass
-        else:
-            if session.collections.exists(source_path):
-                self.source_path = source_path
-            elif session.data_objects.exists(source_path):
-                self.source_path = source_path
+        self.session_pool = None
+        if (jobs or 1) > 1 and index is None:
+            # the streams of a tree read hold pooled sessions while the workers apply what they read
+            self.session_pool = SessionPool(jobs + TREE_STREAMS, worker_session_factory(session, session_factory))
+        self.snapshot = AclSnapshot(session, session_pool=self.session_pool, name_range=name_range)
+        if index is not None:
+            self.snapshot = index.snapshot()
+        self.cache = get_object_cache(session) if session is not None else None
+        self.executor = AclExecutor(session, jobs=jobs if index is None else 1, session_factory=session_factory,
+                                    retries=retries, on_success=self._forget, session_pool=self.session_pool)
+        self.plan = plan
+        if plan is not None:
+            self.executor = _PlanningExecutor(plan)
     
+    def close(self):
+        """A method to clean up the pooled sessions, shared by the reads and the ACL changes"""
+        if self.session_pool is not None:
+            self.session_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def __get_collection_acl(self):
         """A private method to get existing ACLs on a given collection"""
 
-        try:
-            coll = self.session.collections.get(self.source_path)
-            inheritance = coll.inheritance
-            permissions = self.session.permissions.get(coll, report_raw_acls=True)
-        except CollectionDoesNotExist:
-            permissions = None
-            inheritance = None
-        return inheritance, permissions
+        if self.index is not None:
+            return self.index.collection_acl(self.source_path)
+        object_type, coll = self.cache.lookup(self.source_path)
+        if object_type != 'collection':
+            return None, None
+        return coll.inheritance, self.cache.permissions(self.source_path, raw=True)
         
     def __get_data_object_acl(self):
         """A private method to get existing ACLs on a given data object"""
-        try:
-            obj = self.session.data_objects.get(self.source_path)
-            permissions = self.session.permissions.get(obj)
-        except DataObjectDoesNotExist:
-            permissions = None
-        return permissions
+        if self.index is not None:
+            return self.index.data_object_acl(self.source_path)
+        if self.cache.lookup(self.source_path)[0] != 'data_obj':
+            return None
+        return self.cache.permissions(self.source_path)
     
+    def _get_collection_path(self, path):
+        """
+        A private method returning the path of an existing collection,
+        looked up in the index when the manager works offline
+        """
+        if self.index is not None:
+            return self.index.get_collection(path)
+        return self.cache.collection(path).path
+
+    def _is_group(self, user_name):
+        """A private method to know whether a user name is a group"""
+        if self.index is not None:
+            return self.index.is_group(user_name)
+        return check_user_group(self.session, user_name)
+
+    def _forget(self, item, func):
+        """
+        A private method to drop what the cache holds about
+        the path of an ACL change once it was applied
+        """
+        recursive = func is _set_permission_recursively or getattr(item, 'recursive', False)
+        self.cache.invalidate(item.path, recursive=recursive)
+
+    def _set_acls(self, acls, summary=None):
+        """
+        A private method to send iRODSAccess objects to iRODS,
+        in parallel when the manager was created with jobs > 1
+        """
+        return self.executor.run(acls, _set_permission, summary=summary)
+
     def copy_acl(self):
         """A method to copy existing ACLs from one iRODS path to another"""
-        acls_source_collections = self.__get_collection_acl()[1]
-        acls_source_data_objects = self.__get_data_object_acl()
-        if acls_source_collections != None:
-            for item in acls_source_collections:
-                try:
-                    acl_target_collections = iRODSAccess(item.access_name, self.target_path, item.user_name)                    
-                    self.session.permissions.set(acl_target_collections, admin=True)
-                except Exception as err:
-                    print(err.code)
+        acls_source_collections = self.__get_collection_acl()[1] or []
+        acls_source_data_objects = self.__get_data_object_acl() or []
+        acls = (iRODSAccess(item.access_name, self.target_path, item.user_name) \
+                for item in acls_source_collections + acls_source_data_objects)
+        summary = self._set_acls(acls)
+        if summary.failed > 0:
+            summary.report()
+        return summary
 
-        if acls_source_data_objects != None:
-            for item in acls_source_data_objects:
-                try:
-                    acl_target_data_objects = iRODSAccess(item.access_name, self.target_path, item.user_name)                    
-                    self.session.permissions.set(acl_target_data_objects, admin=True)
-                except Exception as err:
-                    print(err.code)
+    def copy_acl_recursively(self, prune=False):
+        """
+        A method to copy the ACLs of a collection tree onto the same
+        relative paths of another tree
+        Both trees are read in bulk once. Only missing grants and different
+        access levels are sent, in parallel when jobs > 1. With prune, grants
+        of the target that the source object does not have are removed too.
+        Objects that exist in only one of the trees are skipped.
+        """
+        try:
+            source = self.cache.collection(self.source_path)
+            target = self.cache.collection(self.target_path)
+        except CollectionDoesNotExist:
+            print('Recursive copy can only be applied between existing collections!')
+            return None
+        desired = load_desired(map_tree(self.snapshot.acls(source.path), source.path, target.path))
+        target_paths = None
+        counts = dict.fromkeys(('grant', 'change', 'revoke', 'skipped'), 0)
+
+        def existing(actions):
+            nonlocal target_paths
+            for action in actions:
+                if action.object_type is None:
+                    # the object has no ACL on the target, or does not exist there
+                    if target_paths is None:
+                        target_paths = set(path for path, _ in chain(self.snapshot.collections(target.path),
+                                                                     self.snapshot.data_objects(target.path)))
+                    if action.path not in target_paths:
+                        counts['skipped'] += 1
+                        continue
+                counts[action.action] += 1
+                yield action
+
+        actions = plan_restore(self.snapshot, desired, target.path, revoke=prune)
+        summary = self.executor.run(existing(actions), _apply_plan_action)
+        print(f"{counts['grant']} grants, {counts['change']} changes and {counts['revoke']} revocations "
+              f"needed, {counts['skipped']} grants skipped for objects missing in the target.")
+        summary.report()
+        return summary
 
     def remove_all_acl(self):
         """A method to delete existing ACLs on an iRODS path"""
-        acls_source_collections = self.__get_collection_acl()[1]
-        acls_source_data_objects = self.__get_data_object_acl()
-        if acls_source_collections != None:
-            for item in acls_source_collections:
-                try:
-                    acl_target_collections = iRODSAccess('null', self.source_path, item.user_name)                    
-                    self.session.permissions.set(acl_target_collections, admin=True)
-                except Exception as err:
-                    print(err.code)
-
-        if acls_source_data_objects != None:
-            for item in acls_source_data_objects:
-                try:
-                    acl_target_data_objects = iRODSAccess('null', self.source_path, item.user_name)
-                    self.session.permissions.set(acl_target_data_objects, admin=True)
-                except Exception as err:
-                    print(err.code)
+        acls_source_collections = self.__get_collection_acl()[1] or []
+        acls_source_data_objects = self.__get_data_object_acl() or []
+        acls = (iRODSAccess('null', self.source_path, item.user_name) \
+                for item in acls_source_collections + acls_source_data_objects)
+        summary = self._set_acls(acls)
+        if summary.failed > 0:
+            summary.report()
+        return summary
     
-    def remove_all_acl_recursively(self):
+    def remove_all_acl_recursively(self, server_side=True, checkpoint=None):
         """
         A method to delete existing ACLs on 
         an iRODS collection path recursively
+        With server_side, one recursive 'null' request is sent per user
+        holding an ACL in the tree and iRODS walks the tree itself.
+        Otherwise every ACL entry is removed one by one.
+        With a Checkpoint, the progress is journaled and a resumed
+        run continues after the last completed request.
         """
         try:
-            collection = self.session.collections.get(self.target_path)
+            collection = self.cache.collection(self.target_path)
         except CollectionDoesNotExist:
             print('Recursive can only be applied on an existing collection!')
-            pass
         else:
-            all_colls = collection.walk()
-            for item in all_colls:
-                coll_path = item[0].path
-                try:
-                    coll = self.session.collections.get(coll_path)
-                    permissions = self.session.permissions.get(coll)
-                    for item in permissions:
-                        acl_target_collection = iRODSAccess('null', coll_path, item.user_name)                    
-                        self.session.permissions.set(acl_target_collection, admin=True)
-                except Exception as err:
-                    print(err.args)
-                if len(coll_path) != 0:
-                    result = query_data_obj(self.session, coll_path)
-                    for data_path in result:
-                        try:
-                            obj = self.session.data_objects.get(data_path)
-                            permissions = self.session.permissions.get(obj)
-                        except Exception as err:
-                            print(err.args)
-                        for item in permissions:
-                            acl_target_data_objects = iRODSAccess('null', data_path, item.user_name)
-                            self.session.permissions.set(acl_target_data_objects, admin=True)
-
-    def set_acl(self, user, alc_type, recursive=False):
+            if server_side:
+                acls = lambda: (iRODSAccess('null', collection.path, user_name, user_zone) \
+                                for user_name, user_zone in sorted(self.snapshot.users(collection.path)))
+                summary = self._run_resumable(f'clear {collection.path}', acls,
+                                              _set_permission_recursively, checkpoint)
+            else:
+                acls = lambda: (iRODSAccess('null', item.path, item.user_name) \
+                                for item in self.snapshot.acls(collection.path))
+                summary = self._run_resumable(f'clear --client-side {collection.path}', acls,
+                                              _set_permission, checkpoint)
+            summary.report()
+            return summary
+
+    def set_acl(self, user, alc_type, recursive=False, server_side=True, object_filter=None,
+                checkpoint=None):
         """
         A method to set (add/modify/remove) given ACLs via cli arguments to
         a user/group for an iRODS path
+        A recursive ACL is applied by iRODS itself in a single request.
+        The tree is walked on the client side, one request per object,
+        only when server_side is False or an object_filter is given.
+        object_filter is called with (path, object_type) and the
+        ACL is set only on the objects for which it returns True.
+        With a Checkpoint, the progress of a client side walk is journaled
+        and a resumed run continues after the last completed object.
         """
+        summary = ExecutionSummary()
         if recursive:
             try:
-                collection = self.session.collections.get(self.target_path)
+                collection = self.cache.collection(self.target_path)
             except CollectionDoesNotExist:
                 print('Recursive can only be applied on an existing collection!')
-                pass
-            all_colls = collection.walk()
-            for item in all_colls:
-                coll_path = (item[0].path)
-                acl_target_collections = iRODSAccess(alc_type, coll_path, user)
-                self.session.permissions.set(acl_target_collections, admin=True)
-                if len(item[2]) != 0:
-                    for data_obj in item[2]:
-                        data_obj_name = data_obj.name
-                        data_obj_path = f'{coll_path}/{data_obj_name}'
-                        acl_target_data_objects = iRODSAccess(alc_type, data_obj_path, user)
-                        self.session.permissions.set(acl_target_data_objects, admin=True)
-        acl_target_data_path = iRODSAccess(alc_type, self.target_path, user)
-        self.session.permissions.set(acl_target_data_path, admin=True)
-    
+                return summary
+            if server_side and object_filter is None:
+                acl_target = iRODSAccess(alc_type, collection.path, user)
+                self.executor.run([acl_target], _set_permission_recursively, summary=summary)
+                summary.report()
+                return summary
+
+            def acls():
+                paths = chain(((path, 'collection') for path, _ in self.snapshot.collections(collection.path)),
+                              ((path, 'data_obj') for path, _ in self.snapshot.data_objects(collection.path)))
+                if object_filter is not None:
+                    paths = (item for item in paths if object_filter(*item))
+                return (iRODSAccess(alc_type, path, user) for path, _ in paths)
+
+            self._run_resumable(f'set {alc_type} {user} {collection.path}', acls, _set_permission,
+                                checkpoint, summary)
+        else:
+            acl_target_data_path = iRODSAccess(alc_type, self.target_path, user)
+            self._set_acls([acl_target_data_path], summary)
+        if recursive or summary.failed > 0:
+            summary.report()
+        return summary
+
+    def _run_resumable(self, operation, make_acls, func, checkpoint=None, summary=None,
+                       batch_size=1000, progress=None):
+        """
+        A private method to send a long stream of ACL requests in batches
+        After every batch the last completed request of the operation and
+        the failed requests are journaled in the checkpoint. A resumed run
+        first tries the failed requests again, then skips the operations
+        that were completed and sends the requests after the last completed
+        one. The journal can hold several operations, e.g. one per user, and
+        is closed by the caller with checkpoint.finish(). A dry run ignores
+        the checkpoint.
+        Parameters
+        ----------
+        operation : str
+            a description of the operation, e.g. 'set read group_A /zone/home'
+        make_acls : callable
+            a function returning the iRODSAccess objects in the same order on every call
+        func : callable
+            _set_permission or _set_permission_recursively
+        checkpoint : Checkpoint
+            the journal, None to run without one
+        summary : ExecutionSummary
+            an existing summary to add the outcome to
+        progress : callable
+            called with the summary after every batch
+        Returns
+        -------
+        summary : ExecutionSummary
+        """
+
+        summary = summary if summary is not None else ExecutionSummary()
+        if checkpoint is None or self.plan is not None:
+            for batch in chunked(make_acls(), batch_size):
+                self.executor.run(batch, func, summary)
+                if progress is not None:
+                    progress(summary)
+            return summary
+        completed = checkpoint.state.setdefault('completed', {})
+
+        def send(batch, func):
+            failed_before = summary.failed
+            self.executor.run(batch, func, summary)
+            for item, err in summary.failures[failed_before:]:
+                checkpoint.add_failure(_journal_access(item, func), describe_error(err))
+            checkpoint.save()
+            if progress is not None:
+                progress(summary)
+
+        retry = [_access_from_journal(item) for item, _ in checkpoint.failures]
+        checkpoint.failures = []
+        for recursive in (False, True):
+            retry_func = _set_permission_recursively if recursive else _set_permission
+            for batch in chunked((acl for acl, flag in retry if flag == recursive), batch_size):
+                send(batch, retry_func)
+        if completed.get(operation) is True:
+            return summary
+        acls = resume_after(make_acls, completed.get(operation), _journal_key)
+        for batch in chunked(acls, batch_size):
+            completed[operation] = _journal_key(batch[-1])
+            send(batch, func)
+        completed[operation] = True
+        checkpoint.save(force=True)
+        return summary
+
+    def revoke_user(self, user_name, coll_path=None, checkpoint=None, batch_size=1000):
+        """
+        A method to remove every ACL a user or group holds, in a collection
+        tree or in the whole zone
+        Only the objects where the user has an ACL are read, with one query
+        per object type, and a 'null' request is sent for each of them in
+        batches, in parallel when jobs > 1, so the cost grows with the grants
+        of the user and not with the size of the zone. The progress is shown
+        after every batch. With a Checkpoint the failed requests are journaled;
+        a resumed run tries them again and queries the grants left.
+        """
+        if coll_path is not None:
+            try:
+                coll_path = self._get_collection_path(coll_path)
+            except CollectionDoesNotExist:
+                print('Revocation can only be applied on an existing collection!')
+                return None
+        # the grants are read before any of them is revoked, a query is
+        # not paged reliably while its rows are being deleted
+        grants = [(item.path, item.user_name, item.user_zone)
+                  for item in iter_acls_of_user(self.session, user_name, coll_path)]
+        where = coll_path or f'zone {self.session.zone}'
+        if not grants:
+            print(f'{user_name} has no ACL in {where}.')
+            return ExecutionSummary()
+        operation = f'revoke {user_name} {coll_path or self.session.zone}'
+        if checkpoint is not None and checkpoint.state.get('completed', {}).get(operation) is not True:
+            # revoked grants drop out of the query, so a resumed run starts at the top
+            checkpoint.state.get('completed', {}).pop(operation, None)
+        acls = lambda: (iRODSAccess('null', path, user, zone) for path, user, zone in grants)
+
+        def progress(summary):
+            done = summary.succeeded + summary.failed + summary.planned
+            print(f'{done}/{len(grants)} revocations of {user_name} done ({100 * done // len(grants)}%), '
+                  f'{summary.failed} failed.', flush=True)
+
+        summary = self._run_resumable(operation, acls, _set_permission, checkpoint,
+                                      batch_size=batch_size, progress=progress)
+        summary.report()
+        return summary
+
+    def set_acl_from_manifest(self, filename, format=None):
+        """
+        A method to set the ACLs listed in a csv or ndjson manifest
+        All rows are read and validated before anything is changed.
+        Duplicate rows are dropped and of conflicting rows for the same
+        user, path and recursive flag the last one wins. The ACLs are sent
+        on the session of the manager, or on a pool of sessions when
+        jobs > 1, where rows overlapping earlier ones of the same user
+        wait until those are applied. The throughput is reported at the end.
+        """
+        try:
+            rows, duplicates = coalesce_rows(read_manifest(filename, format))
+        except (OSError, ValueError) as err:
+            print(f'The manifest cannot be read: {err}')
+            return None
+        start = time.monotonic()
+        summary = ExecutionSummary()
+        for batch in ordered_batches(rows):
+            self.executor.run(batch, _set_manifest_row, summary=summary)
+        elapsed = time.monotonic() - start
+        if duplicates:
+            print(f'{duplicates} duplicate or overridden rows were skipped.')
+        rate = (summary.succeeded + summary.failed) / elapsed if elapsed else 0.0
+        print(f'{len(rows)} ACLs applied in {elapsed:.1f}s ({rate:.1f} ACLs/s).')
+        summary.report()
+        return summary
+
+    def apply_acl_export(self, filename, format=None, coll_path=None, revoke_unlisted=False):
+        """
+        A method to bring the ACLs of a tree back to the state saved by save_acl
+        The export is streamed in and the current ACLs of the tree are read
+        in bulk. Only the grants, changes and revocations needed are sent,
+        in parallel when jobs > 1; objects that already match are not written.
+        Objects that have ACLs now but none in the export are left untouched
+        unless revoke_unlisted is True. With coll_path, only the ACLs of the
+        export in that tree are restored.
+        """
+        try:
+            desired = load_desired(read_export(filename, format))
+        except (OSError, ValueError, KeyError) as err:
+            print(f'The export cannot be read: {err}')
+            return None
+        if not desired:
+            print('The export does not contain any ACL.')
+            return None
+        root = coll_path or common_path(desired)
+        if self.cache.lookup(root)[0] != 'collection':
+            root = root.rsplit('/', 1)[0] or '/'
+        outside = [path for path in desired if not in_subtree(path, root)]
+        for path in outside:
+            del desired[path]
+        if outside:
+            print(f'{len(outside)} objects of the export outside {root} are skipped.')
+        stats = {}
+        counts = dict.fromkeys(('grant', 'change', 'revoke'), 0)
+
+        def counted(actions):
+            for action in actions:
+                counts[action.action] += 1
+                yield action
+
+        actions = plan_restore(self.snapshot, desired, root, revoke_unlisted=revoke_unlisted, stats=stats)
+        summary = self.executor.run(counted(actions), _apply_plan_action)
+        print(f"{counts['grant']} grants, {counts['change']} changes and {counts['revoke']} revocations "
+              f"needed, {stats.get('matching', 0)} objects already matched.")
+        summary.report()
+        return summary
+
+    def reconcile_policy(self, filename, check=False):
+        """
+        A method to bring the ACLs and inheritance of the trees a policy
+        file covers to the state it describes. The rules are compiled into
+        a PolicyMatcher, the trees below the literal prefixes of their globs
+        are read in bulk and only the changes needed are sent, in parallel
+        when jobs > 1; objects that already match are not written.
+        With check, the changes are printed instead of sent.
+        Returns the number of changes needed, None when the policy cannot be read
+        """
+        try:
+            rules = load_policy(filename, self.session.zone)
+        except (OSError, ValueError) as err:
+            print(f'The policy cannot be read: {err}')
+            return None
+        matcher = PolicyMatcher(rules)
+        stats = {'objects': 0, 'matching': 0}
+        counts = dict.fromkeys(ACTIONS, 0)
+
+        def actions():
+            for root in matcher.roots():
+                object_type = self.cache.lookup(root)[0]
+                if object_type is None:
+                    print(f'{root} does not exist, its rules are skipped.')
+                    continue
+                snapshot = self.snapshot
+                if object_type == 'data_obj':
+                    root = root.rsplit('/', 1)[0] or '/'
+                    snapshot = AclSnapshot(self.session, recursive=False, session_pool=self.session_pool)
+                for path, object_type, inheritance, acls in snapshot.objects_with_acls(root):
+                    rules = matcher.match(path)
+                    if not rules:
+                        continue
+                    stats['objects'] += 1
+                    changed = False
+                    for action in diff_policy(path, object_type, inheritance, acls, rules):
+                        changed = True
+                        counts[action.action] += 1
+                        yield action
+                    if not changed:
+                        stats['matching'] += 1
+
+        summary = None
+        if check:
+            for action in actions():
+                print(format_action(action))
+        else:
+            summary = self.executor.run(actions(), _apply_plan_action)
+        print(f"{counts['grant']} grants, {counts['change']} changes, {counts['revoke']} revocations and "
+              f"{counts['inherit']} inheritance changes needed, {stats['matching']} of {stats['objects']} "
+              f"objects already matched.")
+        if summary is not None:
+            summary.report()
+        return sum(counts.values())
+
+    def execute_plan(self, plan):
+        """
+        A method to send the ACL changes of a ChangePlan, e.g. one
+        recorded with a dry run and loaded back with ChangePlan.load
+        """
+        summary = self.executor.run(iter(plan), _apply_plan_action)
+        summary.report()
+        return summary
+
     def set_inherit(self, alc_type=None):
         """
         A method to set (add/modify/remove) given ACLs via cli arguments to
         a user/group for an iRODS path
         """
         try:
-            coll = self.session.collections.get(self.target_path)
+            coll = self.cache.collection(self.target_path)
         except CollectionDoesNotExist:
             print('<Inherit> can only be applied on a collection!')
             pass
@@ -188,10 +537,12 @@ class PermissionManager(object):
                     or alc_type == 'yes' or alc_type == 'YES':
                     acl_inherit = iRODSAccess('inherit', self.target_path)
                     self.session.permissions.set(acl_inherit,  admin=True)
+                    self.cache.invalidate(self.target_path)
                 elif alc_type == 'False' or alc_type == 'false' or alc_type == 'noinherit'\
                     or alc_type == 'no' or alc_type == 'NO':
                     acl_inherit = iRODSAccess('noinherit', self.target_path)
                     self.session.permissions.set(acl_inherit, admin=True)
+                    self.cache.invalidate(self.target_path)
                 else:
                     print("There's something wrong with the way your argument is typed!")
         
@@ -207,7 +558,7 @@ class PermissionManager(object):
                 print(f'ACL - {i.path}:')
                 break
             [print(f'     g:{i.user_name}#{i.user_zone}:{i.access_name}') \
-            if (check_user_group(self.session, i.user_name)) is True \
+            if self._is_group(i.user_name) is True \
             else print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
             for i in acls_source_collections]
         if acls_source_data_objects != None:
@@ -217,7 +568,7 @@ class PermissionManager(object):
                 print(f'ACL - {i.path}:')
                 break
             [print(f'     g:{i.user_name}#{i.user_zone}:{i.access_name}') \
-            if check_user_group(self.session, i.user_name) is True \
+            if self._is_group(i.user_name) is True \
             else print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
             for i in acls_source_data_objects]
 
@@ -228,17 +579,12 @@ class PermissionManager(object):
         Lists only for sub-collections from top to down
         """
         try:
-            collection = self.session.collections.get(self.target_path)
+            collection_path = self._get_collection_path(self.target_path)
         except CollectionDoesNotExist:
             print('Recursive can only be applied on a collection!')
             pass
         else:
-            all_colls = collection.walk()
-            for item in all_colls:
-                path = item[0].path
-                coll = self.session.collections.get(path)
-                inheritance = coll.inheritance
-                permissions = self.session.permissions.get(coll)
+            for path, inheritance, permissions in self.snapshot.collections_with_acls(collection_path):
                 print(f'Inheritance: {inheritance}')
                 if len(permissions) == 0:
                     print(f'{path} \n ACL - ')
@@ -246,111 +592,123 @@ class PermissionManager(object):
                     print(f'ACL - {i.path}:')
                     break
                 [print(f'     g:{i.user_name}#{i.user_zone}:{i.access_name}') \
-                if check_user_group(self.session, i.user_name) is True \
+                if self._is_group(i.user_name) is True \
                 else print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
                 for i in permissions]
     
-    def compare_acl_of_two_collections(self, source, target):
+    def list_access_of_users(self, user_names, coll_path=None, resolve_groups=True, format='text'):
         """
-        A method to list all given ACLs together with inherit 
-        information for two iRODS paths
-        Lists only for given collections and their first level data objects for comparision
+        A method to list every path the given users or groups have an ACL on,
+        in a collection tree or in the whole zone
+        For a user, the ACLs its groups hold are listed too unless
+        resolve_groups is False. The ACLs are streamed from one query
+        per user and object type (or from the index when offline).
+        Returns how many ACL entries were listed.
         """
-        try:
-            collection_source = self.session.collections.get(source)
-            collection_target = self.session.collections.get(target)
-        except CollectionDoesNotExist:
-            print('Comparision can only be applied for collections!')
-            pass
+        count = 0
+        for user_name in user_names:
+            names = [user_name]
+            if self._is_group(user_name):
+                members = self._group_members(user_name)
+                if format != 'json':
+                    print(f"ACLs of g:{user_name} (members: {', '.join(members) or '-'}):")
+            else:
+                groups = self._user_groups(user_name) if resolve_groups else []
+                names += groups
+                if format != 'json':
+                    print(f"ACLs of {user_name} (groups: {', '.join(groups) or '-'}):")
+            for name in names:
+                via = name if name != user_name else None
+                for item in self._acls_of_user(name, coll_path):
+                    if format == 'json':
+                        print(json.dumps({'user': user_name, 'via': via, 'path': item.path,
+                                          'object_type': item.object_type, 'user_name': item.user_name,
+                                          'user_zone': item.user_zone, 'access_name': item.access_name}))
+                    else:
+                        prefix = 'C - ' if item.object_type == 'collection' else ''
+                        suffix = f' (via g:{via})' if via is not None else ''
+                        print(f'     {prefix}{item.path}: {item.access_name}{suffix}')
+                    count += 1
+        if count == 0 and format != 'json':
+            print('No ACL was found.')
+        return count
+
+    def _acls_of_user(self, user_name, coll_path=None):
+        """A private method to stream the ACL entries of one user or group"""
+        if self.index is not None:
+            return self.index.grants([user_name], coll_path)
+        return iter_acls_of_user(self.session, user_name, coll_path)
+
+    def _user_groups(self, user_name):
+        """A private method to get the groups a user is member of"""
+        if self.index is not None:
+            return self.index.user_groups(user_name)
+        return get_user_groups(self.session, user_name)
+
+    def _group_members(self, group_name):
+        """A private method to get the members of a group"""
+        if self.index is not None:
+            return self.index.group_members(group_name)
+        return get_group_members(self.session, group_name)
+
+    def compare_acl_of_two_collections(self, source, target, format='text'):
+        """
+        A method to compare all given ACLs together with inherit
+        information of two iRODS collections
+        Compares only given collections and their first level data objects
+        Prints only the differences and returns how many there are
+        """
+        if self.index is not None:
+            snapshot = self.index.snapshot(recursive=False)
         else:
-            colls_source = collection_source.walk()
-            for item in colls_source:
-                coll_path = item[0].path
-                coll = self.session.collections.get(coll_path)
-                inheritance = coll.inheritance
-                permissions = self.session.permissions.get(coll)
-                print(f'Inheritance: {inheritance}')
-                for i in permissions:
-                    print(f'ACL - {i.path}:')
-                    break
-                [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                for i in permissions]
-                for i in item[0].data_objects:
-                    obj_path = i.path
-                    obj = self.session.data_objects.get(obj_path)
-                    permissions_data_objects = self.session.permissions.get(obj)
-                    for i in permissions_data_objects:
-                        print(f'ACL - {i.path}:')
-                        break
-                    [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                    for i in permissions_data_objects]
-                break
-        
-            print('\n-------------------------------TARGET COLLECTION------------------------------------\n')
-            
-            colls_target = collection_target.walk()
-            for item in colls_target:
-                coll_path = item[0].path
-                coll = self.session.collections.get(coll_path)
-                inheritance = coll.inheritance
-                permissions = self.session.permissions.get(coll)
-                print(f'Inheritance: {inheritance}')
-                for i in permissions:
-                    print(f'ACL - {i.path}:')
-                    break
-                [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                for i in permissions]
-                for i in item[0].data_objects:
-                    obj_path = i.path
-                    obj = self.session.data_objects.get(obj_path)
-                    permissions_data_objects = self.session.permissions.get(obj)
-                    for i in permissions_data_objects:
-                        print(f'ACL - {i.path}:')
-                        break
-                    [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                    for i in permissions_data_objects]
-                break
+            snapshot = AclSnapshot(self.session, recursive=False, session_pool=self.session_pool)
+        return self._compare_trees(source, target, snapshot, format)
 
-    def compare_acl_of_two_collections_recursively(self, source, target):
+    def compare_acl_of_two_collections_recursively(self, source, target, format='text'):
         """
-        A method to list all given ACLs together with inherit information 
-        recursively for two iRODS paths
-        Lists only for sub-collections from top to down
+        A method to compare all given ACLs together with inherit information
+        recursively for two iRODS paths, including data objects
+        Prints only the differences and returns how many there are
         """
+        return self._compare_trees(source, target, self.snapshot, format)
+
+    def _compare_trees(self, source, target, snapshot, format):
+        """A private method to diff the ACLs of two trees read in bulk"""
         try:
-            collection_source = self.session.collections.get(source)
-            collection_target = self.session.collections.get(target)
+            self._get_collection_path(source)
+            self._get_collection_path(target)
         except CollectionDoesNotExist:
-            print('Recursive can only be applied on a collection!')
-            pass
+            print('Comparision can only be applied for collections!')
+            return None
+        if self.session_pool is None:
+            source_runs = spill_object_acls(snapshot, source)
+            target_runs = spill_object_acls(snapshot, target)
         else:
-            colls_source = collection_source.walk()
-            colls_target = collection_target.walk()
-            for item in colls_source:
-                path = item[0].path
-                coll = self.session.collections.get(path)
-                inheritance = coll.inheritance
-                permissions = self.session.permissions.get(coll)
-                print(f'Inheritance: {inheritance}')
-                for i in permissions:
-                    print(f'ACL - {i.path}:')
-                    break
-                [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                for i in permissions]
-
-            print('\n-------------------------------TARGET COLLECTION------------------------------------\n')
+            def spill(coll_path):
+                # every thread reads on a session of its own when no other one is free
+                session = self.session_pool.acquire()
+                try:
+                    return spill_object_acls(snapshot.on_session(session), coll_path)
+                finally:
+                    self.session_pool.release(session)
 
-            for item in colls_target:
-                path = item[0].path
-                coll = self.session.collections.get(path)
-                inheritance = coll.inheritance
-                permissions = self.session.permissions.get(coll)
-                print(f'Inheritance: {inheritance}')
-                for i in permissions:
-                    print(f'ACL - {i.path}:')
-                    break
-                [print(f'     {i.user_name}#{i.user_zone}:{i.access_name}') \
-                for i in permissions]
+            # both trees are read at the same time
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(spill, source)
+                target_future = executor.submit(spill, target)
+                source_runs = source_future.result()
+                target_runs = target_future.result()
+        differences = diff_object_acls(merge_runs(source_runs), merge_runs(target_runs))
+        count = 0
+        for difference in differences:
+            if format == 'json':
+                print(difference_to_json(difference))
+            else:
+                print(format_difference(difference, self._is_group))
+            count += 1
+        if count == 0 and format != 'json':
+            print('The permissions of both collections are the same.')
+        return count
 
     def search_orphaned_objects(self, collection_path=None, data_obj_path=None, recursive=False):
         """
@@ -358,7 +716,7 @@ class PermissionManager(object):
         (meaning no acl exists) of a given path
         """
         if collection_path and recursive == True:
-            object_list_with_no_acl = get_objects_with_no_acl(self.session, collection_path)
+            object_list_with_no_acl = get_objects_with_no_acl(self.session, collection_path, self.snapshot)
             if len(object_list_with_no_acl['coll']) > 0 or len(object_list_with_no_acl['data_obj']) > 0:
                 print('Warning: Objects below have no granted permissions.')
                 object_list_with_no_acl_list = [i for i in object_list_with_no_acl.values()]
@@ -368,16 +726,22 @@ class PermissionManager(object):
                 print('No orphaned object is available.')
 
         elif collection_path:
-            coll_instance = self.session.collections.get(collection_path)
-            permissions_collection = self.session.permissions.get(coll_instance)
+            if self.index is not None:
+                permissions_collection = self.index.acls_of(self.index.get_collection(collection_path))
+            else:
+                self.cache.collection(collection_path)
+                permissions_collection = self.cache.permissions(collection_path)
             if len(permissions_collection) == 0:
                 print(False)
             else:
                 print('This collection has an granted permission.')
 
         elif data_obj_path:
-            obj_instance = self.session.data_objects.get(data_obj_path)
-            permissions_data_object = self.session.permissions.get(obj_instance)
+            if self.index is not None:
+                permissions_data_object = self.index.acls_of(self.index.get_data_object(data_obj_path))
+            else:
+                self.cache.data_object(data_obj_path)
+                permissions_data_object = self.cache.permissions(data_obj_path)
             if len(permissions_data_object) == 0:
                 print(False)
             else:
@@ -387,68 +751,238 @@ class PermissionManager(object):
         """
         A method to find the orphaned object 
         (meaning no acl exists) of a entire zone
+        Offline, only the trees kept in the index are searched.
         """
 
-        object_list_with_no_acl = get_objects_with_no_acl_for_entire_zone(self.session)
         if zone_name:
-            if len(object_list_with_no_acl) > 0:
-                print('Warning: Objects below have no granted permissions.')
-                for item in object_list_with_no_acl:
-                    if item[0] == 'collection':
-                        print(f'C -  {item[1]}')
-                    if item[0] == 'data_obj':
-                        print(item[1])
+            found = False
+            if self.index is not None:
+                orphans = self.index.orphans()
             else:
+                orphans = iter_objects_with_no_acl_for_entire_zone(self.session)
+            for item in orphans:
+                if not found:
+                    print('Warning: Objects below have no granted permissions.')
+                    found = True
+                if item[0] == 'collection':
+                    print(f'C -  {item[1]}')
+                if item[0] == 'data_obj':
+                    print(item[1])
+            if not found:
                 print('There is no object that doesnt have any permission in your zone.')
 
-    def restore_original_owner(self, collection_path=None, data_obj_path=None, zone_name=None):
-        """A method to set original ACL onto the orphaned object """
-        if zone_name:
-            object_list_with_no_acl = get_objects_with_no_acl_for_entire_zone(self.session)
-            if len(object_list_with_no_acl) > 0:
-                for item in object_list_with_no_acl:
-                    if item[0] == 'collection':
-                        coll_instance = self.session.collections.get(item[1])
-                        permissions_collection = self.session.permissions.get(coll_instance)
-                        user = coll_instance.owner_name
-                        acl_target_collection = iRODSAccess('own', item[1], user)
-                        self.session.permissions.set(acl_target_collection, admin=True)
-                    elif item[0] == 'data_obj':
-                        obj_instance = self.session.data_objects.get(item[1])
-                        permissions_data_object = self.session.permissions.get(obj_instance)
-                        user = obj_instance.owner_name
-                        acl_target_data_object = iRODSAccess('own', item[1], user)                    
-                        self.session.permissions.set(acl_target_data_object, admin=True)
+    def audit_inheritance(self, coll_path, ignore_extra=False, summary=False, format='text'):
+        """
+        A method to find the objects below collections with inheritance on
+        whose ACLs differ from the ones of their collection. The tree is
+        read in bulk and every object is compared with its parent by its
+        sorted grants. Only the differing objects and subtrees are
+        shown; with summary the subtrees and, per collection, the number
+        of differing data objects.
+        Returns how many objects differ, None when coll_path is not a collection
+        """
+
+        try:
+            coll_path = self._get_collection_path(coll_path)
+        except CollectionDoesNotExist:
+            print('The inheritance audit can only be applied for collections!')
+            return None
+        counts = {}
+        differing = {}
+        found = 0
+        for drift in audit_inheritance(self.snapshot, coll_path, ignore_extra=ignore_extra, counts=counts):
+            found += 1
+            if summary and drift.object_type == 'data_obj':
+                differing[drift.parent] = differing.get(drift.parent, 0) + 1
+                continue
+            if format == 'json':
+                print(drift_to_json(drift))
             else:
-                print('There is no object that has missing permission to be restored in your zone.')
+                print(format_drift(drift, self._is_group))
+        for parent in sorted(differing):
+            if format == 'json':
+                print(json.dumps({'path': parent, 'object_type': 'collection',
+                                  'differing': differing[parent], 'objects': counts[parent]}))
+            else:
+                print(f'C - {parent}: {differing[parent]} of {counts[parent]} objects differ from the collection')
+        if format != 'json':
+            print(f'{found} of {sum(counts.values())} objects below collections with inheritance on '
+                  f'differ from their parent.')
+        return found
+
+    def restore_original_owner(self, collection_path=None, data_obj_path=None, zone_name=None,
+                               checkpoint=None):
+        """
+        A method to set original ACL onto the orphaned object
+        For a zone, the orphans and their owners are read with one query
+        and the 'own' ACLs are set in batches. With a Checkpoint, the last
+        restored ids and the failed paths are journaled after every batch
+        and a resumed run continues after them instead of from the start.
+        """
+        if zone_name:
+            self._restore_original_owner_in_bulk(checkpoint)
         elif collection_path:
-            coll_instance = self.session.collections.get(collection_path)
-            permissions_collection = self.session.permissions.get(coll_instance)
+            coll_instance = self.cache.collection(collection_path)
+            permissions_collection = self.cache.permissions(collection_path)
             if len(permissions_collection) == 0:
                 user = coll_instance.owner_name
                 acl_target_collection = iRODSAccess('own', collection_path, user)
-                self.session.permissions.set(acl_target_collection, admin=True)
+                self._set_acls([acl_target_collection])
             else:
                 print('This object has already a granted permission.')
         elif data_obj_path:
-            obj_instance = self.session.data_objects.get(data_obj_path)
-            permissions_data_object = self.session.permissions.get(obj_instance)
+            obj_instance = self.cache.data_object(data_obj_path)
+            permissions_data_object = self.cache.permissions(data_obj_path)
             if len(permissions_data_object) == 0:
                 user = obj_instance.owner_name
                 acl_target_data_object = iRODSAccess('own', data_obj_path, user)                    
-                self.session.permissions.set(acl_target_data_object, admin=True)
+                self._set_acls([acl_target_data_object])
             else:
                 print('This object has already a granted permission.')
 
-    def save_acl(self, coll_path, local_path, format=None):
+    def _restore_original_owner_in_bulk(self, checkpoint=None, batch_size=1000):
+        """
+        A private method to restore the 'own' ACL of all orphans in a zone
+        A resumed run first tries the failed restores of the checkpoint
+        again, then continues after the last object id that was completed.
+        A dry run starts from the checkpoint but does not move it forward.
+        """
+        state = checkpoint.state if checkpoint is not None else {}
+        if self.plan is not None:
+            checkpoint = None
+        summary = ExecutionSummary()
+
+        def send(acls):
+            failed_before = summary.failed
+            self._set_acls(acls, summary)
+            if checkpoint is not None:
+                for item, err in summary.failures[failed_before:]:
+                    checkpoint.add_failure(_journal_access(item, _set_permission), describe_error(err))
+
+        if checkpoint is not None:
+            # journals of older runs only hold the paths, they are kept for inspection
+            retry = [item for item, _ in checkpoint.failures if isinstance(item, list)]
+            checkpoint.failures = [failure for failure in checkpoint.failures if not isinstance(failure[0], list)]
+            for batch in chunked((_access_from_journal(item)[0] for item in retry), batch_size):
+                send(batch)
+                checkpoint.save()
+        orphans = iter_orphaned_objects_with_owner(self.session,
+                                                   after_data_id=state.get('data_obj', 0),
+                                                   after_coll_id=state.get('collection', 0))
+        for batch in chunked(orphans, batch_size):
+            send(iRODSAccess('own', item.path, item.owner_name, item.owner_zone) for item in batch)
+            if checkpoint is not None:
+                for item in batch:
+                    state[item.object_type] = item.id
+                checkpoint.save()
+        if checkpoint is not None:
+            checkpoint.finish()
+        if summary.succeeded == 0 and summary.failed == 0 and summary.planned == 0:
+            print('There is no object that has missing permission to be restored in your zone.')
+        else:
+            summary.report()
+        return summary
+
+    def save_acl(self, coll_path, local_path, format=None, compression=None, baseline=None,
+                 since=None, detect_removals=False):
         """
         A method to write all given ACLs of an iRODS
         path into the specified file format
+        ACLs are streamed into the file while the results are paged in,
+        optionally compressed with gzip or zstd. A local path of '-'
+        writes to stdout.
+        With baseline, the state of the tree is also recorded in that state
+        file. With since, only the ACLs added or changed after the state
+        file was recorded are written and the state file is updated; with
+        detect_removals the whole tree is read to find removed ACLs too.
         """
-        if format == 'csv':
-            write_acl_csv(self.session, coll_path, local_path)
-        elif format == 'json':
-            write_acl_json(self.session, coll_path, local_path)
-        else:
+        if since:
+            if self.index is not None:
+                print('Changes since a state file can only be read from the catalog, not offline.')
+                return
+            if format not in ('csv', 'ndjson'):
+                print('Changes can only be written in csv or ndjson format.')
+                return
+            filename = export_filename(local_path, format, compression, name='irods_permission_changes')
+            try:
+                counts = save_acl_changes(self.session, self.snapshot, coll_path, since, filename,
+                                          format=format, compression=compression,
+                                          detect_removals=detect_removals)
+            except ValueError as err:
+                print(err)
+                return
+            if local_path != '-':
+                print(f"Added: {counts['added']}, changed: {counts['changed']}, removed: {counts['removed']}")
+            return counts
+        if format not in FORMATS:
             print('You did not provide a correct file format.\
-                   Choose either csv or json')
\ No newline at end of file
+                   Choose either csv, json or ndjson')
+            return
+        snapshot = self.snapshot if baseline is None else BaselineRecorder(self.snapshot, baseline)
+        export_acls(snapshot, coll_path, export_filename(local_path, format, compression),
+                    format, compression)
+
+
+def _set_permission(session, acl):
+    """A function to set one ACL as rodsadmin"""
+    session.permissions.set(acl, admin=True)
+
+
+def _set_permission_recursively(session, acl):
+    """A function to let iRODS set one ACL on a whole collection tree as rodsadmin"""
+    session.permissions.set(acl, recursive=True, admin=True)
+
+
+def _set_manifest_row(session, row):
+    """A function to set the ACL of one manifest row, recursively when asked for"""
+    session.permissions.set(iRODSAccess(row.access, row.path, row.user), recursive=row.recursive, admin=True)
+
+
+def _apply_plan_action(session, action):
+    """A function to send one planned ACL change as rodsadmin"""
+    session.permissions.set(to_access(action), recursive=action.recursive, admin=True)
+
+
+def _planned_action(item, func):
+    """A function to describe an item given to an executor as a PlanAction"""
+    if isinstance(item, PlanAction):
+        return item
+    if isinstance(item, ManifestRow):
+        return PlanAction('revoke' if item.access == 'null' else 'grant', item.path, None,
+                          item.user, None, item.access, None, item.recursive)
+    return PlanAction('revoke' if item.access_name == 'null' else 'grant', item.path, None,
+                      item.user_name, item.user_zone or None, item.access_name, None,
+                      func is _set_permission_recursively)
+
+
+class _PlanningExecutor(object):
+    """
+    A private class taking the place of the AclExecutor in a dry run:
+    items are recorded in a ChangePlan instead of being sent.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def run(self, items, func, summary=None):
+        summary = summary if summary is not None else ExecutionSummary()
+        for item in items:
+            self.plan.add(_planned_action(item, func))
+            summary.add_planned()
+        return summary
+
+
+def _journal_key(acl):
+    """A function to identify an ACL request in a checkpoint"""
+    return [acl.path, acl.user_name]
+
+
+def _journal_access(acl, func):
+    """A function to write a failed ACL request into a checkpoint"""
+    return [acl.access_name, acl.path, acl.user_name, acl.user_zone, func is _set_permission_recursively]
+
+
+def _access_from_journal(item):
+    """A function to read a failed ACL request back from a checkpoint"""
+    access_name, path, user_name, user_zone, recursive = item
+    return iRODSAccess(access_name, path, user_name, user_zone), recursive
@@ -0,0 +1,144 @@
+import csv
+import json
+from collections import namedtuple
+from .export import export_format, open_input
+
+
+ManifestRow = namedtuple('ManifestRow', ['access', 'user', 'path', 'recursive'])
+MANIFEST_FORMATS = ('csv', 'ndjson')
+ACCESS_TYPES = ('own', 'write', 'read', 'null', 'modify object', 'read object')
+TRUE_VALUES = ('true', 'yes', '1', 'y', 'recursive')
+FALSE_VALUES = ('false', 'no', '0', 'n', '')
+
+
+def manifest_format(filename, format=None):
+    """A function to find the format of a manifest from its name unless it is given"""
+    format = format or export_format(filename)
+    if format not in MANIFEST_FORMATS:
+        raise ValueError(f'Cannot tell the format of {filename}. Choose either csv or ndjson')
+    return format
+
+
+def read_manifest(filename, format=None):
+    """
+    A generator function:
+    It streams the rows of a manifest file of ACLs to set.
+    A csv manifest has the header access,user,path,recursive and an
+    ndjson manifest has one object with these keys per line. The
+    recursive column is optional and false by default.
+    Parameters
+    ----------
+    filename : str
+        a local file path, or '-' for stdin
+    format : str
+        csv or ndjson, found from the file name when None
+    Returns
+    -------
+    A generator object for ManifestRow tuples
+    Raises
+    ------
+    ValueError
+        when a row is incomplete or has an unknown access type
+    """
+
+    format = manifest_format(filename, format)
+    with open_input(filename) as f:
+        if format == 'csv':
+            records = csv.DictReader(f)
+            start = 2
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+            start = 1
+        for line_number, record in enumerate(records, start):
+            yield _manifest_row(record, line_number)
+
+
+def _manifest_row(record, line_number):
+    """A private function to validate one manifest record"""
+    access = str(record.get('access') or '').strip().lower()
+    user = str(record.get('user') or '').strip()
+    path = str(record.get('path') or '').strip()
+    if not access or not user or not path:
+        raise ValueError(f'Line {line_number}: access, user and path are required')
+    if access not in ACCESS_TYPES:
+        raise ValueError(f'Line {line_number}: unknown access type {access}')
+    recursive = record.get('recursive')
+    if not isinstance(recursive, bool):
+        recursive = str(recursive if recursive is not None else '').strip().lower()
+        if recursive not in TRUE_VALUES + FALSE_VALUES:
+            raise ValueError(f'Line {line_number}: recursive must be true or false')
+        recursive = recursive in TRUE_VALUES
+    return ManifestRow(access, user, path.rstrip('/') or '/', recursive)
+
+
+def coalesce_rows(rows):
+    """
+    A function to drop duplicate and conflicting manifest rows.
+    Rows for the same user, path and recursive flag conflict and the
+    last one wins, like the ACL that is set last wins in iRODS. A
+    recursive and a non-recursive row for the same path are both kept.
+    The rows are returned in the order of the winning rows.
+    Parameters
+    ----------
+    rows : iterable
+        ManifestRow tuples
+    Returns
+    -------
+    rows : list
+        the ManifestRow tuples to apply
+    duplicates : int
+        the number of rows dropped
+    """
+
+    latest = {}
+    total = 0
+    for row in rows:
+        total += 1
+        key = (row.user, row.path, row.recursive)
+        latest.pop(key, None)
+        latest[key] = row
+    return list(latest.values()), total - len(latest)
+
+
+def ordered_batches(rows):
+    """
+    A generator function:
+    It splits manifest rows into consecutive batches that can be applied
+    in parallel. Two rows of the same user overlap when they are for the
+    same path or one lies in the tree of the other, recursive, row; such
+    a row starts a new batch, so that it is applied after the rows before
+    it and the last one still wins.
+    Parameters
+    ----------
+    rows : list
+        ManifestRow tuples in the order they are applied
+    Returns
+    -------
+    A generator object for lists of ManifestRow tuples
+    """
+
+    batch = []
+    paths = {}
+    trees = {}
+    for row in rows:
+        path = row.path.rstrip('/') or '/'
+        ancestors = _ancestors(path)
+        if (row.recursive and path in paths.get(row.user, ())) or \
+                any(ancestor in trees.get(row.user, ()) for ancestor in ancestors):
+            yield batch
+            batch, paths, trees = [], {}, {}
+        batch.append(row)
+        paths.setdefault(row.user, set()).update(ancestors)
+        if row.recursive:
+            trees.setdefault(row.user, set()).add(path)
+    if batch:
+        yield batch
+
+
+def _ancestors(path):
+    """A private function to list a path and the collections above it"""
+    ancestors = [path]
+    while path != '/':
+        path = path.rsplit('/', 1)[0] or '/'
+        ancestors.append(path)
+    return ancestors
@@ -0,0 +1,277 @@
+import sys
+import json
+import time
+import random
+import threading
+from weakref import WeakKeyDictionary
+
+
+INSTRUMENTED_CALLS = {
+    'collections': ('get', 'exists'),
+    'data_objects': ('get', 'exists'),
+    'permissions': ('get', 'set'),
+}
+QUERY_BUILDERS = ('filter', 'order_by', 'limit', 'offset', 'add_keyword', 'continue_index',
+                  'count', 'min', 'max', 'sum', 'avg')
+QUERY_EXECUTORS = ('all', 'one', 'first', 'execute')
+STATS_FORMATS = ('text', 'json', 'prometheus')
+
+
+class CallStats(object):
+    """
+    This class keeps the number, total time and a bounded sample of
+    the latencies of one kind of iRODS API call.
+    """
+
+    def __init__(self, max_samples=10000):
+        """A constructor method"""
+        self.calls = 0
+        self.total = 0.0
+        self.samples = []
+        self.max_samples = max_samples
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            # reservoir sampling keeps the percentiles representative
+            index = random.randrange(self.calls)
+            if index < self.max_samples:
+                self.samples[index] = seconds
+
+    def percentile(self, fraction):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        return {'calls': self.calls, 'total': self.total,
+                'avg': self.total / self.calls if self.calls else 0.0,
+                'p95': self.percentile(0.95)}
+
+
+class Metrics(object):
+    """
+    This class counts and times the iRODS API calls of a command by
+    call type, together with free counters such as catalog rows read
+    and ACL changes applied. It is shared by all sessions of a command,
+    so recording is guarded by a lock.
+    ...
+    Attributes
+    ----------
+    calls : dict
+        CallStats per call type, e.g. 'permissions.set' or 'query'.
+    counters : dict
+        free counters, e.g. 'rows' or 'acl_changes'.
+
+    Examples:
+
+        metrics = instrument_session(session)
+        ...
+        print(metrics.to_text())
+    """
+
+    def __init__(self):
+        """A constructor method"""
+        self.calls = {}
+        self.counters = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """A method to add the latency of one call"""
+        with self._lock:
+            stats = self.calls.get(name)
+            if stats is None:
+                stats = self.calls[name] = CallStats()
+            stats.add(seconds)
+
+    def increment(self, name, value=1):
+        """A method to increase a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def summary(self):
+        """A method returning all numbers as a dict"""
+        elapsed = self.elapsed()
+        with self._lock:
+            calls = {name: stats.as_dict() for name, stats in sorted(self.calls.items())}
+            counters = dict(sorted(self.counters.items()))
+        rates = {f'{name}_per_second': value / elapsed if elapsed else 0.0
+                 for name, value in counters.items() if name in ('rows', 'acl_changes')}
+        return {'elapsed': elapsed, 'calls': calls, 'counters': counters, 'rates': rates}
+
+    def to_text(self):
+        """A method to show the numbers as a table"""
+        summary = self.summary()
+        lines = [f"{'CALL':<24}{'CALLS':>10}{'TOTAL(s)':>12}{'AVG(ms)':>10}{'P95(ms)':>10}"]
+        for name, stats in summary['calls'].items():
+            lines.append(f"{name:<24}{stats['calls']:>10}{stats['total']:>12.3f}"
+                         f"{stats['avg'] * 1000:>10.2f}{stats['p95'] * 1000:>10.2f}")
+        for name, value in summary['counters'].items():
+            lines.append(f'{name}: {value}')
+        for name, value in summary['rates'].items():
+            lines.append(f'{name}: {value:.1f}')
+        lines.append(f"elapsed: {summary['elapsed']:.3f}s")
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """A method to show the numbers as json"""
+        return json.dumps(self.summary(), indent=True)
+
+    def to_prometheus(self):
+        """A method to show the numbers in the Prometheus text format"""
+        summary = self.summary()
+        lines = ['# TYPE iacl_calls_total counter',
+                 *[f'iacl_calls_total{{call="{name}"}} {stats["calls"]}'
+                   for name, stats in summary['calls'].items()],
+                 '# TYPE iacl_call_seconds summary',
+                 *[line for name, stats in summary['calls'].items() for line in (
+                     f'iacl_call_seconds{{call="{name}",quantile="0.95"}} {stats["p95"]}',
+                     f'iacl_call_seconds_sum{{call="{name}"}} {stats["total"]}',
+                     f'iacl_call_seconds_count{{call="{name}"}} {stats["calls"]}')],
+                 *[f'iacl_{name}_total {value}' for name, value in summary['counters'].items()],
+                 f"iacl_elapsed_seconds {summary['elapsed']}"]
+        return '\n'.join(lines) + '\n'
+
+    def render(self, format='text'):
+        if format == 'json':
+            return self.to_json()
+        if format == 'prometheus':
+            return self.to_prometheus()
+        return self.to_text()
+
+
+class _TimedCall(object):
+    """A private class to time a bound method of a session manager"""
+
+    def __init__(self, metrics, name, func):
+        self.metrics = metrics
+        self.name = name
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.metrics.record(self.name, time.perf_counter() - start)
+
+
+class _TimedQuery(object):
+    """
+    A private class wrapping a GenQuery object so that every page
+    fetched from iRODS is timed and every row is counted.
+    """
+
+    def __init__(self, metrics, query):
+        self._metrics = metrics
+        self._query = query
+
+    def __getattr__(self, name):
+        attr = getattr(self._query, name)
+        if name in QUERY_BUILDERS:
+            return lambda *args, **kwargs: _TimedQuery(self._metrics, attr(*args, **kwargs))
+        if name in QUERY_EXECUTORS:
+            return _TimedCall(self._metrics, 'query', attr)
+        return attr
+
+    def __iter__(self):
+        return timed_batches(self._metrics, 'query', self._query.get_batches())
+
+
+def timed_batches(metrics, name, batches):
+    """
+    A generator function:
+    It yields the rows of paged query results, timing the fetch
+    of every page and counting the rows.
+    """
+
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+        finally:
+            elapsed = time.perf_counter() - start
+        metrics.record(name, elapsed)
+        rows = 0
+        for row in batch:
+            rows += 1
+            yield row
+        metrics.increment('rows', rows)
+
+
+_metrics = WeakKeyDictionary()
+
+def get_metrics(session):
+    """A function to get the Metrics of an instrumented session, or None"""
+    return _metrics.get(session)
+
+def instrument_session(session, metrics=None):
+    """
+    A function to count and time every iRODS API call a session makes:
+    get/exists of collections and data objects, get/set of permissions
+    and the pages of GenQuery results.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    metrics : Metrics
+        an existing Metrics object to share, e.g. with pooled sessions
+    Returns
+    -------
+    metrics : Metrics
+    """
+
+    metrics = metrics or get_metrics(session) or Metrics()
+    if session in _metrics:
+        return metrics
+    _metrics[session] = metrics
+    for manager_name, methods in INSTRUMENTED_CALLS.items():
+        manager = getattr(session, manager_name)
+        for method in methods:
+            setattr(manager, method, _TimedCall(metrics, f'{manager_name}.{method}',
+                                                getattr(manager, method)))
+    query = session.query
+    session.query = lambda *args, **kwargs: _TimedQuery(metrics, query(*args, **kwargs))
+    return metrics
+
+def uninstrument_session(session):
+    """A function to stop counting the calls of a session instrumented before"""
+    if _metrics.pop(session, None) is None:
+        return
+    for manager_name, methods in INSTRUMENTED_CALLS.items():
+        manager = getattr(session, manager_name)
+        for method in methods:
+            manager.__dict__.pop(method, None)
+    session.__dict__.pop('query', None)
+
+def add_stats_arguments(arg_parser):
+    """A function to add the --stats options to a command"""
+    arg_parser.add_argument('--stats', action='store_true',
+                            help='Prints the number and latency of iRODS calls per type to stderr.')
+    arg_parser.add_argument('--stats-format', choices=STATS_FORMATS, default='text',
+                            help='Shows the --stats output as text, json or prometheus.')
+    arg_parser.add_argument('--stats-file',
+                            help='Writes the --stats output into this file instead of stderr.')
+
+def report_stats(metrics, args):
+    """A function to print or write the numbers asked for with --stats"""
+    if metrics is None:
+        return
+    output = metrics.render(args.stats_format)
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            f.write(output)
+            f.write('\n')
+    else:
+        print(output, file=sys.stderr)
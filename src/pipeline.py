@@ -0,0 +1,92 @@
+import threading
+from queue import Queue, Full, Empty
+
+
+class Prefetch(object):
+    """
+    This class runs an iterable in a background thread and hands its
+    items over through a bounded queue, so that reading the next pages
+    of a catalog query overlaps with whatever the consumer does with the
+    items. The items come out in the order the iterable produces them.
+    Errors of the iterable are raised in the consumer.
+    ...
+    Attributes
+    ----------
+    iterable : iterable
+        the stage to run, e.g. a generator paging through a query.
+    maxsize : int
+        the number of chunks the queue holds before the stage waits.
+    chunk_size : int
+        the number of items handed over at once.
+    on_done : callable
+        called in the background thread when the stage ends, e.g. to
+        give its session back to a pool.
+
+    Examples:
+
+        for path, inheritance in Prefetch(snapshot.collections(coll_path)):
+            print(path)
+    """
+
+    _DONE = object()
+
+    def __init__(self, iterable, maxsize=8, chunk_size=256, on_done=None):
+        """A constructor method"""
+        self.iterable = iterable
+        self.chunk_size = chunk_size
+        self.on_done = on_done
+        self._queue = Queue(maxsize)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        """A private method filling the queue in the background thread"""
+        try:
+            chunk = []
+            for item in self.iterable:
+                chunk.append(item)
+                if len(chunk) == self.chunk_size:
+                    if not self._put(chunk):
+                        return
+                    chunk = []
+            if chunk and not self._put(chunk):
+                return
+            self._put(self._DONE)
+        except BaseException as err:
+            self._put(err)
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+    def _put(self, item):
+        """A private method waiting for room in the queue unless the consumer has stopped"""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is self._DONE:
+                    return
+                if isinstance(chunk, BaseException):
+                    raise chunk
+                for item in chunk:
+                    yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """A method to stop the background thread when the consumer stops early"""
+        self._stopped.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
@@ -0,0 +1,271 @@
+import json
+import time
+import posixpath
+from collections import namedtuple, Counter
+from irods.access import iRODSAccess
+from .export import open_input, open_output
+from .snapshot import in_subtree
+
+
+PlanAction = namedtuple('PlanAction', ['action', 'path', 'object_type', 'user_name', 'user_zone',
+                                       'access_name', 'previous', 'recursive'], defaults=[False])
+ACTIONS = ('grant', 'change', 'revoke', 'inherit')
+PLAN_VERSION = 1
+
+
+def load_desired(entries):
+    """
+    A function to collect the wanted ACLs of a tree from a stream of entries
+    Parameters
+    ----------
+    entries : iterable
+        AclEntry tuples, e.g. from read_export
+    Returns
+    -------
+    desired : dict
+        {path: {user_name: AclEntry}}
+    """
+
+    desired = {}
+    for item in entries:
+        desired.setdefault(item.path, {})[item.user_name] = item
+    return desired
+
+
+def common_path(paths):
+    """A function to find the deepest path all given iRODS paths lie in or are"""
+    paths = list(paths)
+    return posixpath.commonpath(paths) if paths else None
+
+
+def diff_object(path, object_type, current, desired, revoke=True):
+    """
+    A generator function:
+    It yields the fewest ACL changes turning the current ACLs
+    of one object into the desired ones.
+    Parameters
+    ----------
+    path : str
+        an iRODS path
+    object_type : str
+        'collection', 'data_obj' or None when unknown
+    current : dict
+        {user_name: AclEntry} of the catalog
+    desired : dict
+        {user_name: AclEntry} wanted
+    revoke : bool
+        whether grants missing in desired are revoked
+    Returns
+    -------
+    A generator object for PlanAction tuples
+    """
+
+    for user_name in sorted(set(current) | set(desired)):
+        now = current.get(user_name)
+        wanted = desired.get(user_name)
+        if wanted is None:
+            if not revoke:
+                continue
+            yield PlanAction('revoke', path, object_type, user_name, now.user_zone, 'null', now.access_name)
+        elif now is None:
+            yield PlanAction('grant', path, object_type, user_name, wanted.user_zone, wanted.access_name, None)
+        elif now.access_name != wanted.access_name:
+            yield PlanAction('change', path, object_type, user_name, wanted.user_zone or now.user_zone,
+                             wanted.access_name, now.access_name)
+
+
+def plan_restore(snapshot, desired, coll_path, revoke=True, revoke_unlisted=False, stats=None):
+    """
+    A generator function:
+    It reads the current ACLs of a tree in bulk and yields only the
+    changes needed to reach the desired ACLs. Objects whose ACLs
+    already match produce nothing.
+    Parameters
+    ----------
+    snapshot : object
+        an AclSnapshot object
+    desired : dict
+        {path: {user_name: AclEntry}}, consumed while planning
+    coll_path : str
+        an absolute iRODS collection path
+    revoke : bool
+        whether grants of an object missing in desired are revoked
+    revoke_unlisted : bool
+        whether ACLs of objects missing in desired are revoked
+        instead of left untouched
+    stats : dict
+        counts 'matching' objects when given
+    Returns
+    -------
+    A generator object for PlanAction tuples
+    """
+
+    for path, entries in snapshot.acls_by_object(coll_path):
+        current = {item.user_name: item for item in entries}
+        object_type = entries[0].object_type
+        wanted = desired.pop(path, None)
+        if wanted is None:
+            if not revoke_unlisted:
+                continue
+            wanted = {}
+        changed = False
+        for action in diff_object(path, object_type, current, wanted, revoke):
+            changed = True
+            yield action
+        if not changed and stats is not None:
+            stats['matching'] = stats.get('matching', 0) + 1
+    # objects left have no ACL at all in the catalog now
+    for path in sorted(desired):
+        if not in_subtree(path, coll_path):
+            continue
+        for action in diff_object(path, None, {}, desired.pop(path)):
+            yield action
+
+
+def map_tree(entries, source, target):
+    """
+    A generator function:
+    It moves ACL entries of a source tree onto the same relative
+    paths below a target collection.
+    """
+    source = source.rstrip('/')
+    target = target.rstrip('/')
+    for item in entries:
+        yield item._replace(path=target + item.path[len(source):])
+
+
+def to_access(action):
+    """A function to turn a planned change into an iRODSAccess object"""
+    return iRODSAccess(action.access_name, action.path, action.user_name, action.user_zone or '')
+
+
+class ChangePlan(object):
+    """
+    This class collects the ACL changes a command would send instead of
+    sending them, so that they can be counted, estimated, reviewed and
+    executed later without reading the catalog again.
+    ...
+    Attributes
+    ----------
+    actions : list
+        PlanAction tuples in the order they would be sent.
+
+    Examples:
+
+        plan = ChangePlan()
+        PermissionManager(session, target_path=path, plan=plan).set_acl('group_A', 'read', recursive=True)
+        plan.report(measure_latency(session, path), jobs=8)
+        plan.save('/tmp/add.plan')
+    """
+
+    def __init__(self, actions=None):
+        """A constructor method"""
+        self.actions = list(actions or [])
+
+    def add(self, action):
+        self.actions.append(action)
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __iter__(self):
+        return iter(self.actions)
+
+    def summary(self):
+        """A method returning the counts by action, access type and collection"""
+        by_collection = Counter(action.path if action.object_type == 'collection' or action.recursive
+                                else posixpath.dirname(action.path) for action in self.actions)
+        return {'requests': len(self.actions),
+                'recursive': sum(1 for action in self.actions if action.recursive),
+                'by_action': dict(Counter(action.action for action in self.actions)),
+                'by_access': dict(Counter(action.access_name for action in self.actions)),
+                'by_collection': dict(by_collection.most_common())}
+
+    def estimate(self, latency, jobs=1):
+        """
+        A method to estimate the runtime in seconds from the round trip latency
+        A recursive request is counted as one round trip, although iRODS
+        needs time proportional to the size of the tree for it.
+        """
+        return len(self.actions) * latency / max(int(jobs or 1), 1)
+
+    def report(self, latency=None, jobs=1, top=10):
+        """A method to print the counts and the estimated runtime of the plan"""
+        summary = self.summary()
+        print(f"Plan: {summary['requests']} ACL requests ({summary['recursive']} recursive), nothing was written.")
+        for name in ACTIONS:
+            if name in summary['by_action']:
+                print(f"     {name}: {summary['by_action'][name]}")
+        print('By access type:')
+        for access_name, count in sorted(summary['by_access'].items()):
+            print(f'     {access_name}: {count}')
+        print('By collection:')
+        for coll_path, count in list(summary['by_collection'].items())[:top]:
+            print(f'     {coll_path}: {count}')
+        if len(summary['by_collection']) > top:
+            print(f"     ... and {len(summary['by_collection']) - top} more collections")
+        if latency is not None:
+            print(f'Estimated runtime: {self.estimate(latency, jobs):.1f}s '
+                  f'at {latency * 1000:.1f} ms per round trip with {max(int(jobs or 1), 1)} jobs.')
+            if summary['recursive']:
+                print('     Recursive requests take longer, iRODS walks the tree for each of them.')
+
+    def save(self, filename, description=None):
+        """
+        A method to write the plan as newline delimited json
+        The first line holds the plan version, creation time and a
+        description; every following line is one PlanAction.
+        """
+        with open_output(filename) as f:
+            f.write(json.dumps({'plan': PLAN_VERSION, 'created': int(time.time()),
+                                'description': description, 'requests': len(self.actions)}))
+            f.write('\n')
+            for action in self.actions:
+                f.write(json.dumps(action._asdict()))
+                f.write('\n')
+
+    @classmethod
+    def load(cls, filename):
+        """A method to read a plan written by save"""
+        with open_input(filename) as f:
+            meta = json.loads(next(f))
+            if meta.get('plan') != PLAN_VERSION:
+                raise ValueError(f'{filename} is not a plan of version {PLAN_VERSION}')
+            return cls(PlanAction(**json.loads(line)) for line in f if line.strip())
+
+
+def measure_latency(session, path, probes=5):
+    """
+    A function to measure the round trip latency to iRODS in seconds
+    It times a few cheap catalog lookups and returns the median.
+    """
+    timings = []
+    for _ in range(probes):
+        start = time.perf_counter()
+        session.collections.exists(path)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def add_plan_arguments(arg_parser):
+    """A function to add the --dry-run and --plan options to a mutating command"""
+    arg_parser.add_argument('--dry-run', action='store_true',
+                            help='Reads the catalog and shows the ACL changes that would be sent, \
+                                  by access type and collection, with an estimated runtime, without changing anything.')
+    arg_parser.add_argument('--plan', metavar='PLAN_FILE',
+                            help='Like --dry-run and also writes the changes into this file, \
+                                  to be reviewed and executed later with iacl-apply --from-plan.')
+
+def new_plan(args):
+    """A function to create a ChangePlan when --dry-run or --plan is given, otherwise None"""
+    return ChangePlan() if args.dry_run or args.plan else None
+
+def report_plan(plan, session, args, path=None, description=None):
+    """A function to print a plan and write it into the file given with --plan"""
+    if plan is None:
+        return
+    latency = measure_latency(session, path or f'/{session.zone}')
+    plan.report(latency, getattr(args, 'jobs', 1))
+    if args.plan:
+        plan.save(args.plan, description)
+        print(f'The plan was written into {args.plan}.')
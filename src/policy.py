@@ -0,0 +1,215 @@
+import re
+import json
+import fnmatch
+from collections import namedtuple
+from .snapshot import AclEntry
+from .plan import PlanAction, diff_object
+from .export import open_input
+
+
+PolicyRule = namedtuple('PolicyRule', ['number', 'pattern', 'acls', 'inherit', 'exclusive'])
+POLICY_ACCESS = {'own': 'own', 'write': 'modify object', 'modify object': 'modify object',
+                 'read': 'read object', 'read object': 'read object', 'null': 'null'}
+RULE_KEYS = ('inherit', 'exclusive')
+WILDCARDS = re.compile(r'[*?\[]')
+
+
+def load_policy(filename, zone):
+    """
+    A function to read a policy file: a json object mapping iRODS path
+    globs onto the wanted ACLs of the matching objects, e.g.
+    {"/tempZone/home/proj*/**": {"g:group_A": "read", "rods": "own", "inherit": true}}
+    A user is given as name or name#zone, groups may be prefixed with
+    'g:'. The access is own, write, read or null (no ACL). 'inherit'
+    sets the inheritance of matching collections and with 'exclusive'
+    the ACLs of users not listed are removed.
+    Parameters
+    ----------
+    filename : str
+        a local file path, or '-' for stdin
+    zone : str
+        the zone of users given without one
+    Returns
+    -------
+    rules : list
+        PolicyRule tuples in the order of the file
+    Raises
+    ------
+    ValueError
+        when the file is no policy or a rule is invalid
+    """
+
+    with open_input(filename) as f:
+        document = json.load(f)
+    if not isinstance(document, dict):
+        raise ValueError('A policy is a json object mapping path globs onto ACLs')
+    rules = []
+    for number, (pattern, wanted) in enumerate(document.items(), 1):
+        if not pattern.startswith('/') or not isinstance(wanted, dict):
+            raise ValueError(f'Rule {number}: {pattern} is no absolute path glob with an object of ACLs')
+        acls = {}
+        for user, access in wanted.items():
+            if user in RULE_KEYS:
+                continue
+            if access not in POLICY_ACCESS:
+                raise ValueError(f'Rule {number}: unknown access {access} of {user}')
+            user_name, _, user_zone = user[2:].partition('#') if user.startswith('g:') \
+                else user.partition('#')
+            acls[user_name] = (user_zone or zone, POLICY_ACCESS[access])
+        for key in RULE_KEYS:
+            if key in wanted and not isinstance(wanted[key], bool):
+                raise ValueError(f'Rule {number}: {key} has to be true or false')
+        rules.append(PolicyRule(number, pattern.rstrip('/') or '/', acls,
+                                wanted.get('inherit'), wanted.get('exclusive')))
+    return rules
+
+
+class _TrieNode(object):
+    """A private class holding the rules whose literal part ends at one path segment"""
+
+    def __init__(self):
+        self.children = {}
+        self.rules = []
+
+
+class PolicyMatcher(object):
+    """
+    This class finds the rules of a policy matching an iRODS path.
+    The rules are compiled into a prefix trie on the literal segments
+    of their globs, so a path only walks its own segments and is matched
+    against the few rules whose literal prefix it lies in, not against
+    every rule. '*', '?' and '[...]' match within one path segment and
+    '**' matches any number of segments, also none.
+    ...
+    Attributes
+    ----------
+    rules : list
+        PolicyRule tuples in the order of the policy.
+
+    Examples:
+
+        matcher = PolicyMatcher(load_policy('projects.json', 'tempZone'))
+        for root in matcher.roots():
+            pass
+        rules = matcher.match('/tempZone/home/projA/raw/data.txt')
+    """
+
+    def __init__(self, rules):
+        """A constructor method"""
+        self.rules = rules
+        self._root = _TrieNode()
+        self._prefixes = []
+        for rule in rules:
+            segments = _segments(rule.pattern)
+            literal = 0
+            while literal < len(segments) and not WILDCARDS.search(segments[literal]):
+                literal += 1
+            node = self._root
+            for segment in segments[:literal]:
+                node = node.children.setdefault(segment, _TrieNode())
+            node.rules.append((rule, [_compile(segment) for segment in segments[literal:]]))
+            self._prefixes.append('/' + '/'.join(segments[:literal]))
+
+    def roots(self):
+        """
+        A method returning the paths to read: the literal prefixes of the
+        globs, without the ones lying in another.
+        """
+        roots = []
+        for prefix in sorted(set(self._prefixes)):
+            if not any(prefix == root or prefix.startswith(root.rstrip('/') + '/') for root in roots):
+                roots.append(prefix)
+        return roots
+
+    def match(self, path):
+        """A method returning the rules matching a path in the order of the policy"""
+        segments = _segments(path)
+        found = []
+        node = self._root
+        for depth in range(len(segments) + 1):
+            for rule, tail in node.rules:
+                if _match_segments(tail, segments[depth:]):
+                    found.append(rule)
+            if depth == len(segments):
+                break
+            node = node.children.get(segments[depth])
+            if node is None:
+                break
+        found.sort(key=lambda rule: rule.number)
+        return found
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+def _compile(segment):
+    """A private function to compile one glob segment, '**' stays as it is"""
+    if segment == '**':
+        return segment
+    return re.compile(fnmatch.translate(segment)).match
+
+
+def _match_segments(patterns, segments):
+    """A private function to match compiled glob segments against path segments"""
+    if not patterns:
+        return not segments
+    if patterns[0] == '**':
+        return any(_match_segments(patterns[1:], segments[start:]) for start in range(len(segments) + 1))
+    return bool(segments) and patterns[0](segments[0]) is not None and \
+        _match_segments(patterns[1:], segments[1:])
+
+
+def diff_policy(path, object_type, inheritance, acls, rules):
+    """
+    A generator function:
+    It yields the fewest changes bringing one object to the ACLs the
+    matching rules want. Later rules override earlier ones per user;
+    users no rule names are left untouched unless a rule is exclusive.
+    Parameters
+    ----------
+    path : str
+        an iRODS path
+    object_type : str
+        'collection' or 'data_obj'
+    inheritance : bool
+        the inheritance of a collection
+    acls : list
+        AclEntry tuples of the object in the catalog
+    rules : list
+        the PolicyRule tuples matching the object
+    Returns
+    -------
+    A generator object for PlanAction tuples, 'inherit' actions
+    change the inheritance of a collection.
+    """
+
+    wanted = {}
+    inherit = None
+    exclusive = False
+    for rule in rules:
+        wanted.update(rule.acls)
+        if rule.inherit is not None:
+            inherit = rule.inherit
+        if rule.exclusive is not None:
+            exclusive = rule.exclusive
+    if object_type == 'collection' and inherit is not None and inherit != inheritance:
+        yield PlanAction('inherit', path, object_type, '', None, 'inherit' if inherit else 'noinherit',
+                         'inherit' if inheritance else 'noinherit')
+    current = {item.user_name: item for item in acls if exclusive or item.user_name in wanted}
+    desired = {user_name: AclEntry(path, user_name, user_zone, access_name, None, object_type)
+               for user_name, (user_zone, access_name) in wanted.items() if access_name != 'null'}
+    for action in diff_object(path, object_type, current, desired):
+        yield action
+
+
+def format_action(action):
+    """A function to show a change of a policy as a line of text"""
+    if action.action == 'inherit':
+        return f'{action.action:<7} {action.path}: {action.previous} -> {action.access_name}'
+    user = f'{action.user_name}#{action.user_zone}' if action.user_zone else action.user_name
+    if action.action == 'grant':
+        return f'{action.action:<7} {action.path}: {user}:{action.access_name}'
+    if action.action == 'revoke':
+        return f'{action.action:<7} {action.path}: {user}:{action.previous}'
+    return f'{action.action:<7} {action.path}: {user}:{action.previous} -> {action.access_name}'
@@ -0,0 +1,317 @@
+import os
+import sys
+import csv
+import json
+import pickle
+import shutil
+import tempfile
+import argparse
+import subprocess
+from itertools import groupby
+from operator import attrgetter
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from irods.column import Criterion
+from irods.models import Collection, DataObject
+from .util import new_session, get_object_type, iter_objects_with_no_acl_for_entire_zone
+from .snapshot import AclSnapshot, in_subtree
+from .export import FORMATS, CSV_HEADER, open_output, write_ndjson
+from .manage_acl import PermissionManager
+
+
+PARTS = ('collections', 'data_objects')
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_shard(value):
+    """A function to read a --shard value i/N, 1 <= i <= N, into (i, N)"""
+    number, _, shards = value.partition('/')
+    try:
+        number, shards = int(number), int(shards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is no shard i/N')
+    if not 1 <= number <= shards:
+        raise argparse.ArgumentTypeError(f'{value} is no shard i/N with 1 <= i <= N')
+    return number, shards
+
+
+def add_shard_arguments(arg_parser):
+    """A function to add the --shards and --shard options to a scanning command"""
+    arg_parser.add_argument('--shards', type=int,
+                            help='Splits the scan into this many ranges of collections holding about the same \
+                                  number of data objects, scanned in parallel processes (-j, one per CPU \
+                                  by default) with their own iRODS connections. The output is merged in order.')
+    arg_parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                            help='Scans only the i-th of N ranges, e.g. on one of N hosts. The outputs of \
+                                  1/N ... N/N concatenated hold the whole tree.')
+
+
+def new_scan(session, coll_path, args):
+    """A function to create a ShardedScan when --shards or --shard is given, otherwise None"""
+    if not args.shards and not args.shard:
+        return None
+    if getattr(args, 'offline', False):
+        print('Scans can only be sharded on the catalog, not offline.')
+        sys.exit(2)
+    number, shards = args.shard if args.shard else (None, args.shards)
+    jobs = args.jobs if getattr(args, 'jobs', 1) > 1 else None
+    return ShardedScan(session, coll_path, shards, only=number, jobs=jobs)
+
+
+def shard_ranges(session, coll_path, shards):
+    """
+    A function to split a tree into contiguous ranges of collection names
+    holding about the same number of data objects. The data objects per
+    collection are counted by the catalog in one grouped query, and the
+    bounds are collection names in the order of the catalog, so the ranges
+    cover every collection exactly once.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    coll_path : str
+        an absolute iRODS collection path
+    shards : int
+        the number of ranges
+    Returns
+    -------
+    ranges : list
+        (lower, upper) bounds of each shard, None for an open bound,
+        or None for a shard left empty in a small tree.
+    """
+
+    coll_path = coll_path.rstrip('/') or '/'
+    query = session.query(Collection.name, DataObject.id).count(DataObject.id).order_by(Collection.name)
+    weights = []
+    for criterion in (Criterion('=', Collection.name, coll_path),
+                      Criterion('like', Collection.name, f'{coll_path.rstrip("/")}/%')):
+        for result in query.filter(criterion):
+            if in_subtree(result[Collection.name], coll_path):
+                weights.append((result[Collection.name], int(result[DataObject.id]) + 1))
+    total = sum(weight for _, weight in weights)
+    bounds = []
+    cumulative = 0
+    for name, weight in weights:
+        if len(bounds) < shards - 1 and cumulative >= total * (len(bounds) + 1) / shards:
+            bounds.append(name)
+        cumulative += weight
+    edges = [None] + bounds + [None]
+    ranges = [(edges[number], edges[number + 1]) for number in range(len(bounds) + 1)]
+    return ranges + [None] * (shards - len(ranges))
+
+
+class ShardedScan(object):
+    """
+    This class scans a collection tree in shards: contiguous ranges of
+    collection names, each read by its own process on its own session,
+    so the formatting of the rows runs on several cores. The processes
+    run this module (python -m src.shard), not the command that started
+    the scan. Every shard writes its collections and its data objects
+    into separate part files, which are merged in shard order; the merged
+    output is the same as the one of an unsharded scan.
+    ...
+    Attributes
+    ----------
+    session : object
+        the iRODS session the ranges are read with.
+    coll_path : str
+        an absolute iRODS collection path
+    ranges : list
+        the (lower, upper) bounds of the shards to scan here.
+    numbers : list
+        the numbers of the shards to scan here, from 1.
+    only : int
+        the number of the one shard scanned here, None for all shards.
+    jobs : int
+        the number of processes.
+    session_factory : callable
+        a picklable function returning a new session in a process, new_session by default.
+
+    Examples:
+
+        scan = ShardedScan(session, '/tempZone/home', shards=8)
+        scan.save('/tmp/acls.ndjson', 'ndjson')
+        scan = ShardedScan(session, '/tempZone/home', shards=4, only=2)
+        scan.list()
+    """
+
+    def __init__(self, session, coll_path, shards, only=None, jobs=None, session_factory=None):
+        """A constructor method"""
+        self.session = session
+        self.coll_path = coll_path
+        ranges = shard_ranges(session, coll_path, shards)
+        self.only = only
+        self.ranges = ranges if only is None else [ranges[only - 1]]
+        self.numbers = list(range(1, shards + 1)) if only is None else [only]
+        self.jobs = jobs or min(len(self.ranges), os.cpu_count() or 1)
+        self.session_factory = session_factory
+
+    def _run(self, scan, **options):
+        """A private method to scan all shards, returning their part files in shard order"""
+        workdir = tempfile.mkdtemp(prefix='iacl_shards_')
+        tasks = [(scan, self.coll_path, name_range, number, os.path.join(workdir, str(number)),
+                  self.session_factory, options) for number, name_range in zip(self.numbers, self.ranges)]
+        try:
+            if len(tasks) == 1 or self.jobs == 1:
+                parts = [_scan_shard(*task) for task in tasks]
+            else:
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    parts = list(pool.map(_scan_in_process, tasks))
+        except BaseException:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        return workdir, parts
+
+    def save(self, filename, format, compression=None):
+        """
+        A method to write the ACLs of the tree into an export file like
+        export_acls. A single shard of several (--shard) writes the csv
+        header only in the first shard, so the exports of all shards can
+        be concatenated; json can not be concatenated, so it is refused.
+        """
+        if format not in FORMATS:
+            raise ValueError(f'Unknown format: {format}')
+        if format == 'json' and self.only is not None:
+            raise ValueError('The json exports of single shards can not be concatenated. Choose either csv or ndjson')
+        workdir, parts = self._run('acls', format=format)
+        try:
+            with open_output(filename, compression) as f:
+                if format == 'csv' and self.only in (None, 1):
+                    csv.writer(f).writerow(CSV_HEADER)
+                if format == 'json':
+                    f.write('{')
+                separator = '\n'
+                for part in _ordered(parts):
+                    with open(part, newline='') as source:
+                        if format != 'json':
+                            shutil.copyfileobj(source, f)
+                            continue
+                        for line in source:
+                            f.write(separator + line.rstrip('\n'))
+                            separator = ',\n'
+                if format == 'json':
+                    f.write('\n}\n')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def list(self):
+        """A method to print the ACLs of all collections of the tree like list_acl_recursively"""
+        if get_object_type(self.session, self.coll_path) != 'collection':
+            print('Recursive can only be applied on a collection!')
+            return
+        workdir, parts = self._run('collections')
+        try:
+            for part in _ordered(parts):
+                with open(part) as source:
+                    shutil.copyfileobj(source, sys.stdout)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def orphans(self):
+        """A method to print the objects without any ACL like search_orphaned_objects_entire_zone"""
+        workdir, parts = self._run('orphans')
+        try:
+            found = False
+            for part in _ordered(parts, reverse=True):
+                with open(part) as source:
+                    for line in source:
+                        if not found:
+                            print('Warning: Objects below have no granted permissions.')
+                            found = True
+                        sys.stdout.write(line)
+            if not found:
+                print('There is no object that doesnt have any permission in your zone.')
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _ordered(parts, reverse=False):
+    """
+    A private function to order part files: the collections of all shards,
+    then their data objects, or the other way round with reverse
+    """
+    indices = range(len(PARTS) - 1, -1, -1) if reverse else range(len(PARTS))
+    return [shard_parts[index] for index in indices for shard_parts in parts]
+
+
+def _scan_in_process(task):
+    """
+    A private function scanning one shard in a new python process running
+    this module. The task is handed over in a file with sys.path, so the
+    process finds the modules of the session factory; the output of the
+    process is passed on when it ends.
+    Returns the paths of the part files
+    """
+    number, prefix = task[3], task[4]
+    task_file = f'{prefix}.task'
+    with open(task_file, 'wb') as f:
+        pickle.dump(sys.path, f)
+        pickle.dump(task, f)
+    python_path = [ROOT_DIR] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])
+    result = subprocess.run([sys.executable, '-m', 'src.shard', task_file], stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join(python_path)))
+    sys.stdout.write(result.stdout)
+    sys.stderr.write(result.stderr)
+    if result.returncode != 0:
+        raise RuntimeError(f'The scan of shard {number} failed with exit code {result.returncode}.')
+    return [f'{prefix}.{name}' for name in PARTS]
+
+
+def _scan_shard(scan, coll_path, name_range, number, prefix, session_factory, options):
+    """
+    A private function scanning one shard, in a process of its own:
+    it opens a session and writes the collections and the data objects
+    of its range into two part files.
+    Returns the paths of the part files
+    """
+    parts = [f'{prefix}.{name}' for name in PARTS]
+    for part in parts:
+        open(part, 'w').close()
+    if name_range is None:
+        return parts
+    with (session_factory or new_session)() as session:
+        if scan == 'acls':
+            snapshot = AclSnapshot(session, name_range=name_range)
+            _write_acls(snapshot.collection_acls(coll_path), parts[0], options['format'])
+            _write_acls(snapshot.data_object_acls(coll_path), parts[1], options['format'])
+        elif scan == 'collections':
+            manager = PermissionManager(session, target_path=coll_path, name_range=name_range)
+            with open(parts[0], 'w') as f, redirect_stdout(f):
+                manager.list_acl_recursively()
+        else:
+            with open(parts[0], 'w') as collections, open(parts[1], 'w') as data_objects:
+                for object_type, path in iter_objects_with_no_acl_for_entire_zone(session, name_range, number):
+                    if object_type == 'collection':
+                        collections.write(f'C -  {path}\n')
+                    else:
+                        data_objects.write(f'{path}\n')
+    return parts
+
+
+def _write_acls(acl_entries, filename, format):
+    """A private function to write ACL entries into a part file, without the header of the format"""
+    with open(filename, 'w', newline='') as f:
+        if format == 'csv':
+            writer = csv.writer(f)
+            for item in acl_entries:
+                writer.writerow((item.path, item.user_name, item.access_name))
+        elif format == 'ndjson':
+            write_ndjson(acl_entries, f)
+        else:
+            for path, acls in groupby(acl_entries, key=attrgetter('path')):
+                f.write(f'{json.dumps(path)}: ')
+                f.write(json.dumps({item.user_name: item.access_name for item in acls}))
+                f.write('\n')
+
+
+def main():
+    """The entry point of the shard processes: python -m src.shard TASK_FILE"""
+    with open(sys.argv[1], 'rb') as f:
+        sys.path[:0] = [path for path in pickle.load(f) if path not in sys.path]
+        task = pickle.load(f)
+    _scan_shard(*task)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+import threading
+from collections import namedtuple, deque
+from itertools import groupby, chain
+from operator import attrgetter
+from irods.column import Criterion
+from irods.models import Collection, DataObject, User, CollectionUser, \
+                         DataAccess, CollectionAccess
+from .pipeline import Prefetch
+
+
+# the most query streams a tree read holds at the same time, e.g. objects_with_acls
+TREE_STREAMS = 4
+
+AclEntry = namedtuple('AclEntry', ['path', 'user_name', 'user_zone', 'access_name',
+                                   'inheritance', 'object_type'])
+
+
+def in_subtree(path, coll_path):
+    """
+    A function to know whether an iRODS path is the given
+    collection itself or lies below it.
+    LIKE criteria treat '_' and '%' as wildcards, so the
+    query results are checked again with this function.
+    """
+    coll_path = coll_path.rstrip('/')
+    return path == (coll_path or '/') or path.startswith(f'{coll_path}/')
+
+
+def data_object_key(path):
+    """A function to sort data object paths like the queries do: on collection, then name"""
+    return tuple(path.rsplit('/', 1))
+
+
+def attach_acls(objects, entries):
+    """
+    A generator function:
+    It merges a stream of objects with a stream of the ACL entries of
+    the same objects. Both streams have to come from queries sorted on
+    the same columns, but the order is the collation of the catalog,
+    which is not the order of Python strings; so paths are never
+    compared by order, only matched exactly. An object without ACLs is
+    recognized when a later object of the stream has its ACLs read
+    already; an ACL group whose object is missing from the objects,
+    e.g. created or removed between the two queries, is skipped. Only
+    the objects and ACL groups between two matched paths are held.
+    Parameters
+    ----------
+    objects : iterable
+        (path, inheritance) tuples
+    entries : iterable
+        AclEntry tuples
+    Returns
+    -------
+    A generator object for (path, inheritance, [AclEntry]) tuples
+    """
+
+    objects = iter(objects)
+    groups = ((path, list(acls)) for path, acls in groupby(entries, key=attrgetter('path')))
+    pending_objects = deque()
+    pending_paths = set()
+    pending_groups = {}
+    common = set()
+    while True:
+        if pending_objects:
+            path, inheritance = pending_objects[0]
+            if path in pending_groups:
+                skipped = []
+                for other in pending_groups:
+                    if other == path:
+                        break
+                    if other not in pending_paths:
+                        skipped.append(other)
+                for other in skipped:
+                    del pending_groups[other]
+                acls = pending_groups.pop(path)
+            elif common or groups is None:
+                acls = []
+            else:
+                acls = None
+            if acls is not None:
+                pending_objects.popleft()
+                pending_paths.discard(path)
+                common.discard(path)
+                yield path, inheritance, acls
+                continue
+        elif objects is None:
+            return
+        if objects is not None and (groups is None or len(pending_objects) <= len(pending_groups)):
+            item = next(objects, None)
+            if item is None:
+                objects = None
+            else:
+                pending_objects.append(item)
+                pending_paths.add(item[0])
+                if item[0] in pending_groups:
+                    common.add(item[0])
+        else:
+            group = next(groups, None)
+            if group is None:
+                groups = None
+            else:
+                pending_groups[group[0]] = group[1]
+                if group[0] in pending_paths:
+                    common.add(group[0])
+
+
+class AclSnapshot(object):
+    """
+    This class fetches every ACL of a collection tree with a few
+    paged GenQuery calls instead of one permissions.get() call per
+    object. The queries join the catalog access table (R_OBJT_ACCESS)
+    with collections, data objects and users on the server side.
+    ...
+    Attributes
+    ----------
+    session : object
+        a connection object to communicate with iRODS.
+    recursive : bool
+        whether a tree is the whole subtree or only the collection
+        itself and its data objects.
+    session_pool : SessionPool
+        when given, the query streams of a tree are read at the same
+        time on pooled sessions in background threads.
+    name_range : tuple
+        when given, (lower, upper) bounds of the collection names read:
+        only collections with lower <= name < upper and their data objects
+        are part of a tree, a bound of None is open. It is one shard of a
+        tree scanned in several processes.
+    Methods
+    -------
+    collections(coll_path):
+        Yields (path, inheritance) of all collections in a tree.
+    data_objects(coll_path):
+        Yields (path, None) of all data objects in a tree.
+    collection_acls(coll_path):
+        Yields AclEntry tuples of all collections in a tree.
+    data_object_acls(coll_path):
+        Yields AclEntry tuples of all data objects in a tree.
+    users(coll_path):
+        Returns a set of (user, zone) holding an ACL in a tree.
+    objects_with_acls(coll_path):
+        Yields (path, object_type, inheritance, [AclEntry]) of all objects
+        in a tree, also the ones that don't have any permission on.
+    acls(coll_path):
+        Yields AclEntry tuples of all objects in a tree.
+    acls_by_object(coll_path):
+        Yields (path, [AclEntry]) of all objects in a tree that have permissions.
+
+    Examples:
+
+        snapshot = AclSnapshot(session)
+        for path, object_type, inheritance, acls in snapshot.objects_with_acls(coll_path):
+            pass
+    """
+
+    def __init__(self, session, recursive=True, session_pool=None, name_range=None):
+        """A constructor method"""
+        self.session = session
+        self.recursive = recursive
+        self.session_pool = session_pool
+        self.name_range = name_range
+        self._thread = threading.get_ident()
+
+    def on_session(self, session):
+        """
+        A method returning a copy of the snapshot reading on another
+        session, e.g. one a worker thread holds for itself
+        """
+        return AclSnapshot(session, self.recursive, self.session_pool, self.name_range)
+
+    def _stage(self, stream, coll_path):
+        """
+        A private method to start one query stream of a tree
+        With a session pool, the stream runs right away in a background
+        thread on a pooled session, so several streams of a tree are read
+        at the same time while their items are consumed in order. When no
+        pooled session is free, it is read on the main session as it is
+        consumed, but only in the thread that created the snapshot: the
+        pages of a query have to follow each other on one connection, so
+        other threads wait for a pooled session instead. A worker thread
+        reading a tree should hold a session and use on_session().
+        """
+        session = self.session_pool.acquire(block=False) if self.session_pool is not None else None
+        if session is None:
+            if self.session_pool is None or threading.get_ident() == self._thread:
+                return stream(self.session, coll_path)
+            session = self.session_pool.acquire()
+        return Prefetch(stream(session, coll_path), on_done=lambda: self.session_pool.release(session))
+
+    def _subtree_queries(self, query, coll_path):
+        """
+        A private method to build the queries of a tree:
+        one for the collection itself and one for its descendants
+        """
+        coll_path = coll_path.rstrip('/') or '/'
+        lower, upper = self.name_range or (None, None)
+        if lower is not None:
+            query = query.filter(Criterion('>=', Collection.name, lower))
+        if upper is not None:
+            query = query.filter(Criterion('<', Collection.name, upper))
+        yield query.filter(Criterion('=', Collection.name, coll_path))
+        if self.recursive:
+            yield query.filter(Criterion('like', Collection.name, f'{coll_path.rstrip("/")}/%'))
+
+    def _run(self, query, coll_path):
+        """A private method to page through the results of a tree query"""
+        for subtree_query in self._subtree_queries(query, coll_path):
+            for result in subtree_query:
+                yield result
+
+    def collections(self, coll_path):
+        """A method to get the paths and inheritance of all collections in a tree"""
+        return self._stage(self._collections, coll_path)
+
+    def _collections(self, session, coll_path):
+        query = session.query(Collection.name, Collection.inheritance)\
+                       .order_by(Collection.name)
+        for result in self._run(query, coll_path):
+            path = result[Collection.name]
+            if in_subtree(path, coll_path):
+                yield path, _inheritance(result[Collection.inheritance])
+
+    def data_objects(self, coll_path):
+        """A method to get the paths of all data objects in a tree"""
+        return self._stage(self._data_objects, coll_path)
+
+    def _data_objects(self, session, coll_path):
+        query = session.query(Collection.name, DataObject.name)\
+                       .order_by(Collection.name).order_by(DataObject.name)
+        for result in self._run(query, coll_path):
+            if in_subtree(result[Collection.name], coll_path):
+                yield f'{result[Collection.name]}/{result[DataObject.name]}', None
+
+    def collection_acls(self, coll_path):
+        """A method to get ACLs of all collections in a tree"""
+        return self._stage(self._collection_acls, coll_path)
+
+    def _collection_acls(self, session, coll_path):
+        query = session.query(Collection.name, Collection.inheritance, CollectionUser.name,
+                              CollectionUser.zone, CollectionAccess.name)\
+                       .order_by(Collection.name)
+        for result in self._run(query, coll_path):
+            path = result[Collection.name]
+            if in_subtree(path, coll_path):
+                yield AclEntry(path, result[CollectionUser.name], result[CollectionUser.zone],
+                               result[CollectionAccess.name],
+                               _inheritance(result[Collection.inheritance]), 'collection')
+
+    def data_object_acls(self, coll_path):
+        """A method to get ACLs of all data objects in a tree"""
+        return self._stage(self._data_object_acls, coll_path)
+
+    def _data_object_acls(self, session, coll_path):
+        query = session.query(Collection.name, DataObject.name, User.name,
+                              User.zone, DataAccess.name)\
+                       .order_by(Collection.name).order_by(DataObject.name)
+        for result in self._run(query, coll_path):
+            if in_subtree(result[Collection.name], coll_path):
+                yield AclEntry(f'{result[Collection.name]}/{result[DataObject.name]}',
+                               result[User.name], result[User.zone], result[DataAccess.name],
+                               None, 'data_obj')
+
+    def users(self, coll_path):
+        """
+        A method to get the distinct (user, zone) pairs holding an ACL in a tree
+        The paths are not selected to keep the results distinct, so names
+        matched by LIKE wildcards can add a few users from outside the tree.
+        """
+        streams = [self._stage(self._users(user_type, access_type), coll_path)
+                   for user_type, access_type in ((CollectionUser, CollectionAccess), (User, DataAccess))]
+        return set(chain.from_iterable(streams))
+
+    def _users(self, user_type, access_type):
+        def stream(session, coll_path):
+            query = session.query(user_type.name, user_type.zone, access_type.name)
+            for result in self._run(query, coll_path):
+                yield result[user_type.name], result[user_type.zone]
+        return stream
+
+    def collections_with_acls(self, coll_path):
+        """A method to get all collections of a tree together with their ACLs"""
+        return attach_acls(self.collections(coll_path), self.collection_acls(coll_path))
+
+    def data_objects_with_acls(self, coll_path):
+        """A method to get all data objects of a tree together with their ACLs"""
+        return attach_acls(self.data_objects(coll_path), self.data_object_acls(coll_path))
+
+    def objects_with_acls(self, coll_path):
+        """
+        A method to get all objects of a tree together with their ACLs
+        Collections come first and data objects follow them
+        """
+        collections = self.collections_with_acls(coll_path)
+        data_objects = self.data_objects_with_acls(coll_path)
+        return chain(((path, 'collection', inheritance, acls) for path, inheritance, acls in collections),
+                     ((path, 'data_obj', inheritance, acls) for path, inheritance, acls in data_objects))
+
+    def acls(self, coll_path):
+        """A method to get ACL entries of all objects in a tree"""
+        return chain(self.collection_acls(coll_path), self.data_object_acls(coll_path))
+
+    def acls_by_object(self, coll_path):
+        """
+        A method to get ACL entries of a tree grouped per object
+        Objects that don't have any permission on are left out
+        """
+        for path, entries in groupby(self.acls(coll_path), key=attrgetter('path')):
+            yield path, list(entries)
+
+
+def _inheritance(value):
+    """A function to convert the catalog inheritance flag into a boolean"""
+    return bool(value) and value != '0'
@@ -1,13 +1,27 @@
 import os
 import os.path
 import ssl
-import csv
-import json
-from datetime import datetime
+import time
+import threading
+from collections import namedtuple, OrderedDict
+from weakref import WeakKeyDictionary
 from irods.session import iRODSSession
-from irods.models import Collection, DataObject, UserGroup, User
+from irods.models import Collection, DataObject, User, UserGroup, CollectionUser, \
+                         CollectionAccess, DataAccess
 from irods.column import Criterion
 from irods.query import SpecificQuery
+from irods.exception import CAT_NO_ROWS_FOUND, CollectionDoesNotExist, DataObjectDoesNotExist
+from .snapshot import AclSnapshot, AclEntry, in_subtree, _inheritance
+from .metrics import get_metrics, timed_batches
+from .export import export_acls, export_filename
+
+
+def get_irods_env_file():
+    """A function returning the iRODS environment file sessions are configured with"""
+    try:
+        return os.environ['IRODS_ENVIRONMENT_FILE']
+    except KeyError:
+        return os.path.expanduser('~/.irods/irods_environment.json')
 
 
 class GetiRODSSession(iRODSSession):
@@ -20,15 +34,31 @@ class GetiRODSSession(iRODSSession):
     """
 
     def __init__(self):
-        try:
-            env_file = os.environ['IRODS_ENVIRONMENT_FILE']
-        except KeyError:
-            env_file = os.path.expanduser('~/.irods/irods_environment.json')
+        env_file = get_irods_env_file()
         ssl_context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=None, capath=None, cadata=None)
         ssl_settings = {'ssl_context': ssl_context}
         iRODSSession.__init__(self, irods_env_file=env_file, **ssl_settings)
 
 
+_session_factory = None
+
+def new_session():
+    """
+    A function returning the session a command works with: a new
+    GetiRODSSession or, inside the iacl daemon, a warm one it lends.
+    Example:
+    with new_session() as session:
+        pass
+    """
+
+    return (_session_factory or GetiRODSSession)()
+
+def set_session_factory(factory):
+    """A function to let new_session() return the sessions of factory, or GetiRODSSession with None"""
+    global _session_factory
+    _session_factory = factory
+
+
 def query_data_obj(session, coll_path):
     """
     A generator function:
@@ -52,6 +82,218 @@ def query_data_obj(session, coll_path):
                         result[Collection.name], result[DataObject.name])
         yield data_obj_path
 
+class UserGroupResolver(object):
+    """
+    UserGroupResolver class is used to know whether a name belongs
+    to a group without querying iRODS for every ACL entry.
+    All 'rodsgroup' names are loaded with a single query and kept
+    for ttl seconds. The hits and misses counters show how many
+    lookups were answered from memory and how many needed a query.
+    Example:
+    resolver = get_user_group_resolver(session)
+    resolver.is_group('group_A')
+    """
+
+    def __init__(self, session, ttl=300):
+        self.session = session
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._groups = None
+        self._loaded_at = None
+
+    def _expired(self):
+        return self._groups is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def _load(self):
+        result = self.session.query(User.name).filter(
+        Criterion('=', User.type, 'rodsgroup'))
+        self._groups = frozenset(item[User.name] for item in result)
+        self._loaded_at = time.monotonic()
+
+    def is_group(self, name):
+        """A method returning True when the given user name is a group"""
+        metrics = get_metrics(self.session)
+        if self._expired():
+            self.misses += 1
+            self._load()
+            if metrics is not None:
+                metrics.increment('group_cache_misses')
+        else:
+            self.hits += 1
+            if metrics is not None:
+                metrics.increment('group_cache_hits')
+        return name in self._groups
+
+    def invalidate(self):
+        """A method to drop the loaded group names"""
+        self._groups = None
+
+    def stats(self):
+        """A method returning the cache counters as a dict"""
+        return {'hits': self.hits, 'misses': self.misses,
+                'groups': len(self._groups) if self._groups is not None else 0}
+
+
+_user_group_resolvers = WeakKeyDictionary()
+
+def get_user_group_resolver(session):
+    """
+    A function to get the UserGroupResolver shared
+    by everything that uses the same session.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    Returns
+    -------
+    resolver : UserGroupResolver
+    """
+
+    resolver = _user_group_resolvers.get(session)
+    if resolver is None:
+        resolver = UserGroupResolver(session)
+        _user_group_resolvers[session] = resolver
+    return resolver
+
+class ObjectCache(object):
+    """
+    ObjectCache class is used to look up the type, the object and the
+    ACLs of an iRODS path once per command instead of on every call.
+    A path is resolved with at most two lookups (collection, then data
+    object) and the answer, also a missing path, is kept for the next
+    calls. At most maxsize paths are kept; the least recently used ones
+    are dropped first. Entries have to be invalidated when the ACLs or
+    the inheritance of a path are changed.
+    Example:
+    cache = get_object_cache(session)
+    object_type, obj = cache.lookup('/tempZone/home/rods')
+    cache.permissions('/tempZone/home/rods')
+    cache.invalidate('/tempZone/home/rods')
+    """
+
+    def __init__(self, session, maxsize=4096):
+        self.session = session
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, load):
+        """A private method returning a cached value or loading and keeping it"""
+        metrics = get_metrics(self.session)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if metrics is not None:
+                    metrics.increment('object_cache_hits')
+                return self._entries[key]
+            self.misses += 1
+        if metrics is not None:
+            metrics.increment('object_cache_misses')
+        value = load()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def lookup(self, path):
+        """A method returning ('collection', obj), ('data_obj', obj) or (None, None) for a path"""
+        return self._get(('object', path), lambda: self._load(path))
+
+    def _load(self, path):
+        try:
+            return 'collection', self.session.collections.get(path)
+        except CollectionDoesNotExist:
+            pass
+        try:
+            return 'data_obj', self.session.data_objects.get(path)
+        except DataObjectDoesNotExist:
+            return None, None
+
+    def collection(self, path):
+        """A method returning the collection of a path or raising CollectionDoesNotExist"""
+        object_type, obj = self.lookup(path)
+        if object_type != 'collection':
+            raise CollectionDoesNotExist(path)
+        return obj
+
+    def data_object(self, path):
+        """A method returning the data object of a path or raising DataObjectDoesNotExist"""
+        object_type, obj = self.lookup(path)
+        if object_type != 'data_obj':
+            raise DataObjectDoesNotExist(path)
+        return obj
+
+    def permissions(self, path, raw=False):
+        """A method returning the ACLs of a collection or data object path"""
+        object_type, obj = self.lookup(path)
+        if object_type is None:
+            return None
+        if raw:
+            return self._get(('raw_acls', path), lambda: self.session.permissions.get(obj, report_raw_acls=True))
+        return self._get(('acls', path), lambda: self.session.permissions.get(obj))
+
+    def invalidate(self, path=None, recursive=False):
+        """A method to drop the entries of a path, of a whole tree with recursive, or all of them"""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries
+                        if key[1] == path or (recursive and in_subtree(key[1], path))]:
+                del self._entries[key]
+
+    def stats(self):
+        """A method returning the cache counters as a dict"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+
+_object_caches = WeakKeyDictionary()
+
+def get_object_cache(session):
+    """
+    A function to get the ObjectCache shared
+    by everything that uses the same session.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    Returns
+    -------
+    cache : ObjectCache
+    """
+
+    cache = _object_caches.get(session)
+    if cache is None:
+        cache = ObjectCache(session)
+        _object_caches[session] = cache
+    return cache
+
+def drop_object_cache(session):
+    """A function to forget everything the ObjectCache of a session holds"""
+    _object_caches.pop(session, None)
+
+def get_object_type(session, path):
+    """
+    A function to know whether a path is a collection or a data object:
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    path : str
+        an absolute iRODS path
+    Returns
+    -------
+    'collection', 'data_obj' or None
+    """
+
+    return get_object_cache(session).lookup(path)[0]
+
 def check_user_group(session, user):
     """
     A function to know the gorup user type:
@@ -66,13 +308,87 @@ def check_user_group(session, user):
     True/False
     """
 
-    result = session.query(UserGroup).filter(
-    Criterion('=', User.type, 'rodsgroup')).filter(
-    Criterion('=', User.name, user))
+    return get_user_group_resolver(session).is_group(user)
 
-    return len(result.all().rows) > 0
+def get_user_groups(session, user):
+    """
+    A function to get the groups a user is member of:
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    user : str
+        a user in iRODS
+    Returns
+    -------
+    groups : list
+        sorted group names, without the personal group of the user
+    """
+
+    result = session.query(UserGroup.name).filter(Criterion('=', User.name, user))
+    return sorted(set(item[UserGroup.name] for item in result) - {user})
 
-def get_objects_with_no_acl(session, collection_path):
+def get_group_members(session, group):
+    """
+    A function to get the members of a group:
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    group : str
+        a group in iRODS
+    Returns
+    -------
+    members : list
+        sorted user names
+    """
+
+    result = session.query(User.name).filter(Criterion('=', UserGroup.name, group))
+    return sorted(set(item[User.name] for item in result) - {group})
+
+def iter_acls_of_user(session, user, coll_path=None):
+    """
+    A generator function:
+    It streams the ACL entries a user or group holds, with one paged
+    query per object type filtered on the user name in the access table
+    instead of a walk over every object.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    user : str
+        a user/group in iRODS
+    coll_path : str
+        an absolute iRODS collection path to look in, the whole zone by default
+    Returns
+    -------
+    A generator object for AclEntry tuples
+    """
+
+    subtree = [None]
+    if coll_path is not None:
+        coll_path = coll_path.rstrip('/') or '/'
+        subtree = [Criterion('=', Collection.name, coll_path),
+                   Criterion('like', Collection.name, f'{coll_path.rstrip("/")}/%')]
+    query = session.query(Collection.name, Collection.inheritance, CollectionUser.name,
+                          CollectionUser.zone, CollectionAccess.name)\
+                   .filter(Criterion('=', CollectionUser.name, user)).order_by(Collection.name)
+    for criterion in subtree:
+        for result in (query.filter(criterion) if criterion is not None else query):
+            if coll_path is None or in_subtree(result[Collection.name], coll_path):
+                yield AclEntry(result[Collection.name], result[CollectionUser.name], result[CollectionUser.zone],
+                               result[CollectionAccess.name], _inheritance(result[Collection.inheritance]),
+                               'collection')
+    query = session.query(Collection.name, DataObject.name, User.name, User.zone, DataAccess.name)\
+                   .filter(Criterion('=', User.name, user))\
+                   .order_by(Collection.name).order_by(DataObject.name)
+    for criterion in subtree:
+        for result in (query.filter(criterion) if criterion is not None else query):
+            if coll_path is None or in_subtree(result[Collection.name], coll_path):
+                yield AclEntry(f'{result[Collection.name]}/{result[DataObject.name]}', result[User.name],
+                               result[User.zone], result[DataAccess.name], None, 'data_obj')
+
+def get_objects_with_no_acl(session, collection_path, snapshot=None):
     """
     A function to get the objects that don't have any permission on.
     Parameters
@@ -81,30 +397,180 @@ def get_objects_with_no_acl(session, collection_path):
         an iRODS session object
     collection_path : str
         an absolute in iRODS
+    snapshot : object
+        an AclSnapshot to read the tree with, a new one on session by default
     Returns
     -------
     object_list_with_no_acl : dict
     """
 
-    collection = session.collections.get(collection_path)
+    snapshot = snapshot if snapshot is not None else AclSnapshot(session)
     object_list_with_no_acl = dict()
     object_list_with_no_acl.setdefault('coll', [])
     object_list_with_no_acl.setdefault('data_obj', [])
-    all_colls = collection.walk()
-    for coll in all_colls:
-        coll_path = coll[0].path
-        coll_instance = session.collections.get(coll_path)
-        permissions_collections = session.permissions.get(coll_instance)
-        if len(permissions_collections) == 0:
-            object_list_with_no_acl['coll'].extend([coll_path])
-        for obj in coll[0].data_objects:
-            obj_path = obj.path
-            obj_instance = session.data_objects.get(obj_path)
-            permissions_data_objects = session.permissions.get(obj_instance)
-            if len(permissions_data_objects) == 0:
-                object_list_with_no_acl['data_obj'].extend([obj_path])
+    for path, object_type, inheritance, acls in snapshot.objects_with_acls(collection_path):
+        if len(acls) == 0:
+            if object_type == 'collection':
+                object_list_with_no_acl['coll'].extend([path])
+            else:
+                object_list_with_no_acl['data_obj'].extend([path])
     return object_list_with_no_acl
 
+ORPHANED_DATA_OBJECTS_SQL = 'select distinct c.coll_name, d.data_name from R_DATA_MAIN d \
+                join R_COLL_MAIN c on c.coll_id = d.coll_id where not exists \
+                (select 1 from R_OBJT_ACCESS a where a.object_id = d.data_id)'
+ORPHANED_COLLECTIONS_SQL = 'select c.coll_name from R_COLL_MAIN c where not exists \
+                (select 1 from R_OBJT_ACCESS a where a.object_id = c.coll_id)'
+
+def iter_specific_query(session, sql, alias, columns, args=None):
+    """
+    A generator function:
+    It registers a specific query, pages through its results
+    and removes the query again when the iteration ends.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    sql : str
+        the SQL of the specific query
+    alias : str
+        the alias the query is registered with
+    columns : list
+        the columns the result rows are mapped to
+    args : list
+        the values bound to '?' in the SQL
+    Returns
+    -------
+    A generator object for result rows
+    """
+
+    query = SpecificQuery(session, sql, alias, columns, args=args)
+    try:
+        query.register()
+    except Exception:
+        # an interrupted run may have left the alias registered
+        query.remove()
+        query.register()
+    metrics = get_metrics(session)
+    try:
+        if metrics is None:
+            for result in query:
+                yield result
+        else:
+            for result in timed_batches(metrics, 'specific_query', query.get_batches()):
+                yield result
+    except CAT_NO_ROWS_FOUND:
+        pass
+    finally:
+        query.remove()
+
+def iter_objects_with_no_acl_for_entire_zone(session, name_range=None, shard=None):
+    """
+    A generator function:
+    It streams the objects that don't have any permission on in the
+    entire zone. Each kind of object is found with a single anti-join
+    query that also returns the full logical path, so no extra lookup
+    is needed per object. With a name range only the collections and
+    the data objects of the collections with names in the range are
+    searched, so the zone can be searched in shards.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    name_range : tuple
+        (lower, upper) bounds of the collection names, lower included,
+        upper excluded, None for an open bound
+    shard : int
+        the number of the shard, which makes the query aliases unique
+        while several shards are searched at the same time
+    Returns
+    -------
+    A generator object for ('data_obj', path) and ('collection', path) tuples
+    """
+
+    bounds, args, suffix = '', [], ''
+    if name_range is not None:
+        lower, upper = name_range
+        if lower is not None:
+            bounds += ' and c.coll_name >= ?'
+            args.append(lower)
+        if upper is not None:
+            bounds += ' and c.coll_name < ?'
+            args.append(upper)
+        suffix = f'_in_shard_{shard}'
+    for result in iter_specific_query(session, ORPHANED_DATA_OBJECTS_SQL + bounds,
+                                      f'list_orphaned_data_object{suffix}',
+                                      [Collection.name, DataObject.name], args=args):
+        yield 'data_obj', f'{result[Collection.name]}/{result[DataObject.name]}'
+    for result in iter_specific_query(session, ORPHANED_COLLECTIONS_SQL + bounds,
+                                      f'list_orphaned_collections{suffix}',
+                                      [Collection.name], args=args):
+        yield 'collection', result[Collection.name]
+
+ORPHANED_DATA_OBJECTS_WITH_OWNER_SQL = 'select distinct d.data_id, c.coll_name, d.data_name, \
+                d.data_owner_name, d.data_owner_zone from R_DATA_MAIN d \
+                join R_COLL_MAIN c on c.coll_id = d.coll_id where d.data_id > ? \
+                and not exists (select 1 from R_OBJT_ACCESS a where a.object_id = d.data_id) \
+                order by d.data_id'
+ORPHANED_COLLECTIONS_WITH_OWNER_SQL = 'select c.coll_id, c.coll_name, c.coll_owner_name, \
+                c.coll_owner_zone from R_COLL_MAIN c where c.coll_id > ? \
+                and not exists (select 1 from R_OBJT_ACCESS a where a.object_id = c.coll_id) \
+                order by c.coll_id'
+
+OrphanedObject = namedtuple('OrphanedObject', ['object_type', 'id', 'path', 'owner_name', 'owner_zone'])
+
+def iter_orphaned_objects_with_owner(session, after_data_id=0, after_coll_id=0):
+    """
+    A generator function:
+    It streams the objects that don't have any permission on in the
+    entire zone together with their owners, in the order of their ids.
+    Objects up to the given ids are skipped, so that an interrupted
+    scan can continue where it stopped.
+    Parameters
+    ----------
+    session : object
+        an iRODS session object
+    after_data_id : int
+        the last data object id that was already handled
+    after_coll_id : int
+        the last collection id that was already handled
+    Returns
+    -------
+    A generator object for OrphanedObject tuples
+    """
+
+    for result in iter_specific_query(session, ORPHANED_DATA_OBJECTS_WITH_OWNER_SQL,
+                                      'list_orphaned_data_object_with_owner',
+                                      [DataObject.id, Collection.name, DataObject.name,
+                                       DataObject.owner_name, DataObject.owner_zone],
+                                      args=[str(after_data_id)]):
+        yield OrphanedObject('data_obj', int(result[DataObject.id]),
+                             f'{result[Collection.name]}/{result[DataObject.name]}',
+                             result[DataObject.owner_name], result[DataObject.owner_zone])
+    for result in iter_specific_query(session, ORPHANED_COLLECTIONS_WITH_OWNER_SQL,
+                                      'list_orphaned_collections_with_owner',
+                                      [Collection.id, Collection.name,
+                                       Collection.owner_name, Collection.owner_zone],
+                                      args=[str(after_coll_id)]):
+        yield OrphanedObject('collection', int(result[Collection.id]), result[Collection.name],
+                             result[Collection.owner_name], result[Collection.owner_zone])
+
+def chunked(iterable, size):
+    """
+    A generator function:
+    It splits an iterable into lists of at most size items
+    without reading further than the current chunk.
+    """
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 def get_objects_with_no_acl_for_entire_zone(session):
     """
     A function to get the objects that don't have any
@@ -118,39 +584,9 @@ def get_objects_with_no_acl_for_entire_zone(session):
     object_list_with_no_acl : list
     """
 
-    object_list_with_no_acl = []
-    sql_obj = 'select data_id, data_name from R_DATA_MAIN where data_id not in \
-                (select object_id from R_OBJT_ACCESS)'
-    alias_obj = 'list_orphaned_data_object'
-    columns_obj = [DataObject.id, DataObject.name]
-    sql_coll = 'select coll_id, coll_name from R_COLL_MAIN where coll_id not in \
-                (select object_id from R_OBJT_ACCESS)'
-    alias_coll = 'list_orphaned_collections'
-    columns_coll = [Collection.id, Collection.name]
-    try:
-        query_obj = SpecificQuery(session, sql_obj, alias_obj, columns_obj)
-        query_coll = SpecificQuery(session, sql_coll, alias_coll, columns_coll)
-    except Exception as err:
-        print(err)
-    else:
-        query_obj.register()
-        query_coll.register()
-        try:
-            for result in query_obj:
-                query = session.query(Collection.name, DataObject.name).filter(
-                        Criterion('=', DataObject.name, result[DataObject.name]))
-                object_list_with_no_acl.append(('data_obj', [f'{i[Collection.name]}/{i[DataObject.name]}' \
-                                                for i in query][0]))
-            for result in query_coll:
-                object_list_with_no_acl.append(('collection', result[Collection.name]))
-        except Exception as err:
-            print(err.args)
-    finally:
-        query_obj.remove()
-        query_coll.remove()
-    return object_list_with_no_acl
+    return list(iter_objects_with_no_acl_for_entire_zone(session))
 
-def write_acl_csv(session, coll_path, local_path):
+def write_acl_csv(session, coll_path, local_path, compression=None):
     """
     A function to write ACLs of a given collection to a csv file.
     ----------
@@ -159,27 +595,15 @@ def write_acl_csv(session, coll_path, local_path):
     collection_path : str
         an absolute in iRODS
     local_path : str
-        an absolute local file system path
-    """
-
-    collection = session.collections.get(coll_path)
-    all_colls = collection.walk()
-    filename = f"{local_path}/{'irods_permissions_{0}.csv'.format(datetime.today().strftime('%Y%m%d_%H%M'))}"
-    with open(filename, 'a') as f:
-        writer = csv.writer(f)
-        writer.writerow(['iRODS PATH', 'USER NAME', 'ACL'])
-        for coll in all_colls:
-            coll_path = coll[0].path
-            coll_instance = session.collections.get(coll_path)
-            permissions_collections = session.permissions.get(coll_instance)
-            writer.writerows([(item.path, item.user_name, item.access_name) for item in permissions_collections])
-            for obj in coll[0].data_objects:
-                obj_path = obj.path
-                obj_instance = session.data_objects.get(obj_path)
-                permissions_data_objects = session.permissions.get(obj_instance)
-                writer.writerows([(item.path, item.user_name, item.access_name) for item in permissions_data_objects])
-
-def write_acl_json(session, coll_path, local_path):
+        an absolute local file system path, or '-' for stdout
+    compression : str
+        None, 'gzip' or 'zstd'
+    """
+
+    filename = export_filename(local_path, 'csv', compression)
+    export_acls(AclSnapshot(session), coll_path, filename, 'csv', compression)
+
+def write_acl_json(session, coll_path, local_path, compression=None):
     """
     A function to write ACLs of a given collection to a json file.
     ----------
@@ -188,29 +612,28 @@ def write_acl_json(session, coll_path, local_path):
     collection_path : str
         an absolute in iRODS
     local_path : str
-        an absolute local file system path
-    """
-
-    filename = f"{local_path}/{'irods_permissions_{0}.json'.format(datetime.today().strftime('%Y%m%d_%H%M'))}"
-    collection = session.collections.get(coll_path)
-    all_colls = collection.walk()
-    acl_dict = dict()
-    for coll in all_colls:
-        single_coll_path = coll[0].path
-        coll_instance = session.collections.get(single_coll_path)
-        permissions_collections = session.permissions.get(coll_instance)
-        for item in permissions_collections:
-            acl_dict[item.path] = {}
-            break
-        [acl_dict[item.path].update({item.user_name: item.access_name}) for item in permissions_collections]
-
-        for obj in coll[0].data_objects:
-            obj_path = f'{coll[0].path}/{obj.name}'
-            obj_instance = session.data_objects.get(obj_path)
-            permissions_data_objects = session.permissions.get(obj_instance)
-            for item in permissions_data_objects:
-                acl_dict[item.path] = {}
-                break
-            [acl_dict[item.path].update({item.user_name: item.access_name}) for item in permissions_data_objects]
-    with open(filename, 'a') as write_file:
-            json.dump(acl_dict, write_file, indent=True)
\ No newline at end of file
+        an absolute local file system path, or '-' for stdout
+    compression : str
+        None, 'gzip' or 'zstd'
+    """
+
+    filename = export_filename(local_path, 'json', compression)
+    export_acls(AclSnapshot(session), coll_path, filename, 'json', compression)
+
+def write_acl_ndjson(session, coll_path, local_path, compression=None):
+    """
+    A function to write ACLs of a given collection to a newline
+    delimited json file, one ACL entry per line.
+    ----------
+    session : object
+        an iRODS session object
+    collection_path : str
+        an absolute in iRODS
+    local_path : str
+        an absolute local file system path, or '-' for stdout
+    compression : str
+        None, 'gzip' or 'zstd'
+    """
+
+    filename = export_filename(local_path, 'ndjson', compression)
+    export_acls(AclSnapshot(session), coll_path, filename, 'ndjson', compression)